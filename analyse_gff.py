@@ -13,134 +13,195 @@
 # -o or --organism    	 Ensembl organism name Ex: Mus_musculus
 # -e or --ensemblversion Ensembl version Ex: 84
 #-f  or --feature        List of features, separated by commas Ex: ncrna,cdna
+# -s or --stream         Bounded memory stats, without histogram, for huge files
+# -a or --accuracy       Relative accuracy of the quantiles in stream mode (default=0.01)
+# -p or --processes      Number of processes reading parts of a gunzipped gff file in stream mode (default=1)
+# -c or --compare        Other Ensembl versions compared with -e, separated by commas Ex: 83
 # -v or --verbose
 
 # Exemple :
 # python analyse_gff.py -o Mus_musculus -e 84 -f cdna,ncrna -v
+# python analyse_gff.py -o Triticum_aestivum -e 31 -f gene,mRNA -s -a 0.005 -p 8 -v
+# python analyse_gff.py -o Mus_musculus -e 84 -c 83 -f gene,cdna -v
 
 
 
 
 import argparse
 import os.path
-import fileinput
-from pylab import *
-import subprocess
+import sys
 import logging
-import pandas as pd
+from multiprocessing import Pool
 from validannot_env import gff3_path
 from validannot_env import log_path
+from validannot_gff import read_gff_index
+from validannot_io import chromosome_key
+from validannot_io import find_input
+from validannot_stats import read_gff_length_stats
 
 #############
 # Functions #
 #############
 
+# numpy, pandas and matplotlib take seconds to import : they are imported by the functions using them,
+# the stream mode, --help and argument errors never load them
 
-# Checks if the path and file exist
-# Argv = path and file
-# Returns a var that can be a boolean or an integer
-# If true, path and gz file exist, if false, path and gunzipped file exist, if 2, path or file do not exist
-def make_sure_file_exists(p,f):
-    if os.path.exists(p):
-        if os.path.isfile(p+"/"+f[:-3]):
-            logging.info("Found gunzipped file: "+ f[:-3] + "\n No need to gunzip...")
-            gz = False
-        elif os.path.isfile(p+"/"+f):
-            logging.info("Found gzipped file: "+ f +"...")
-            gz = True
-        else:
-            gz=2
-    else:
-            gz=2
-    return gz
-
-# Gets the length of specific features in a gff file
-# Argv = gff file and a feature list
-# Returns dictionary of ID:Length
-def get_length(gff_in,feature_list):
-    length ={}
-    for line in fileinput.input(gff_in):
-        if line.startswith('#'):
-            continue
-        gff_fields = line.strip().split('\t')
-        attribute_field = gff_fields[8].split(';')
-        for i,a in enumerate(attribute_field):
-            if a.startswith("ID"):
-                id_feature=a
-        if gff_fields[2] in feature_list:
-            i = id_feature
-            l= int(gff_fields[4]) -int(gff_fields[3])
-            length.update({i:l})
-
-    fileinput.close()
-
-    return length
-
-
-# Gets the total length of feature from gff file
-# Argv = gff file and a feature list
-# Returns dictionary of total length
-def get_total_length(gff_in,feature_list):
-    length = {}
-    for line in fileinput.input(gff_in):
-        if line.startswith('#'):
-            continue
-        gff_fields = line.strip().split('\t')
-        attribute_field = gff_fields[8].split(';')
-        for i,a in enumerate(attribute_field):
-            if a.startswith("ID"):
-                id_feature=a
-        if gff_fields[2] in feature_list:
-            i = id_feature
-            l = int(gff_fields[4]) - int(gff_fields[3])
-            length.update({i: l})
-    fileinput.close()
-    return sum(length.values())
 
+# Gets the specific features of a gff file as a columnar table
+# The file is parsed once, the next analyses read its columnar snapshot (file.table.npz), only the columns used by the report
+# Argv = gff file, a feature list and the columns used (among seqid, type, start, end, the Ensembl ID being always read)
+# Returns a data.frame with one row per ID : Ensembl ID, the columns used and Length with start and end
+def get_features(gff_in,feature_list,columns):
+    from validannot_table import load_gff_table
+    # Only the features of the list are kept, features without ID are not counted
+    return load_gff_table(gff_in, set(feature_list), columns)
 
 
 # Prints length data.frame summary
 # Argv = length data.frame and filehandle
 def length_summary(df,report):
-    min = df['Length'].min()
-    index_min = df['Length'].idxmin()
-    ID_min = df['Ensembl ID'][index_min]
-    max = df['Length'].max()
-    index_max = df['Length'].idxmax()
-    ID_max= df['Ensembl ID'][index_max]
-    std = df['Length'].std()
-    mean = df['Length'].mean()
-    median = df['Length'].median()
-    q1 = df['Length'].quantile(0.25)
-    q2 = df['Length'].quantile(0.5)
-    q3 = df['Length'].quantile(0.75)
-    report.write("Min length: " + str(min) + " (" + str(ID_min)+")\n")
-    report.write("Max length: " + str(max) + " (" + str(ID_max)+")\n")
-    report.write("Mean length: " + str(std) + "\n")
-    report.write("Length std: " + str(mean) + "\n")
-    report.write("Median length: " + str(median) + "\n")
+    length = df['Length']
+    index_min = length.idxmin()
+    index_max = length.idxmax()
+    q1, q2, q3 = length.quantile([0.25, 0.5, 0.75])
+    report.write("Min length: " + str(length[index_min]) + " (" + str(df['Ensembl ID'][index_min])+")\n")
+    report.write("Max length: " + str(length[index_max]) + " (" + str(df['Ensembl ID'][index_max])+")\n")
+    report.write("Mean length: " + str(length.mean()) + "\n")
+    report.write("Length std: " + str(length.std()) + "\n")
+    report.write("Median length: " + str(q2) + "\n")
+    report.write("Median length, First to third quantile: " + str(q1) + ", " + str(q2) + ", " + str(q3) + "\n")
+
+
+# Prints the length summary of each group of features, computed on the same data.frame
+# Argv = length data.frame, the grouping column (type or seqid) and filehandle
+def breakdown_summary(df,column,report):
+    stats = df.groupby(column)['Length'].agg(['count', 'sum', 'min', 'max', 'mean', 'std', 'median'])
+    stats = stats[stats['count'] > 0]
+    if column == 'seqid':
+        stats = stats.reindex(sorted(stats.index, key=chromosome_key))
+    report.write("\nLength by " + column + ":\n")
+    report.write(stats.to_string() + "\n")
+
+
+# Prints the summary of streamed length stats, quantiles being within the accuracy of the sketch
+# Only consecutive features of the same ID are counted once, the stream keeps no list of the IDs
+# Argv = LengthStats and filehandle
+def stream_length_summary(stats,report):
+    q1, q2, q3 = [stats.quantile(q) for q in (0.25, 0.5, 0.75)]
+    report.write("Min length: " + str(stats.min) + " (" + str(stats.min_id)+")\n")
+    report.write("Max length: " + str(stats.max) + " (" + str(stats.max_id)+")\n")
+    report.write("Mean length: " + str(stats.mean) + "\n")
+    report.write("Length std: " + str(stats.std()) + "\n")
+    report.write("Median length: " + str(q2) + "\n")
     report.write("Median length, First to third quantile: " + str(q1) + ", " + str(q2) + ", " + str(q3) + "\n")
+    report.write("Quantiles within " + str(stats.sketch.accuracy * 100) + "% of their value\n")
+    report.write("Features of the same ID counted once when they follow each other (the default mode counts each ID once in the whole file)\n")
+
+
+# Prints the streamed length stats of each group of features
+# Argv = dictionary group:LengthStats, the grouping column (type or seqid) and filehandle
+def stream_breakdown_summary(groups,column,report):
+    keys = sorted(groups, key=chromosome_key if column == 'seqid' else None)
+    width = max([len(column)] + [len(k) for k in keys])
+    report.write("\nLength by " + column + ":\n")
+    report.write(column.ljust(width) + "%10s %14s %10s %10s %14s %14s %10s\n" % ('count', 'sum', 'min', 'max', 'mean', 'std', 'median'))
+    for k in keys:
+        g = groups[k]
+        report.write(k.ljust(width) + "%10d %14d %10d %10d %14.6f %14.6f %10.1f\n" % (g.count, g.total, g.min, g.max, g.mean, g.std(), g.quantile(0.5)))
+
+
+# Gets the end of the x axis of a length histogram : the mean length of the last bin holding more than 20 features
+# Argv = the lengths and bin number
+def histogram_limit(length,b):
+    import numpy as np
+    # Counts and length sums of features inside each bin
+    bins = np.linspace(length.min(), length.max(), b)
+    digits = np.digitize(length, bins)
+    size = np.bincount(digits)
+    total = np.bincount(digits, weights=length)
+    okbins = np.nonzero(size > 20)[0]
+    lastbin = okbins[-1] if len(okbins) else digits.max()
+    return total[lastbin] / size[lastbin]
+
 
 # Generates an configured histogram of a feature length
 # Argv = length data.frame, bin number, list of features, Ensembl organism name and Ensembl version
 def configured_histogram(df,b,features,o,v,path):
-    # Counts of feature inside each bin
-    bins = np.linspace(df['Length'].min(), df['Length'].max(), b)
-    grouped = df.groupby(np.digitize(df['Length'], bins))
-    size = grouped.size()
-    mean = grouped.mean()
-    okbins = size[size > 20]
-    lastbin = okbins.keys()[-1]
-    lastbin_mean = mean.loc[lastbin].values[0]
+    import matplotlib.pyplot as plt
+    length = df['Length'].values
+    lastbin_mean = histogram_limit(length,b)
     f="_".join(features)
-    plt.hist(df['Length'], b, facecolor='green')
+    plt.hist(length, b, facecolor='green')
     plt.xlabel('Length')
     plt.xlim(0, lastbin_mean)
     plt.ylabel('Number')
     plt.title("Length of "+f+" "+o + "_ens" + v)
-    savefig(path+f +"_"+ o + "_ens" + v + "_size_histogram.png")
+    plt.savefig(path+f +"_"+ o + "_ens" + v + "_size_histogram.png")
+    plt.close()
+
+# Generates the overlaid length histograms of several releases, on the same bins
+# Argv = list of length data.frames, bin number, list of features, Ensembl organism name and list of Ensembl versions
+def compared_histogram(dfs,b,features,o,versions,path):
+    import matplotlib.pyplot as plt
+    import numpy as np
+    lengths = [df['Length'].values for df in dfs if len(df)]
+    bins = np.linspace(min(l.min() for l in lengths), max(l.max() for l in lengths), b)
+    f="_".join(features)
+    for df, v in zip(dfs, versions):
+        if len(df):
+            plt.hist(df['Length'].values, bins, alpha=0.5, label="ens" + v)
+    plt.xlabel('Length')
+    plt.xlim(0, max(histogram_limit(l,b) for l in lengths))
+    plt.ylabel('Number')
+    plt.legend()
+    plt.title("Length of "+f+" "+o + "_ens" + "_".join(versions))
+    plt.savefig(path+f +"_"+ o + "_ens" + "_".join(versions) + "_size_histogram.png")
     plt.close()
 
+
+# Gets the stable IDs of features, without their version (ENSMUST00000177564.1 and .2 are the same transcript)
+def stable_ids(ids):
+    return ids.str.extract(r'^(.*?)(?:\.\d+)?$', expand=False)
+
+
+# Compares the features of several releases of a gff file, each release being read by its own process
+# Argv = list of gff files, list of Ensembl versions (same order), a feature list, the column detailing the added and removed features (seqid or type),
+# Ensembl organism name and filehandle
+def compare_releases(gff_ins,versions,feature_list,column,o,report):
+    import pandas as pd
+    pool = Pool(len(gff_ins))
+    try:
+        # Type counts, lengths and the detailing column, the IDs being compared
+        columns = ['type', 'start', 'end', column]
+        parts = [pool.apply_async(get_features, (gff_in, feature_list, columns)) for gff_in in gff_ins]
+        dfs = [part.get() for part in parts]
+    finally:
+        pool.close()
+        pool.join()
+    names = ["ens" + v for v in versions]
+    report.write("Releases: " + ", ".join(names) + "\n")
+    # Feature counts of each type
+    counts = pd.DataFrame(dict((n, df['type'].astype(str).value_counts()) for n, df in zip(names, dfs)), columns=names).fillna(0).astype(int)
+    report.write("\nFeature counts by type:\n" + counts.to_string() + "\n")
+    # Length distributions
+    lengths = pd.DataFrame(dict((n, df['Length'].describe()) for n, df in zip(names, dfs)), columns=names)
+    lengths.loc['sum'] = [df['Length'].sum() for df in dfs]
+    report.write("\nLength distributions:\n" + lengths.to_string(float_format=lambda x: "%.1f" % x) + "\n")
+    # Added and removed features between consecutive releases, IDs being compared without version
+    for (n_old, old), (n_new, new) in zip(zip(names, dfs), zip(names, dfs)[1:]):
+        old_ids = stable_ids(old['Ensembl ID'])
+        new_ids = stable_ids(new['Ensembl ID'])
+        changes = pd.DataFrame({'added': new[~new_ids.isin(old_ids)][column].astype(str).value_counts(),
+                                'removed': old[~old_ids.isin(new_ids)][column].astype(str).value_counts()},
+                               columns=['added', 'removed']).fillna(0).astype(int)
+        if column == 'seqid':
+            changes = changes.reindex(sorted(changes.index, key=chromosome_key))
+        report.write("\nFeatures added and removed by " + column + " from " + n_old + " to " + n_new + ":\n")
+        report.write(changes.to_string() + "\n")
+        report.write("Total: " + str(changes['added'].sum()) + " added, " + str(changes['removed'].sum()) + " removed\n")
+    compared_histogram(dfs, 500, feature_list, o, versions, gff3_path)
+
+
 #############
 # Arguments and usage
 
@@ -148,16 +209,47 @@ parser = argparse.ArgumentParser(description='A script to build an annotation fi
 parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus_musculus)', required=True)
 parser.add_argument('-e', '--ensemblversion', help='Ensembl version Ex: 84', required=True)
 parser.add_argument('-f', '--feature', help='List of features, separated by commas Ex: ncrna,cdna', required=True)
+parser.add_argument('-s', '--stream', help='Bounded memory stats (online mean and variance, quantile sketch), without histogram, for huge files', action='store_true')
+parser.add_argument('-a', '--accuracy', help='Relative accuracy of the quantiles in stream mode (default=0.01)', type=float, default=0.01)
+parser.add_argument('-p', '--processes', help='Number of processes reading parts of a gunzipped gff file in stream mode (default=1)', type=int, default=1)
+parser.add_argument('-c', '--compare', help='Other Ensembl versions compared with -e, separated by commas Ex: 83')
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
+if args['compare'] and args['stream']:
+    parser.error("-c compares the lengths of all the features, it can not be used with -s")
 
 
 organism = args['organism']
 version = args['ensemblversion']
 feature = args['feature'].split(',')
+stream = args['stream']
+accuracy = args['accuracy']
+processes = args['processes']
 if args['verbose']:
     logging.basicConfig(filename=log_path+'analyse_gff.log',level=logging.INFO,format='%(asctime)s %(message)s')
 
+## comparison of releases
+if args['compare']:
+    versions = sorted(set([version] + args['compare'].split(',')), key=int)
+    only_chr_feature = [f for f in feature if f not in ('cdna', 'ncrna')]
+    cdna_ncrna_feature = [f for f in feature if f in ('cdna', 'ncrna')]
+    # only_chr gff files, added and removed features by chromosome
+    # cdna_ncrna gff files, each transcript being its own seqid, added and removed features by type
+    for gff_name, features, column, report_name in (
+            ("only_chr_" + organism + "_ens%s_sgdb.gff.gz", only_chr_feature, 'seqid', "only_chr_" + organism + "_ens" + "_".join(versions) + "_comparison_report.txt"),
+            (organism + "_ens%s_cdna_ncrna.gff.gz", cdna_ncrna_feature, 'type', organism + "_ens" + "_".join(versions) + "_cdna_ncrna_comparison_report.txt")):
+        if len(features) == 0:
+            continue
+        gff_ins = [find_input(gff3_path, gff_name % v) for v in versions]
+        if None in gff_ins:
+            sys.exit(1)
+        logging.info("Comparing " + ','.join(gff_ins))
+        report = open(gff3_path + report_name, "w")
+        compare_releases(gff_ins, versions, features, column, organism, report)
+        report.close()
+        logging.info("Comparison report written : " + gff3_path + report_name)
+    sys.exit(0)
+
 ## only_chr_gff
 only_chr_feature = feature[:]
 
@@ -168,28 +260,32 @@ if 'ncrna' in only_chr_feature:
 
 only_chr_gff = "only_chr_" + organism + "_ens" + version+"_sgdb.gff.gz"
 if len(only_chr_feature) != 0:
-    isgz_only_chr_gff = make_sure_file_exists(gff3_path,only_chr_gff)
-    # gunzip or not only_chr_gff
-    if type(isgz_only_chr_gff) is int:
-     logging.info(os.strerror(isgz_only_chr_gff))
-     sys.exit(1)
-    else:
-        if not isgz_only_chr_gff:
-           only_chr_gff = only_chr_gff[:-3]
-           only_chr_gff_report = only_chr_gff[:-6] + "_report.txt"
-        else:
-            inF = gff3_path + only_chr_gff
-            proc = subprocess.Popen(["gunzip", gff3_path + only_chr_gff], stderr=subprocess.PIPE)
-            for line in proc.stderr:
-                logging.info(line)
-                only_chr_gff = only_chr_gff[:-3]
-                only_chr_gff_report = only_chr_gff[:-6] + "_report.txt"
+    # gzipped file read as it is
+    only_chr_gff_in = find_input(gff3_path,only_chr_gff)
+    if only_chr_gff_in is None:
+        sys.exit(1)
+    only_chr_gff = only_chr_gff[:-3]
+    only_chr_gff_report = only_chr_gff[:-6] + "_report.txt"
+    # The sidecar index written by the previous scripts tells the features missing in the file without reading it
+    index = read_gff_index(only_chr_gff_in)
+    if index is not None:
+        missing = [f for f in only_chr_feature if f not in index['types']]
+        if missing:
+            logging.info("Features not found in file " + only_chr_gff_in + " : " + ','.join(missing))
 
     report = open(gff3_path+only_chr_gff_report,"w")
-    length = get_length(gff3_path+only_chr_gff,only_chr_feature)
-    df_only_chr = pd.DataFrame(length.items(), columns = ['Ensembl ID','Length'])
-    length_summary(df_only_chr,report)
-    configured_histogram(df_only_chr, 500,only_chr_feature,organism,version,gff3_path)
+    if stream:
+        stats, by_type, by_seqid = read_gff_length_stats(only_chr_gff_in, set(only_chr_feature), accuracy, processes)
+        stream_length_summary(stats,report)
+        stream_breakdown_summary(by_type,'type',report)
+        stream_breakdown_summary(by_seqid,'seqid',report)
+        logging.info("Stream mode, no histogram for " + only_chr_gff)
+    else:
+        df_only_chr = get_features(only_chr_gff_in,only_chr_feature,['seqid', 'type', 'start', 'end'])
+        length_summary(df_only_chr,report)
+        breakdown_summary(df_only_chr,'type',report)
+        breakdown_summary(df_only_chr,'seqid',report)
+        configured_histogram(df_only_chr, 500,only_chr_feature,organism,version,gff3_path)
     report.close()
 else:
     logging.info("Some features don't exist in file " +only_chr_gff+"\n: Can't test...\n")
@@ -205,30 +301,29 @@ if 'ncrna' in feature:
 
 cdna_ncrna_gff = organism + "_ens" + version +"_cdna_ncrna.gff.gz"
 if len(cdna_ncrna_feature) != 0:
-    isgz_cdna_ncrna_gff = make_sure_file_exists(gff3_path,cdna_ncrna_gff)
-    # gunzip or not cdna_ncrna_gff
-    if type(isgz_cdna_ncrna_gff) is int:
-        logging.info(os.strerror(isgz_cdna_ncrna_gff))
+    # gzipped file read as it is
+    cdna_ncrna_gff_in = find_input(gff3_path,cdna_ncrna_gff)
+    if cdna_ncrna_gff_in is None:
         sys.exit(1)
-    else:
-        if not isgz_cdna_ncrna_gff:
-            cdna_ncrna_gff = cdna_ncrna_gff[:-3]
-            cdna_ncrna_gff_report = cdna_ncrna_gff[:-3] + "_report.txt"
-        else:
-            inF = gff3_path + cdna_ncrna_gff
-            proc = subprocess.Popen(["gunzip", gff3_path + cdna_ncrna_gff], stderr=subprocess.PIPE)
-            for line in proc.stderr:
-                logging.info(line)
-                cdna_ncrna_gff = cdna_ncrna_gff[:-3]
-                cdna_ncrna_gff_report = cdna_ncrna_gff[:-3] + "_report.txt"
+    cdna_ncrna_gff = cdna_ncrna_gff[:-3]
+    cdna_ncrna_gff_report = cdna_ncrna_gff[:-3] + "_report.txt"
 
     report = open(gff3_path+cdna_ncrna_gff_report,"w")
-    length = get_length(gff3_path+cdna_ncrna_gff,feature)
-    df_cdna_ncrna = pd.DataFrame(length.items(), columns = ['Ensembl ID','Length'])
-    length_summary(df_cdna_ncrna,report)
-    total_length=get_total_length(gff3_path+cdna_ncrna_gff,feature)
-    report.write("Total length of features:"+str(total_length)+"\n" )
-    configured_histogram(df_cdna_ncrna, 500,feature,organism,version,gff3_path)
+    # Each transcript is its own seqid in this file, only the types are detailed
+    if stream:
+        stats, by_type, by_seqid = read_gff_length_stats(cdna_ncrna_gff_in, set(feature), accuracy, processes)
+        stream_length_summary(stats,report)
+        report.write("Total length of features:"+str(stats.total)+"\n" )
+        stream_breakdown_summary(by_type,'type',report)
+        logging.info("Stream mode, no histogram for " + cdna_ncrna_gff)
+    else:
+        # The seqids (one by transcript) are not read
+        df_cdna_ncrna = get_features(cdna_ncrna_gff_in,feature,['type', 'start', 'end'])
+        length_summary(df_cdna_ncrna,report)
+        total_length=df_cdna_ncrna['Length'].sum()
+        report.write("Total length of features:"+str(total_length)+"\n" )
+        breakdown_summary(df_cdna_ncrna,'type',report)
+        configured_histogram(df_cdna_ncrna, 500,feature,organism,version,gff3_path)
     report.close()
 else:
     logging.info("cdna and ncrna are the only features available in file " + cdna_ncrna_gff + "\n: Can't test any other feature....\n")
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# benchmark_build_gff.py
+# Measures the time of build_gff_from_ensembl_fasta.py with a single process, then with the cdna and ncrna files processed at the same time
+# Both runs are checked to write the same files byte for byte, plain files and bgzf files (-z)
+
+# Usage : python benchmark_build_gff.py -o Ensembl organism name -e Ensembl version -z level
+
+# Arguments :
+# -o or --organism        = Ensembl organism name Ex: Mus_musculus
+# -e or --ensemblversion  = Ensembl version Ex: 84
+# -z or --bgzf            = compression level of the bgzf runs, 1 fastest to 9 smallest (default=6)
+
+# Exemple :
+# python benchmark_build_gff.py -o Mus_musculus -e 84
+
+from validannot_env import gff3_path
+from validannot_env import cdna_fasta_path
+import argparse
+import filecmp
+import os.path
+import subprocess
+import sys
+import time
+
+
+#############
+# Functions #
+#############
+
+# Runs build_gff_from_ensembl_fasta.py in a new python process
+# Argv = the organism, the Ensembl version, the number of processes and the bgzf compression level (None for plain files)
+# Returns the elapsed time
+def run(organism, version, processes, level):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'build_gff_from_ensembl_fasta.py')
+    command = [sys.executable, script, '-o', organism, '-e', version, '-p', str(processes)]
+    if level is not None:
+        command += ['-z', str(level)]
+    start = time.time()
+    subprocess.check_call(command)
+    return time.time() - start
+
+
+#############
+
+# Arguments and usage
+
+parser = argparse.ArgumentParser(description='A benchmark of build_gff_from_ensembl_fasta.py, single process against two processes')
+parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus_musculus)', required=True)
+parser.add_argument('-e', '--ensemblversion', help='Ensembl version Ex: 84', required=True)
+parser.add_argument('-z', '--bgzf', help='Compression level of the bgzf runs, 1 fastest to 9 smallest (default=6)', type=int, default=6)
+args = vars(parser.parse_args())
+
+organism = args['organism']
+version = args['ensemblversion']
+
+failed = []
+for level in (None, args['bgzf']):
+    outputs = [cdna_fasta_path + organism + "_ens" + version + "_cdna_ncrna.fa",
+               gff3_path + organism + "_ens" + version + "_cdna_ncrna.gff"]
+    if level is not None:
+        outputs = [o + ".gz" for o in outputs]
+    serial = run(organism, version, 1, level)
+    for o in outputs:
+        os.rename(o, o + '.serial')
+    parallel = run(organism, version, 2, level)
+    mode = "plain" if level is None else "bgzf -z " + str(level)
+    for o in outputs:
+        if not filecmp.cmp(o + '.serial', o, shallow=False):
+            failed.append(os.path.basename(o))
+        os.remove(o + '.serial')
+    print "%-12s 1 process : %.1f s   2 processes : %.1f s" % (mode, serial, parallel)
+
+if failed:
+    raise SystemExit("Files differ between 1 and 2 processes : " + ", ".join(failed))
+print "same files with 1 and 2 processes"
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+# benchmark_ensembl_download.py
+# Measures the download throughput of the validannot ftp engine against a local ftp stand-in server
+# The stand-in serves a fake Ensembl release tree (dna, cdna, ncrna fasta, gff3 and gtf files)
+# The same five files are retrieved with 1 session and with a pool of sessions
+
+# Usage : python benchmark_ensembl_download.py -s size_in_MB -b bytes_per_second -j connections
+
+# Arguments :
+# -s or --size         = size of the largest (dna) file in MB, other files are smaller (default=20)
+# -b or --bandwidth    = bandwidth limit per data connection in bytes per second (default=10000000)
+# -j or --connections  = number of ftp sessions of the pool (default=5)
+
+# Exemple :
+# python benchmark_ensembl_download.py -s 20 -b 10000000 -j 5
+
+from validannot_ftp import FtpPool
+from validannot_ftp import run_transfers
+from validannot_ftp import retrieve_matching
+from validannot_ftpserver import start_standin_server
+import argparse
+import functools
+import os
+import posixpath
+import shutil
+import tempfile
+import time
+
+
+#############
+# Functions #
+#############
+
+# Relative sizes of the release files, the dna fasta being the largest one
+artifacts = [('fasta/mus_musculus/dna', 'Mus_musculus.GRCm38.dna.toplevel.fa.gz', 1.0),
+             ('fasta/mus_musculus/cdna', 'Mus_musculus.GRCm38.cdna.all.fa.gz', 0.5),
+             ('fasta/mus_musculus/ncrna', 'Mus_musculus.GRCm38.ncrna.fa.gz', 0.2),
+             ('gff3/mus_musculus', 'Mus_musculus.GRCm38.84.gff3.gz', 0.4),
+             ('gtf/mus_musculus', 'Mus_musculus.GRCm38.84.gtf.gz', 0.4)]
+
+
+# Builds a fake Ensembl release 84 tree
+# Argv = root directory and size of the largest file in bytes
+def build_release_tree(root, size):
+    for d, name, ratio in artifacts:
+        path = os.path.join(root, 'pub', 'release-84', d)
+        os.makedirs(path)
+        remaining = int(size * ratio)
+        with open(os.path.join(path, name), 'wb') as out:
+            while remaining > 0:
+                block = os.urandom(min(remaining, 1 << 20))
+                out.write(block)
+                remaining -= len(block)
+
+
+# Retrieves the five release files with a pool of sessions
+# Returns the number of bytes retrieved and the elapsed time
+def run(port, connections, outdir):
+    pool = FtpPool('127.0.0.1', connections, port=port)
+    tasks = []
+    for d, name, ratio in artifacts:
+        ftpdir = posixpath.join('/pub/release-84', d)
+        tasks.append(functools.partial(retrieve_matching, ftpdir=ftpdir, suffix=name, file_out=os.path.join(outdir, name)))
+    start = time.time()
+    try:
+        results = run_transfers(pool, tasks)
+    finally:
+        pool.close()
+    elapsed = time.time() - start
+    return sum(r.nbytes for rs in results for r in rs), elapsed
+
+
+#############
+
+# Arguments and usage
+
+parser = argparse.ArgumentParser(description='A benchmark of the concurrent Ensembl download engine against a local ftp stand-in server')
+parser.add_argument('-s', '--size', help='Size of the largest file in MB (default=20)', type=float, default=20)
+parser.add_argument('-b', '--bandwidth', help='Bandwidth limit per data connection in bytes per second (default=10000000)', type=int, default=10000000)
+parser.add_argument('-j', '--connections', help='Number of ftp sessions of the pool (default=5)', type=int, default=5)
+args = vars(parser.parse_args())
+
+workdir = tempfile.mkdtemp(prefix='validannot_bench_')
+try:
+    root = os.path.join(workdir, 'ftp')
+    outdir = os.path.join(workdir, 'out')
+    os.makedirs(outdir)
+    build_release_tree(root, int(args['size'] * (1 << 20)))
+    server = start_standin_server(root, bandwidth=args['bandwidth'])
+    port = server.server_address[1]
+
+    nbytes, serial = run(port, 1, outdir)
+    print "1 session   : %d bytes in %.2fs (%.1f MB/s)" % (nbytes, serial, nbytes / serial / (1 << 20))
+    nbytes, pooled = run(port, args['connections'], outdir)
+    print "%d sessions  : %d bytes in %.2fs (%.1f MB/s)" % (args['connections'], nbytes, pooled, nbytes / pooled / (1 << 20))
+    print "speedup     : %.2fx" % (serial / pooled)
+    server.shutdown()
+    server.server_close()
+finally:
+    shutil.rmtree(workdir)
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+# benchmark_gff_rewrite.py
+# Measures the rewriting speed of raw Ensembl gff3 lines, compiled rewriter (validannot_gff.py) against the former line by line rewriting
+# The lines come from a raw Ensembl gff3 file, or from a sample of Ensembl 84 mouse lines
+# Both rewritings are checked to give the same lines
+
+# Usage : python benchmark_gff_rewrite.py -i raw_gff3_file -l lines -n repeats
+
+# Arguments :
+# -i or --input    = raw Ensembl gff3 file, plain or gzipped (default=built in Ensembl 84 sample)
+# -l or --lines    = number of lines read from the input file (default=200000)
+# -n or --repeats  = number of times the lines are rewritten (default=5)
+
+# Exemple :
+# python benchmark_gff_rewrite.py -i Mus_musculus_ens84.gff.gz -l 500000
+
+from validannot_gff import ensembl_rewriter
+from validannot_io import open_input
+import argparse
+import itertools
+import time
+
+
+#############
+# Functions #
+#############
+
+# Lines of the Mus_musculus.GRCm38.84.gff3 file, one of each kind
+sample = ['1\tGRCm38\tchromosome\t1\t195471971\t.\t.\t.\tID=chromosome:1;Alias=CM000994.2,NC_000067.6',
+          '1\tensembl_havana\tgene\t3205901\t3671498\t.\t-\t.\tID=gene:ENSMUSG00000051951;Name=Xkr4;biotype=protein_coding;description=X-linked Kx blood group related 4 [Source:MGI Symbol%3BAcc:MGI:3528744];gene_id=ENSMUSG00000051951;havana_gene=OTTMUSG00000026353;havana_version=2;logic_name=ensembl_havana_gene;version=5',
+          '1\thavana\tmRNA\t3205901\t3216344\t.\t-\t.\tID=transcript:ENSMUST00000162897;Parent=gene:ENSMUSG00000051951;Name=Xkr4-003;biotype=processed_transcript;havana_transcript=OTTMUST00000086625;havana_version=1;transcript_id=ENSMUST00000162897;transcript_support_level=1;version=1',
+          '1\thavana\texon\t3213609\t3216344\t.\t-\t.\tParent=transcript:ENSMUST00000162897;Name=ENSMUSE00000858910;constitutive=0;ensembl_end_phase=-1;ensembl_phase=-1;exon_id=ENSMUSE00000858910;rank=1;version=1',
+          '1\tensembl_havana\tCDS\t3216025\t3216968\t.\t-\t2\tID=CDS:ENSMUSP00000070648;Parent=transcript:ENSMUST00000070533;protein_id=ENSMUSP00000070648',
+          '1\tensembl_havana\tfive_prime_UTR\t3671349\t3671498\t.\t-\t.\tParent=transcript:ENSMUST00000070533',
+          '1\tensembl\tsnRNA_gene\t3783876\t3783933\t.\t-\t.\tID=gene:ENSMUSG00000064842;Name=Gm26206;biotype=snRNA;description=predicted gene%2C 26206 [Source:MGI Symbol%3BAcc:MGI:5455983];gene_id=ENSMUSG00000064842;logic_name=ncrna;version=1',
+          '1\tensembl\tsnRNA\t3783876\t3783933\t.\t-\t.\tID=transcript:ENSMUST00000082908;Parent=gene:ENSMUSG00000064842;Name=Gm26206-201;biotype=snRNA;transcript_id=ENSMUST00000082908;version=1',
+          '1\thavana\tlincRNA_gene\t3205901\t3216344\t.\t+\t.\tID=gene:ENSMUSG00000102343;Name=Gm37381;biotype=lincRNA;description=predicted gene%2C 37381 [Source:MGI Symbol%3BAcc:MGI:5610609];gene_id=ENSMUSG00000102343;havana_gene=OTTMUSG00000049958;havana_version=1;logic_name=havana;version=1',
+          '1\thavana\tpseudogene\t3252757\t3253236\t.\t+\t.\tID=gene:ENSMUSG00000102851;Name=Gm18956;biotype=processed_pseudogene;description=predicted gene%2C 18956 [Source:MGI Symbol%3BAcc:MGI:5011141];gene_id=ENSMUSG00000102851;havana_gene=OTTMUSG00000049960;havana_version=1;logic_name=havana;version=1',
+          'MT\tinsdc\tRNA\t70\t1024\t.\t+\t.\tID=gene:ENSMUSG00000064337;Name=mt-Rnr1;biotype=Mt_rRNA;description=mitochondrially encoded 12S rRNA [Source:MGI Symbol%3BAcc:MGI:102493];gene_id=ENSMUSG00000064337;logic_name=mt_genbank_import;version=1',
+          'MT\tinsdc\tmt_gene\t1094\t2675\t.\t+\t.\tID=gene:ENSMUSG00000064339;Name=mt-Rnr2;biotype=Mt_rRNA;gene_id=ENSMUSG00000064339;logic_name=mt_genbank_import;version=1']
+
+
+# Former rewriting of modify_ensembl_gff.py, each attribute being checked against each prefix
+def legacy_convert_ensemblgff_attributes(gff_fields):
+
+    attributes = gff_fields[8].split(';')
+    for a in attributes:
+        if a.startswith('ID=gene:') and gff_fields[2].endswith('_gene'):
+            gff_fields[2] = 'gene'
+        if a.startswith('ID=gene:') and gff_fields[2] == 'RNA':
+            gff_fields[2] = 'gene'
+        if a.startswith('ID=chromosome:'):
+            i = attributes.index(a)
+            attributes[i] = a.replace('ID=chromosome:', 'ID=')
+        if a.startswith('ID=gene:'):
+            i = attributes.index(a)
+            attributes[i] = a.replace('ID=gene:', 'ID=')
+        if a.startswith('ID=transcript:'):
+            i = attributes.index(a)
+            attributes[i] = a.replace('ID=transcript:', 'ID=')
+        if a.startswith('ID=CDS:'):
+            i = attributes.index(a)
+            attributes[i] = a.replace('ID=CDS:', 'ID=')
+        if a.startswith('Parent=gene:'):
+            i = attributes.index(a)
+            attributes[i] = a.replace('Parent=gene:', 'Parent=')
+        if a.startswith('Parent=transcript'):
+            i = attributes.index(a)
+            attributes[i] = a.replace('Parent=transcript:', 'Parent=')
+
+    gff_fields[8] = ";".join(attributes)
+    n = "\t".join(gff_fields)
+    return n
+
+
+def compiled_convert_ensemblgff_attributes(gff_fields):
+    return "\t".join(ensembl_rewriter.rewrite(gff_fields))
+
+
+# Rewrites all the lines with a rewriting function
+# Argv = the lines and the function
+# Returns the rewritten lines and the elapsed time
+def run(lines, convert):
+    start = time.time()
+    out = [convert(line.split('\t')) for line in lines]
+    return out, time.time() - start
+
+
+#############
+
+# Arguments and usage
+
+parser = argparse.ArgumentParser(description='A benchmark of the raw Ensembl gff3 attribute rewriting')
+parser.add_argument('-i', '--input', help='Raw Ensembl gff3 file, plain or gzipped (default=built in Ensembl 84 sample)')
+parser.add_argument('-l', '--lines', help='Number of lines read from the input file (default=200000)', type=int, default=200000)
+parser.add_argument('-n', '--repeats', help='Number of times the lines are rewritten (default=5)', type=int, default=5)
+args = vars(parser.parse_args())
+
+if args['input']:
+    with open_input(args['input']) as fin:
+        lines = [line.strip() for line in itertools.islice((l for l in fin if not l.startswith('#')), args['lines'])]
+else:
+    lines = sample * (args['lines'] // len(sample))
+
+legacy = compiled = 0.0
+for i in range(args['repeats']):
+    expected, elapsed = run(lines, legacy_convert_ensemblgff_attributes)
+    legacy += elapsed
+    result, elapsed = run(lines, compiled_convert_ensemblgff_attributes)
+    compiled += elapsed
+    if result != expected:
+        raise SystemExit("Rewritten lines differ: " + next(r for r, e in zip(result, expected) if r != e))
+
+n = len(lines) * args['repeats']
+print "lines     : %d x %d" % (len(lines), args['repeats'])
+print "former    : %.0f lines/s" % (n / legacy)
+print "compiled  : %.0f lines/s" % (n / compiled)
+print "speedup   : %.2fx" % (legacy / compiled)
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# benchmark_startup.py
+# Measures the startup time of the validannot scripts : each script is run with --help in a new python process
+# Heavy modules (numpy, pandas, matplotlib, Biopython, bioservices...) must only be imported by the code paths using them
+# The benchmark fails if a script loads one of them at startup or takes longer than the time allowed
+
+# Usage : python benchmark_startup.py -s scripts -n repeats -t seconds
+
+# Arguments :
+# -s or --scripts  = scripts separated by commas (default=all the scripts of the directory but the benchmarks)
+# -n or --repeats  = number of runs of each script, the fastest one is kept (default=3)
+# -t or --time     = startup time allowed for each script in seconds (default=0.5)
+
+# Exemple :
+# python benchmark_startup.py -s analyse_gff.py,query_ensembl_bioservices.py -t 0.3
+
+import argparse
+import glob
+import os.path
+import subprocess
+import sys
+
+
+#############
+# Functions #
+#############
+
+heavy_modules = ['numpy', 'pandas', 'matplotlib', 'pylab', 'Bio', 'bioservices', 'httplib2']
+
+# Run in the new process : the script is run until its argument parsing exits, then the time and the heavy modules loaded are printed
+startup = '''
+import sys, time
+start = time.time()
+import os, runpy
+sys.argv = [sys.argv[1], '--help']
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+out = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stdout = out
+heavy = [m for m in %r if m in sys.modules]
+print("%%f %%s" %% (time.time() - start, ','.join(heavy)))
+''' % heavy_modules
+
+
+# Runs a script with --help in a new python process
+# Argv = the script path
+# Returns the startup time in seconds and the list of the heavy modules loaded
+def run(script):
+    output = subprocess.check_output([sys.executable, '-c', startup, script]).strip().split('\n')[-1].split(' ')
+    return float(output[0]), [m for m in output[1:] if m]
+
+
+#############
+
+# Arguments and usage
+
+parser = argparse.ArgumentParser(description='A benchmark of the startup time of the validannot scripts')
+parser.add_argument('-s', '--scripts', help='Scripts separated by commas (default=all the scripts of the directory but the benchmarks)')
+parser.add_argument('-n', '--repeats', help='Number of runs of each script, the fastest one is kept (default=3)', type=int, default=3)
+parser.add_argument('-t', '--time', help='Startup time allowed for each script in seconds (default=0.5)', type=float, default=0.5)
+args = vars(parser.parse_args())
+
+here = os.path.dirname(os.path.abspath(__file__))
+if args['scripts']:
+    scripts = [os.path.join(here, s) for s in args['scripts'].split(',')]
+else:
+    scripts = sorted(s for s in glob.glob(os.path.join(here, '*.py'))
+                     if not os.path.basename(s).startswith(('validannot_', 'benchmark_')))
+
+failed = []
+for script in scripts:
+    elapsed, heavy = min(run(script) for i in range(args['repeats']))
+    name = os.path.basename(script)
+    status = "ok"
+    if heavy:
+        status = "loads " + ",".join(heavy)
+    elif elapsed > args['time']:
+        status = "too slow"
+    if status != "ok":
+        failed.append(name)
+    print "%-50s %6.3f s  %s" % (name, elapsed, status)
+
+if failed:
+    raise SystemExit("Slow startup : " + ", ".join(failed))
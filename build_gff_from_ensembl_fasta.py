@@ -12,6 +12,8 @@
 # Arguments :
 # -o or --organism    	 Ensembl organism name Ex: Mus_musculus
 # -e or --ensemblversion Ensembl version Ex: 84
+# -z or --bgzf           Write bgzf compressed fasta and gff files (.gz), the compression level can follow (1 to 9, default=6)
+# -p or --processes      Number of fasta files (cdna, ncrna) processed at the same time (default=2)
 # -v or --verbose
 
 # Exemple :
@@ -25,81 +27,122 @@ from validannot_env import gff3_path
 from validannot_env import log_path
 from validannot_env import cdna_fasta_path
 from validannot_env import ncrna_fasta_path
+from validannot_fasta import scan_fasta
+from validannot_io import append_file
+from validannot_io import BgzfWriter
+from validannot_io import find_input
+from validannot_io import open_input
+from validannot_io import open_output
 import argparse
-import subprocess
-import fileinput
 import os
 import time
 import sys
 import logging
-from Bio import SeqIO
+from multiprocessing import Pool
 
 
 #############
 # Functions #
 #############
 
-# Checks if the path and file exist
-# Argv = path and file
-# Returns a var that can be a boolean or an integer
-# If true, path and gz file exist, if false, path and gunzipped file exist, if 2, path or file do not exist
-def make_sure_file_exists(p,f):
-    if os.path.exists(p):
-        if os.path.isfile(p+"/"+f[:-3]):
-            logging.info("Found gunzipped file: "+ f[:-3] + "\n No need to gunzip...")
-            gz = False
-        elif os.path.isfile(p+"/"+f):
-            logging.info("Found gzipped file: "+ f +"...")
-            gz = True
-        else:
-            gz=2
-    else:
-            gz=2
-    return gz
-
-def merge_fasta(fasta1,fasta2,fasta_out):
-    fout = open(fasta_out, 'w')
-    for line1 in fileinput.input(fasta1):
-        fout.write(line1)
-    fileinput.close()
-    for line2 in fileinput.input(fasta2):
-        fout.write(line2)
-    fileinput.close()
+# Builds the gff line of a sequence from its Ensembl header
+# Ex: ENSMUST00000177564.1 cdna chromosome:GRCm38:14:54122226:54122241:1 gene:ENSMUSG00000096176.1 gene_biotype:TR_D_gene ...
+# Argv = the header (without >) and the sequence length
+# Returns the gff line
+def gff_line(header, length):
+    fields = header.split(' ')
+    ID = fields[0]
+    f = fields[1].split(':')
+    feature = f[0]
+    ref = fields[2].split(':')
+    source = "Ensembl_"+ref[1]
+    chromosome = "chromosome="+ref[2]
+    chr_start = "start="+ref[3]
+    chr_end = "end="+ref[4]
+    chr_str = "strand="+ref[5]
+    p = fields[3].split(':')
+    id="ID="+ID
+    parent = "Parent="+p[1]
+    start = '1'
+    end = str(length+1)
+    strand = '1'
+    score = '.'
+    phase = '.'
+    attributes=";".join([id,parent,chromosome,chr_start,chr_end,chr_str])
+    return "\t".join([ID,source,feature,start,end,strand,score,phase,attributes]) + "\n"
+
+
+# Returns the header lines of the gff file built from a fasta file
+def gff_header(fasta):
+    return ("##gff-version\t3\n" +
+            '##created by SGDB on the ' + time.strftime("%Y-%m-%d") + '\n' +
+            "##source file is " + fasta +"\n")
+
+
+# Merges fasta files, plain or gzipped, into a fasta file and builds its gff file in the same pass
+# Only the headers are parsed, the sequence lines are copied and counted by blocks
+# Argv = the fasta files, the output fasta and gff files and the bgzf compression level (None for plain files)
+def build_gff(fastas,fasta_out,gff,level=None):
+    fout = open_output(fasta_out, level)
+    gffout = open_output(gff, level)
+    gffout.write(gff_header(fasta_out))
+    for fasta in fastas:
+        with open_input(fasta) as fin:
+            for header, length in scan_fasta(fin, fout):
+                gffout.write(gff_line(header, length))
+    gffout.close()
     fout.close()
 
 
-def build_gff(fasta,gff):
-    fin = open(fasta, "rU")
-    gffout = open(gff,"w")
-    gffout.write("##gff-version\t3\n")
-    gffout.write('##created by SGDB on the ' + time.strftime("%Y-%m-%d") + '\n')
-    gffout.write("##source file is " + fasta +"\n")
-    for record in SeqIO.parse(fin, "fasta"):
-        ID = record.id
-        Desc = record.description
-        Seq=str(record.seq)
-        fields = Desc.split(' ')
-        f = fields[1].split(':')
-        feature = f[0]
-        ref = fields[2].split(':')
-        source = "Ensembl_"+ref[1]
-        chromosome = "chromosome="+ref[2]
-        chr_start = "start="+ref[3]
-        chr_end = "end="+ref[4]
-        chr_str = "strand="+ref[5]
-        p = fields[3].split(':')
-        id="ID="+ID
-        parent = "Parent="+p[1]
-        start = '1'
-        end = str(len(Seq)+1)
-        strand = '1'
-        score = '.'
-        phase = '.'
-        attributes=";".join([id,parent,chromosome,chr_start,chr_end,chr_str])
-        line = "\t".join([ID,source,feature,start,end,strand,score,phase,attributes])
-        gffout.write(line+"\n")
+# Copies a fasta file into a plain fasta part file and writes the gff lines of its sequences into a plain gff part file, run by the worker processes
+# Argv = the fasta file and the fasta and gff part files
+# Returns the part files
+def build_gff_part(fasta,fasta_part,gff_part):
+    fout = open_output(fasta_part)
+    gffout = open_output(gff_part)
+    with open_input(fasta) as fin:
+        for header, length in scan_fasta(fin, fout):
+            gffout.write(gff_line(header, length))
     gffout.close()
-    fin.close()
+    fout.close()
+    return fasta_part, gff_part
+
+
+# Copies a plain part file at the end of an output file
+# Argv = the output file (open_output) and the part file
+def append_part(out, path):
+    if not isinstance(out, BgzfWriter):
+        append_file(out, path)
+        return
+    # The part is compressed with the rest of the file, the blocks are the same as those written by build_gff
+    with open(path, 'rb') as fin:
+        for data in iter(lambda: fin.read(1 << 20), ''):
+            out.write(data)
+
+
+# Builds the same files as build_gff on a pool of processes, each fasta file being processed by its own process
+# The parts are written plain and joined in the order of the fasta files, bgzf files are compressed once when the parts are joined
+# Argv = the fasta files, the output fasta and gff files, the bgzf compression level and the number of processes
+def build_gff_parallel(fastas,fasta_out,gff,level,processes):
+    logging.info("Processing " + ','.join(fastas) + " on " + str(processes) + " processes")
+    pool = Pool(processes)
+    try:
+        parts = [pool.apply_async(build_gff_part, (fasta, fasta_out + '.part.' + str(i), gff + '.part.' + str(i)))
+                 for i, fasta in enumerate(fastas)]
+        fout = open_output(fasta_out, level)
+        gffout = open_output(gff, level)
+        gffout.write(gff_header(fasta_out))
+        for part in parts:
+            fasta_part, gff_part = part.get()
+            append_part(fout, fasta_part)
+            append_part(gffout, gff_part)
+            os.remove(fasta_part)
+            os.remove(gff_part)
+        gffout.close()
+        fout.close()
+    finally:
+        pool.close()
+        pool.join()
 
 #############
 # Arguments and usage
@@ -107,61 +150,41 @@ def build_gff(fasta,gff):
 parser = argparse.ArgumentParser(description='A script to build an annotation file describing rna (cdna and ncrna from Ensembl) from Ensembl fasta files.')
 parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus_musculus)', required=True)
 parser.add_argument('-e', '--ensemblversion', help='Ensembl version Ex: 84', required=True)
+parser.add_argument('-z', '--bgzf', help='Write the output as a bgzf file (.gz), with an optional compression level from 1 fastest to 9 smallest (default=6)', type=int, nargs='?', const=6)
+parser.add_argument('-p', '--processes', help='Number of fasta files (cdna, ncrna) processed at the same time (default=2)', type=int, default=2)
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
 
 organism = args['organism']
 version = args['ensemblversion']
+level = args['bgzf']
+processes = args['processes']
 if args['verbose']:
     logging.basicConfig(filename=log_path+'build_ensembl_cdna_ncrna_gff_from_fasta.log',level=logging.INFO,format='%(asctime)s %(message)s')
 
 
-cdna_fasta_in = organism + "_ens" + version + "_cdna.fa.gz"
-# Check if cdna_fasta coming in exists
-isgz_cdna_fasta = make_sure_file_exists(cdna_fasta_path,cdna_fasta_in)
-# gunzip or not cdna_fasta
-if type(isgz_cdna_fasta) is int:
-    logging.info(os.strerror(isgz_cdna_fasta))
+# Check if cdna_fasta and ncrna_fasta coming in exist, gzipped files are read as they are
+cdna_fasta_in = find_input(cdna_fasta_path, organism + "_ens" + version + "_cdna.fa.gz")
+if cdna_fasta_in is None:
     sys.exit(1)
-else:
-    if not isgz_cdna_fasta:
-        cdna_fasta_in = cdna_fasta_in[:-3]
-        cdna_gff_out = cdna_fasta_in[:-6]+"_sgdb.gff"
-    else:
-        inF = cdna_fasta_path + cdna_fasta_in
-        proc = subprocess.Popen(["gunzip", cdna_fasta_path + cdna_fasta_in], stderr=subprocess.PIPE)
-        for line in proc.stderr:
-            logging.info(line)
-            cdna_fasta_in = cdna_fasta_in[:-3]
-            cdna_gff_out = cdna_fasta_in[:-6]+"_sgdb.gff"
-
-
-ncrna_fasta_in = organism + "_ens" + version + "_ncrna.fa.gz"
-# Check if ncrna_fasta coming in exists
-isgz_ncrna_fasta = make_sure_file_exists(ncrna_fasta_path,ncrna_fasta_in)
-# gunzip or not ncrna_fasta
-if type(isgz_ncrna_fasta) is int:
-    logging.info(os.strerror(isgz_ncrna_fasta))
+
+ncrna_fasta_in = find_input(ncrna_fasta_path, organism + "_ens" + version + "_ncrna.fa.gz")
+if ncrna_fasta_in is None:
     sys.exit(1)
-else:
-    if not isgz_ncrna_fasta:
-        ncrna_fasta_in = ncrna_fasta_in[:-3]
-        ncrna_gff_out = ncrna_fasta_in[:-6] + "_sgdb.gff"
-    else:
-        inF = ncrna_fasta_path + ncrna_fasta_in
-        proc = subprocess.Popen(["gunzip", ncrna_fasta_path + ncrna_fasta_in], stderr=subprocess.PIPE)
-        for line in proc.stderr:
-            logging.info(line)
-            ncrna_fasta_in = ncrna_fasta_in[:-3]
-            ncrna_gff_out = ncrna_fasta_in[:-6] + "_sgdb.gff"
 
 # merge cdna and ncrna fasta files in a single file saved in the same directory than cdna fasta files
 cdna_ncrna_fasta = cdna_fasta_path + organism + "_ens" + version + "_cdna_ncrna.fa"
 cdna_ncrna_gff = gff3_path + organism + "_ens" + version + "_cdna_ncrna.gff"
-merge_fasta(cdna_fasta_path+cdna_fasta_in, ncrna_fasta_path+ncrna_fasta_in,cdna_ncrna_fasta)
+if level is not None:
+    cdna_ncrna_fasta += ".gz"
+    cdna_ncrna_gff += ".gz"
+# and build its gff file in the gff3 directory, in the same pass
+# cdna and ncrna files are processed at the same time by two processes, the result is the same
+if processes > 1:
+    build_gff_parallel((cdna_fasta_in, ncrna_fasta_in), cdna_ncrna_fasta, cdna_ncrna_gff, level, min(processes, 2))
+else:
+    build_gff((cdna_fasta_in, ncrna_fasta_in), cdna_ncrna_fasta, cdna_ncrna_gff, level)
 logging.info("New fasta file "+cdna_ncrna_fasta+" written.")
-# build gff file from merged fasta file and save it in the gff3 directory
-build_gff(cdna_ncrna_fasta,cdna_ncrna_gff)
 logging.info("New gff file "+cdna_ncrna_gff+" written.")
 
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+# extract_fasta_regions.py
+# Extracts regions (gene bodies, flanks, CDS...) from a fasta file with its .fai index, as samtools faidx does
+# Only the bytes of the regions are read, the regions being read in the file order
+
+# Usage : python extract_fasta_regions.py -i fasta_file -r regions -b bed_file -w width -O output_file -v
+
+# Arguments :
+# -i or --input    = fasta file in the dna fasta directory, plain or bgzf (Ex: only_chr_Mus_musculus_ens84.fa)
+# -r or --regions  = regions separated by commas, chr, chr:start or chr:start-end, 1-based positions, end included
+# -b or --bed      = bed file of regions (chr, 0-based start, end, optional name)
+# -w or --width    = length of the sequence lines written (default=60)
+# -O or --output   = output fasta file (default=standard output)
+# -v or --verbose
+
+# Exemple :
+# python extract_fasta_regions.py -i only_chr_Mus_musculus_ens84.fa -r 1:3205901-3671498,MT -v
+# python extract_fasta_regions.py -i only_chr_Mus_musculus_ens84.fa.gz -b cds.bed -O cds.fa
+
+from validannot_env import dna_fasta_path
+from validannot_env import log_path
+from validannot_fasta import FastaIndex
+from validannot_fasta import parse_region
+import argparse
+import logging
+import sys
+
+
+#############
+# Functions #
+#############
+
+# Reads the regions of a bed file
+# Argv = the bed file
+# Returns a list of (name, start, end) 1-based, end included, and the list of their names (None without name column)
+def read_bed(bed):
+    regions = []
+    names = []
+    with open(bed) as fin:
+        for line in fin:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            bed_fields = line.rstrip('\n').split('\t')
+            regions.append((bed_fields[0], int(bed_fields[1]) + 1, int(bed_fields[2])))
+            names.append(bed_fields[3] if len(bed_fields) > 3 else None)
+    return regions, names
+
+
+# Name of a region in the fasta headers, as samtools faidx writes it
+def region_name(region):
+    name, start, end = region
+    if start is None and end is None:
+        return name
+    return name + ":" + str(start or 1) + ("-" + str(end) if end is not None else "")
+
+
+#############
+
+# Arguments and usage
+parser = argparse.ArgumentParser(description='A script to extract regions from an indexed fasta file.')
+parser.add_argument('-i', '--input', help='Fasta file in the dna fasta directory, plain or bgzf (Ex: only_chr_Mus_musculus_ens84.fa)', required=True)
+parser.add_argument('-r', '--regions', help='Regions separated by commas, chr, chr:start or chr:start-end (1-based, end included)')
+parser.add_argument('-b', '--bed', help='Bed file of regions (chr, 0-based start, end, optional name)')
+parser.add_argument('-w', '--width', help='Length of the sequence lines written (default=60)', type=int, default=60)
+parser.add_argument('-O', '--output', help='Output fasta file (default=standard output)')
+parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
+args = vars(parser.parse_args())
+
+width = args['width']
+if args['verbose']:
+    logging.basicConfig(filename=log_path + 'extract_fasta_regions.log', level=logging.INFO, format='%(asctime)s %(message)s')
+
+regions = []
+names = []
+if args['regions']:
+    for r in args['regions'].split(','):
+        regions.append(parse_region(r))
+        names.append(None)
+if args['bed']:
+    bed_regions, bed_names = read_bed(args['bed'])
+    regions += bed_regions
+    names += bed_names
+if not regions:
+    parser.error("no region given (-r or -b)")
+
+logging.info("Extracting " + str(len(regions)) + " regions from " + dna_fasta_path + args['input'])
+fout = open(args['output'], 'w') if args['output'] else sys.stdout
+# A fasta file which can not be indexed (gzipped without .fai, lines of different lengths) ends the script as a bad region does
+try:
+    with FastaIndex(dna_fasta_path + args['input']) as fasta:
+        bases = fasta.fetch_regions(regions)
+except ValueError as e:
+    logging.info(str(e))
+    sys.exit(str(e))
+for region, name, seq in zip(regions, names, bases):
+    fout.write(">" + (name or region_name(region)) + "\n")
+    for i in range(0, len(seq), width):
+        fout.write(seq[i:i + width] + "\n")
+if fout is not sys.stdout:
+    fout.close()
+logging.info("Regions extracted.")
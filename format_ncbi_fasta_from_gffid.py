@@ -19,16 +19,19 @@
 from validannot_env import gff3_path
 from validannot_env import log_path
 from validannot_env import dna_fasta_path
+from validannot_fasta import chrom_sizes_path
+from validannot_fasta import fasta_name
+from validannot_fasta import filter_fasta
+from validannot_gff import gff_seqid
+from validannot_gff import read_gff
+from validannot_io import open_input
 import argparse
 import os
 import os.path
 from os.path import basename
-import gzip
 import time
 import logging
-import fileinput
 import sys
-from Bio import SeqIO
 
 
 #############
@@ -53,24 +56,12 @@ def make_sure_files_exist(fasta, gff):
 # Returns a chromosome list
 def get_chromosome_from_ncbigff(gff):
     wanted = []
-    if gff.endswith(".gz"):
-        gffin = gzip.open(gff, "rU")
-    else:
-        gffin = open(gff, "rU")
-    for line in gffin:
-            if line.startswith('#'):
-                continue
-            gff_fields = line.strip().split('\t')
-            attributes = gff_fields[8].split(';')
-            if gff_fields[2] == 'region':
-                attributes = gff_fields[8].split(';')
-                for a in attributes:
-                    if a.startswith("chromosome=") and a != "chromosome=Unknown" and gff_fields[0] not in wanted:
-                        wanted.append(gff_fields[0])
-                    elif a.startswith("chromosome=") and a != "chromosome=Unknown" and gff_fields[0] in wanted:
-                        continue
-                    else:
-                        continue
+    gffin = open_input(gff)
+    # Only the regions are read, only their attributes are parsed
+    for record in read_gff(gffin, ('region',)):
+        chromosome = record.attribute('chromosome')
+        if chromosome is not None and chromosome != "Unknown" and record.seqid not in wanted:
+            wanted.append(record.seqid)
     logging.info("chromosome list from " + basename(gff) + " : " + ','.join(wanted))
     gffin.close()
     return wanted
@@ -82,10 +73,9 @@ def build_newgff(gff,wanted):
     # Format output name
     if gff.endswith(".gz"):
         gff_out = gff3_path + "only_chr_" + gff[:-3]  # Output gff file
-        gff_in = gzip.open(gff3_path + gff, "rU")
     else:
         gff_out = gff3_path + "only_chr_" + gff  # Output gff file
-        gff_in = open(gff3_path + gff, "rU")
+    gff_in = open_input(gff3_path + gff)
 
     # Sort and write new GFF
     logging.info("writing new gff3 file....")
@@ -94,8 +84,7 @@ def build_newgff(gff,wanted):
 
     for line in gff_in:
         if not line.startswith('#'):
-            gff_fields = line.strip().split('\t')
-            if gff_fields[0] in wanted:
+            if gff_seqid(line) in wanted:
                 gffout.write(line)
         elif line.startswith('##gff-version'):
             gffout.write(line)
@@ -113,9 +102,24 @@ def build_newgff(gff,wanted):
         else:
             gffout.write(line)
     gffout.close()
-    fileinput.close()
+    gff_in.close()
     return gff_out
 
+# Keeps the sequences of the chromosome list, named by their ref id (gi|...|ref|NC_xxxxxx.x|)
+# The new header is the ref id followed by the former header
+# Argv = the header line (without > and line end)
+# Returns the new header, None if the sequence is not kept
+def select_ref(header):
+    fasta_id = fasta_name(header)
+    ref = fasta_id.split('|')[3]
+    if ref in wanted:
+        logging.info(fasta_id+"=>"+ref)
+        wanted.remove(ref)
+        if ref == fasta_id:
+            return header
+        return ref + " " + header
+    return None
+
 
 #############
 
@@ -144,25 +148,17 @@ gff_out = build_newgff(gff_in,wanted)
 logging.info(gff_out+" : New gff3 file written.")
 
 # Sort and write new fasta
-# Open the input fasta file differently if it's a gz or not
+# Output name following the input fasta file being a gz or not
 if fasta_in.endswith(".gz"):
     fasta_out = dna_fasta_path + "only_chr_sgdb_" + fasta_in[:-3] # Output fasta file
-    fastain = gzip.open(dna_fasta_path+fasta_in,"rU")
 else:
     fasta_out = dna_fasta_path + "only_chr_sgdb_" + fasta_in  # Output fasta file
-    fastain = open(dna_fasta_path+fasta_in, "rU")
+fastain = open_input(dna_fasta_path+fasta_in)
 
 fout = open(fasta_out, "w")
-# Parse the fasta file to get the ref id and check if it's in the wanted list, following the gff
-for record in SeqIO.parse(fastain, "fasta") :
-    fasta_id = record.id
-    fasta_id = fasta_id.split('|')
-    ref = fasta_id[3]
-    if ref in wanted:
-        logging.info(record.id+"=>"+ref)
-        record.id = ref
-        SeqIO.write(record, fout, "fasta")
-        wanted.remove(record.id)
+# Get the ref id of each sequence and check if it's in the wanted list, following the gff
+# Sequence lines are copied as they are, the .fai index and chrom.sizes files are written in the same pass
+filter_fasta(fastain, fout, select_ref, fasta_out + ".fai", chrom_sizes_path(fasta_out))
 if wanted:
     logging.info("Missing chromosomes in new fasta file: "+','.join(wanted))
 else:
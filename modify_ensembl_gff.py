@@ -13,22 +13,45 @@
 # -o or --organism    	 Ensembl organism name Ex: Mus_musculus
 # -e or --ensemblversion Ensembl version Ex: 84
 # -c or --chronly        Chromosome only : y
+# -s or --stream         Download the raw gff3 file and format it during the transfer (no local gff.gz file)
+# -t or --type           Type of organism for the stream mode : plants, fungi, metazoa, bacteria, protists, generic
+# -z or --bgzf           Write a bgzf compressed gff3 file (.gz), the compression level can follow (1 to 9, default=6)
+# -p or --processes      Number of processes formatting parts of a gunzipped gff3 file at the same time (default=1)
 # -v or --verbose
 
 # Exemple :
 # python modify_ensembl_gff.py -o Mus_musculus -e 84 -c y -v
+# python modify_ensembl_gff.py -o Mus_musculus -e 84 -c y -s -v
+# python modify_ensembl_gff.py -o Mus_musculus -e 84 -c y -z 4 -v
+# python modify_ensembl_gff.py -o Triticum_aestivum -e 31 -c y -p 32 -v
 
 from validannot_env import gff3_path
 from validannot_env import log_path
+from validannot_ftp import ftp_connect
+from validannot_ftp import ensembl_host
+from validannot_ftp import ftp_releasedir
+from validannot_ftp import stream_gzip_lines
+from validannot_gff import ensembl_rewriter
+from validannot_gff import gff_chromosomes
+from validannot_gff import gff_index
+from validannot_gff import gff_seqid
+from validannot_io import find_input
+from validannot_io import open_input
+from validannot_io import open_output
+from validannot_io import is_gzip
+from validannot_io import line_ranges
+from validannot_io import read_range
+from validannot_io import append_file
 import sys
 import argparse
-import subprocess
 import os
 import os.path
+import posixpath
 import fnmatch
-import fileinput
 import time
 import logging
+from ftplib import all_errors, error_perm
+from multiprocessing import Pool
 
 
 #############
@@ -44,69 +67,113 @@ def find(pattern, path):
                 result.append(os.path.join(root, name))
             return result
 
-# Checks if the path and file exist
-# Argv = path and file
-# Returns a var that can be a boolean or an integer
-# If true, path and gz file exist, if false, path and gunzipped file exist, if 2, path or file do not exist
-def make_sure_file_exists(p,f):
-        if os.path.exists(p):
-            if os.path.isfile(p+"/"+f[:-3]):
-                logging.info("Found gunzipped file: "+ f[:-3] + "\n No need to gunzip...")
-                gz = False
-            elif os.path.isfile(p+"/"+f):
-                logging.info("Found gzipped file: "+ f +"...")
-                gz = True
-            else:
-                gz=2
+
+# Rewrites the type and the attributes of a raw Ensembl feature following the validannot_gff rules
+# Argv = the 9 gff fields
+# Returns the new gff line without line end
+def convert_ensemblgff_attributes(gff_fields):
+    return "\t".join(ensembl_rewriter.rewrite(gff_fields))
+
+
+# Formats a line of a raw Ensembl gff3 file
+# Argv = the line, chromosome only (y or n) and the chromosome list
+# Returns the text to write in the new gff3 file, empty if the line is not kept
+def format_gff_line(line, chronly, wanted):
+    if not line.startswith('#'):
+        # Lines of other seqids are dropped without splitting them
+        if chronly != 'y' or gff_seqid(line) in wanted:
+            return convert_ensemblgff_attributes(line.strip().split('\t')) + "\n"
+    elif line.startswith('##gff-version'):
+        header = line + '##modified by SGDB on the ' + time.strftime("%Y-%m-%d") + '\n'
+        if chronly == 'y':
+            header += '##regular chromosome only gff file\n'
+        return header
+    elif line.startswith('##sequence-region'):
+        if chronly == 'y':
+                header_fields = line.strip().split(' ')
+                header_fields = filter(None, header_fields)
+                if header_fields[1] in wanted:
+                  return line
         else:
-            gz=2
-        return gz
+            return line
+    return ''
 
 
-# Gets the chromosomes names in the gff3 file
-# Argv = the gff file
-# Returns a chromosome list
-def get_chromosome_from_ensemblgff(gff_in):
+# Formats a raw Ensembl gff3 stream keeping chromosomes only, in a single pass
+# The chromosome list is unknown at the beginning of the stream : a seqid is kept once its chromosome line is read
+# Ensembl writes this line at the beginning of each seqid block, lines of a block read before it are held until then
+# The ##sequence-region line of a kept seqid is written just before its first feature
+# Argv = the lines and the output file handle
+# Returns the chromosome list
+def format_gff_stream_chronly(lines, gffout):
     wanted = []
-    for line in fileinput.input(gff_in):
-            if line.startswith('#'):
-                continue
-            gff_fields = line.strip().split('\t')
-            if gff_fields[2] == 'chromosome' and not '_' in gff_fields[0]:
-                wanted.append(gff_fields[0])
-    logging.info("chromosome list for "+gff_in+" : "+','.join(wanted))
+    regions = {}
+    pending = []
+    current = None
+    for line in lines:
+        if line.startswith('##sequence-region'):
+            header_fields = filter(None, line.strip().split(' '))
+            regions[header_fields[1]] = line
+            continue
+        elif line.startswith('#'):
+            gffout.write(format_gff_line(line, 'y', wanted))
+            continue
+        gff_fields = line.split('\t', 3)
+        if gff_fields[0] != current:
+            # The previous block is not a chromosome
+            pending = []
+            current = gff_fields[0]
+        if gff_fields[2] == 'chromosome' and not '_' in gff_fields[0] and gff_fields[0] not in wanted:
+            wanted.append(gff_fields[0])
+            if gff_fields[0] in regions:
+                gffout.write(regions.pop(gff_fields[0]))
+            for p in pending:
+                gffout.write(format_gff_line(p, 'y', wanted))
+            pending = []
+        if gff_fields[0] in wanted:
+            gffout.write(format_gff_line(line, 'y', wanted))
+        else:
+            pending.append(line)
+    logging.info("chromosome list from stream : " + ','.join(wanted))
     return wanted
 
-def convert_ensemblgff_attributes(gff_fields):
 
-    attributes = gff_fields[8].split(';')
-    for a in attributes:
-        if a.startswith('ID=gene:') and gff_fields[2].endswith('_gene'):
-            gff_fields[2] = 'gene'
-        if a.startswith('ID=gene:') and gff_fields[2] == 'RNA':
-            gff_fields[2] = 'gene'
-        if a.startswith('ID=chromosome:'):
-            i = attributes.index(a)
-            attributes[i] = a.replace('ID=chromosome:', 'ID=')
-        if a.startswith('ID=gene:'):
-            i = attributes.index(a)
-            attributes[i] = a.replace('ID=gene:', 'ID=')
-        if a.startswith('ID=transcript:'):
-            i = attributes.index(a)
-            attributes[i] = a.replace('ID=transcript:', 'ID=')
-        if a.startswith('ID=CDS:'):
-            i = attributes.index(a)
-            attributes[i] = a.replace('ID=CDS:', 'ID=')
-        if a.startswith('Parent=gene:'):
-            i = attributes.index(a)
-            attributes[i] = a.replace('Parent=gene:', 'Parent=')
-        if a.startswith('Parent=transcript'):
-            i = attributes.index(a)
-            attributes[i] = a.replace('Parent=transcript:', 'Parent=')
-
-    gff_fields[8] = ";".join(attributes)
-    n = "\t".join(gff_fields)
-    return n
+# Formats a byte range of a raw Ensembl gff3 file into a part file, run by the worker processes
+# Lines are formatted one by one, the parts joined in order are the same as the whole file formatted at once
+# Argv = the gunzipped gff file, the range start and end, chromosome only (y or n), the chromosome list, the part file and the bgzf level
+# Returns the part file
+def format_gff_range(gff_in, start, end, chronly, wanted, part, level):
+    out = open_output(part, level, threads=1)
+    for line in read_range(gff_in, start, end):
+        out.write(format_gff_line(line, chronly, wanted))
+    out.close()
+    return part
+
+
+# Formats a raw Ensembl gff3 file on a pool of processes, each one formatting a part of the file
+# The chromosome list comes from the sidecar index, built the same way if needed, then the parts are joined in the file order
+# bgzf parts are joined as they are, a bgzf file being a series of gzip members
+# Argv = the gunzipped gff file, chromosome only (y or n), the output file, the bgzf level and the number of processes
+# Returns the chromosome list
+def format_gff_parallel(gff_in, chronly, gff_out, level, processes):
+    ranges = line_ranges(gff_in, processes)
+    logging.info("Formatting " + gff_in + " as " + str(len(ranges)) + " parts on " + str(processes) + " processes")
+    pool = Pool(processes)
+    try:
+        wanted = []
+        if chronly == 'y':
+            wanted = [c.encode('utf-8') for c in gff_index(gff_in, pool, processes)['chromosomes']]
+            logging.info("chromosome list for "+gff_in+" : "+','.join(wanted))
+        parts = [pool.apply_async(format_gff_range, (gff_in, start, end, chronly, wanted, gff_out + '.part.' + str(i), level))
+                 for i, (start, end) in enumerate(ranges)]
+        with open(gff_out, 'wb') as out:
+            for part in parts:
+                append_file(out, part.get())
+                os.remove(part.get())
+    finally:
+        pool.close()
+        pool.join()
+    return wanted
 
 
 #############
@@ -116,14 +183,21 @@ parser = argparse.ArgumentParser(description='A script to format Ensembl a raw g
 parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus_musculus)', required=True)
 parser.add_argument('-e', '--ensemblversion', help='Ensembl version Ex: 84', required=True)
 parser.add_argument('-c', '--chronly', help='Chromosome only', default='y')
+parser.add_argument('-s', '--stream', help='Download the raw gff3 file from Ensembl and format it during the transfer, without intermediate file', action='store_true')
+parser.add_argument('-t', '--type', help='Type of organism for the stream mode (plants, fungi, metazoa, bacteria, protists, generic)', default='generic')
+parser.add_argument('-z', '--bgzf', help='Write the output as a bgzf file (.gz), with an optional compression level from 1 fastest to 9 smallest (default=6)', type=int, nargs='?', const=6)
+parser.add_argument('-p', '--processes', help='Number of processes formatting parts of a gunzipped gff3 file at the same time (default=1)', type=int, default=1)
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
 organism = args['organism']
 version = args['ensemblversion']
 chronly= args['chronly']
-if chronly == 'y':
-    wanted = []
+stream = args['stream']
+organism_type = args['type']
+level = args['bgzf']
+processes = args['processes']
+wanted = []
 if args['verbose']:
     logging.basicConfig(filename=log_path +'modify_ensembl_gff.log',level=logging.INFO,format='%(asctime)s %(message)s')
 
@@ -131,20 +205,17 @@ gfffile_in = organism + "_ens" + version + ".gff.gz"
 logging.info(gfffile_in )
 
 
-isgz = make_sure_file_exists(gff3_path,gfffile_in)
-# gunzip or not
-if type(isgz) is int:
-    logging.info(os.strerror(isgz))
-    sys.exit(1)
-else:
-    if not isgz:
-        gfffile_in = gfffile_in[:-3]
-    else :
-        inF = gff3_path + gfffile_in
-        proc = subprocess.Popen(["gunzip", gff3_path + gfffile_in],stderr = subprocess.PIPE)
-        for line in proc.stderr:
-            logging.info(line)
-        gfffile_in = gfffile_in[:-3]
+if not stream:
+    # Nothing is read from or written to the gff3 directory but the new gff3 file in stream mode
+    # The gzipped file is read as it is, never gunzipped on disk
+    gff_path_in = find_input(gff3_path,gfffile_in)
+    if gff_path_in is None:
+        sys.exit(1)
+    if processes > 1 and is_gzip(gff_path_in):
+        # A gzip file can only be read from its beginning
+        logging.info(gff_path_in + " is gzipped, formatted by a single process")
+        processes = 1
+gfffile_in = gfffile_in[:-3]
 
 
 # format gff to build a new gff and retrieve chr if necessary
@@ -152,45 +223,66 @@ gfffile_out = gfffile_in[:-4]
 if chronly == 'y':
     gfffile_out = "only_chr_"+gfffile_out + '_sgdb.gff'
     # GFF analysis
-    wanted = get_chromosome_from_ensemblgff(gff3_path + gfffile_in)
+    if not stream and processes == 1:
+        wanted = gff_chromosomes(gff_path_in)
     logging.info("Analysing raw Ensembl gff3 file and writing new only chromosome Ensembl sgdb gff3 file....")
 else:
     gfffile_out = gfffile_out + '_sgdb.gff'
     logging.info("Analysing raw Ensembl gff3 file and writing new Ensembl sgdb gff3 file....")
 
-gffout = open(gff3_path + gfffile_out, 'w')
+if level is not None:
+    gfffile_out += '.gz'
 
 
-for line in fileinput.input(gff3_path + gfffile_in):
-    if not line.startswith('#'):
-        gff_fields = line.strip().split('\t')
+if stream:
+    # The raw gff3 file is decompressed and formatted while it is downloaded
+    # It is written to a .part file renamed once the transfer is over : a broken transfer leaves no truncated gff3 file
+    ftp = ftp_connect(ensembl_host(organism_type))
+    gffout = None
+    lines = None
+    try:
+        ftpdir = posixpath.join(ftp_releasedir(organism_type, version), 'gff3', organism.lower())
+        try:
+            ftp.cwd(ftpdir)
+            remotes = [f for f in ftp.nlst() if f.endswith(version + ".gff3.gz")]
+        except error_perm:
+            remotes = []
+        if not remotes:
+            logging.info("No *" + version + ".gff3.gz file in " + ftpdir)
+            parser.error("no *" + version + ".gff3.gz file in " + ftpdir + " (" + ensembl_host(organism_type) + ")")
+        logging.info("Streaming " + ftpdir + "/" + remotes[0])
+        gffout = open_output(gff3_path + gfffile_out + '.part', level)
+        lines = stream_gzip_lines(ftp, remotes[0])
         if chronly == 'y':
-            if gff_fields[0] in wanted:
-                newline = convert_ensemblgff_attributes(gff_fields)
-                gffout.write(newline + "\n")
-            elif gff_fields[0] not in wanted:
-                pass
+            wanted = format_gff_stream_chronly(lines, gffout)
         else:
-            newline = convert_ensemblgff_attributes(gff_fields)
-            gffout.write(newline + "\n")
-    elif line.startswith('##gff-version'):
-        gffout.write(line)
-        gffout.write('##modified by SGDB on the ' + time.strftime("%Y-%m-%d") + '\n')
-        if chronly == 'y':
-            gffout.write('##regular chromosome only gff file\n')
-    elif line.startswith('##sequence-region'):
-        if chronly == 'y':
-                header_fields = line.strip().split(' ')
-                header_fields = filter(None, header_fields)
-                if header_fields[1] in wanted:
-                  gffout.write(line)
-        else:
-            gffout.write(line)
+            for line in lines:
+                gffout.write(format_gff_line(line, chronly, wanted))
+        gffout.close()
+        gffout = None
+        os.rename(gff3_path + gfffile_out + '.part', gff3_path + gfffile_out)
+    finally:
+        # The transfer is stopped before the session is quit
+        if lines is not None:
+            lines.close()
+        if gffout is not None:
+            gffout.close()
+            os.remove(gff3_path + gfffile_out + '.part')
+        try:
+            ftp.quit()
+        except all_errors:
+            ftp.close()
+elif processes > 1:
+    wanted = format_gff_parallel(gff_path_in, chronly, gff3_path + gfffile_out, level, processes)
+else:
+    gffout = open_output(gff3_path + gfffile_out, level)
+    with open_input(gff_path_in) as fin:
+        for line in fin:
+            gffout.write(format_gff_line(line, chronly, wanted))
+    gffout.close()
 
 
-fileinput.close()
-gffout.close()
 if chronly == 'y':
     logging.info("Only chromosome Ensembl_sgdb gff3 file written.")
 else:
-    logging.info("Ensembl_sgdb gff3 file written.")
\ No newline at end of file
+    logging.info("Ensembl_sgdb gff3 file written.")
@@ -6,16 +6,24 @@
 # Genomicpariscentre
 
 # docker run -t -i -v /.../Scripts/ValidAnnot/Scripts:/scripts -v /..../validation_genomeannot/biomart/:/biomart -v /..../validation_genomeannot/log/:/log --rm genomicpariscentre/bioservices bash
-# Usage : python /scripts/query_ensembl_bioservices.py -o organism_ensembl_name -e ensemblversion -f filenb
+# Usage : python /scripts/query_ensembl_bioservices.py -o organism_ensembl_name -e ensemblversion -f filenb -j connections -s shards -r retries -c cache_dir -n -R
 
 # Arguments :
 # -o or --organism         = Bos_taurus, Mus_musculus, Homo_sapiens
 # -e or --ensemblversion   = 83
 # -f or --filenb           = 2 for genes and transcripts separated, 1 means together
+# -j or --connections      = maximum number of BioMart queries running at the same time (default=4)
+# -s or --shards           = number of chromosome groups each query is split in (default=4 x connections)
+# -r or --retries          = number of new tries of a failed query, after 5s, 10s, 20s... (default=3)
+# -c or --cache            = cache directory of the BioMart answers (default=/biomart/cache/, kept in the mounted biomart directory)
+# -n or --nocache          = do not use the cache of BioMart answers
+# -R or --replay           = answer from the cache only, without network
 # -v or --verbose
 
 # Exemple :
 # python query_ensembl_bioservices.py -o Bos_taurus -e 83 -f 1 -v
+# python query_ensembl_bioservices.py -o Homo_sapiens -e 84 -f 2 -j 6 -r 5 -v
+# python query_ensembl_bioservices.py -o Bos_taurus -e 83 -f 1 -c /cache -R
 
 # Results :
 # 2 files if file_number_for_gene_and_transcript = 2   btaurus_ens83_transcriptid.tsv and btaurus_ens83_geneid.tsv
@@ -25,10 +33,17 @@
 # Issue about scerevisiae gene ids are mostly the same as transcrit ids (nearly no intron), building 2 files is probably better 
 
 
-import os
+from validannot_biomart import CachedBioMart
+from validannot_biomart import cached
+from validannot_biomart import chromosome_counts
+from validannot_biomart import chromosome_shards
+from validannot_biomart import merge_shards
+from validannot_biomart import set_query_option
+from validannot_biomart import sharded_queries
+from validannot_cache import ArtifactCache
+from validannot_env import cache_max_age
+from validannot_env import cache_max_size
 import argparse
-import httplib2
-from bioservices import *
 import logging
 
 
@@ -38,6 +53,7 @@ import logging
 
 # Get the redirected url of an Ensembl version (The real url is referenced by date and not by version number)
 def verified_url(version):
+    import httplib2
     initial_url = "e" + version + ".ensembl.org"
     h = httplib2.Http()
     h.follow_redirects = False
@@ -54,14 +70,11 @@ def verified_url(version):
     return url
 
 
-# Replace the header line of the biomart query in case transcript and gene annotations are mixed in the same file, to suit both
-def replace_header(src_filename, target_filename, replacement_line):
-    f = open(src_filename)
-    first_line, remainder = f.readline(), f.read()
-    t = open(target_filename, "w")
-    t.write(replacement_line)
-    t.write(remainder)
-    t.close()
+# Opens a bioservices BioMart session, only when an answer is not in the cache
+# bioservices takes seconds to import, --help, argument errors and the replay mode do not load it
+def biomart_connexion(url):
+    from bioservices import BioMart
+    return BioMart(verbose=False, host=url)
 
 
 def format_organism_name(organism):
@@ -78,6 +91,12 @@ parser.add_argument('-e', '--ensemblversion', help='Ensembl version (Ex:84)', re
 parser.add_argument('-f', '--filenb',
                     help='1 if gene and transcript annotations in the same file, 2 if annotations in separated files',
                     default='1')
+parser.add_argument('-j', '--connections', help='Maximum number of BioMart queries running at the same time (default=4)', type=int, default=4)
+parser.add_argument('-s', '--shards', help='Number of chromosome groups each query is split in (default=4 x connections)', type=int)
+parser.add_argument('-r', '--retries', help='Number of new tries of a failed query, after 5s, 10s, 20s... (default=3)', type=int, default=3)
+parser.add_argument('-c', '--cache', help='Cache directory of the BioMart answers (default=/biomart/cache/, kept in the mounted biomart directory)', default='/biomart/cache/')
+parser.add_argument('-n', '--nocache', help='Do not use the cache of BioMart answers', action='store_true')
+parser.add_argument('-R', '--replay', help='Answer from the cache only, without network', action='store_true')
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
@@ -87,6 +106,17 @@ if args['verbose']:
 ensembl_organism = args['organism']
 version = args['ensemblversion']
 filenb = args['filenb']
+connections = args['connections']
+shards = args['shards'] or 4 * connections
+retries = args['retries']
+replay = args['replay']
+if replay and args['nocache']:
+    parser.error("the replay mode (-R) needs the cache")
+# In the container, the cache is kept in the mounted biomart directory : the answers are still there at the next run
+if args['nocache']:
+    cache = None
+else:
+    cache = ArtifactCache(args['cache'], cache_max_size, cache_max_age)
 
 
 
@@ -98,11 +128,11 @@ organism=format_organism_name(ensembl_organism)
 if organism == "scerevisiae" and filenb == "1":
     logging.info("scerevisiae gene ids are mostly the same as transcrit ids (nearly no intron).\nBuilding distinct files for gene annotations and transcript annotations is probably better.\n")
 
-url = verified_url(version)
+# The redirection, the attribute lists and the answers of a release do not change, they are kept in the cache
+url = cached(cache, ('biomart', version, 'url', "e" + version + ".ensembl.org"), lambda: verified_url(version), replay)
 logging.info("url="+url+"\n")
 print url
-s = BioMart(verbose=False, host=url)
-s.datasets("ENSEMBL_MART_ENSEMBL")
+s = CachedBioMart(lambda: biomart_connexion(url), version, cache, replay)
 
 # Retrieve transcript linked annotations
 s.new_query()
@@ -146,25 +176,9 @@ s.add_attribute_to_xml("transcription_start_site")
 s.add_attribute_to_xml("transcript_length")
 s.add_attribute_to_xml("ensembl_gene_id")
 
-xmlq = s.get_xml()
-xmlq = xmlq.replace("header = \"0\"", "header = \"1\"")
-xmlq = xmlq.replace("uniqueRows = \"0\"", "uniqueRows = \"1\"")
-transcript = s.query(xmlq)
-
-# Write annotations to file : 2 cases
-if filenb == "2":
-    logging.info("writing transcript related annotations in a transcript file.\n")
-    tsvfile_out = "/biomart/" + organism + "_ens" + version + "_transcriptid.tsv"
-    #tsvfile_out = "./" + organism + "_ens" + version + "_transcriptid.tsv"
-    tsvout = open(tsvfile_out, 'w')
-    tsvout.write(transcript)
-    tsvout.close()
-else:
-    logging.info("writing transcript related annotations in an intermediate file.\n")
-    tsvfile_out = "/biomart/" + organism + "_ens" + version + "_raw.tsv"
-    #tsvfile_out = "./" + organism + "_ens" + version + "_raw.tsv"
-    tsvout = open(tsvfile_out, 'a')
-    tsvout.write(transcript)
+transcript_xmlq = s.get_xml()
+transcript_xmlq = set_query_option(transcript_xmlq, 'header', '1')
+transcript_xmlq = set_query_option(transcript_xmlq, 'uniqueRows', '1')
 
 # Retrieve gene linked annotations
 s.new_query()
@@ -204,30 +218,39 @@ elif organism == "celegans":
 else:
     logging.info("Undefined organism, write only standard gene annotations to tsv files\n")
 
-xmlq = s.get_xml()
-xmlq = xmlq.replace("uniqueRows = \"0\"", "uniqueRows = \"1\"")
+gene_xmlq = s.get_xml()
+gene_xmlq = set_query_option(gene_xmlq, 'uniqueRows', '1')
+if filenb == "2":
+    gene_xmlq = set_query_option(gene_xmlq, 'header', '1')
+else:
+    gene_xmlq = set_query_option(gene_xmlq, 'header', '0')
+
+# Both queries are split by chromosome, their shards run at the same time
+counts = chromosome_counts(s, organism + "_gene_ensembl", retries)
+chromosome_groups = chromosome_shards(counts, shards)
+logging.info(str(len(counts)) + " chromosomes queried in " + str(len(chromosome_groups)) + " shards on " + str(connections) + " connections\n")
+transcript, gene = sharded_queries(lambda: CachedBioMart(lambda: biomart_connexion(url), version, cache, replay),
+                                   [transcript_xmlq, gene_xmlq], chromosome_groups, connections, retries)
 
 # Write annotations to file : 2 cases
 if filenb == "2":
+    logging.info("writing transcript related annotations in a transcript file.\n")
+    tsvfile_out = "/biomart/" + organism + "_ens" + version + "_transcriptid.tsv"
+    #tsvfile_out = "./" + organism + "_ens" + version + "_transcriptid.tsv"
+    with open(tsvfile_out, 'w') as tsvout:
+        merge_shards(tsvout, transcript, True)
     logging.info("writing gene related annotations in a gene file.\n")
-    xmlq = xmlq.replace("header = \"0\"", "header = \"1\"")
     tsvfile_out = "/biomart/" + organism + "_ens" + version + "_geneid.tsv"
     #tsvfile_out = "./" + organism + "_ens" + version + "_geneid.tsv"
-    tsvout = open(tsvfile_out, 'w')
-
-gene = s.query(xmlq)
-tsvout.write(gene)
-tsvout.close()
-
-# Change file header when transcript and gene annotations are written in the same file
-# The file header needs to suit both cases, default Ensembl header does not.
-if filenb == "1":
-    logging.info("writing gene related annotations in an intermediate file.\n")
-    newtsvfile_out = "/biomart/" + organism + "_ens" + version + ".tsv"
-    #newtsvfile_out = "./" + organism + "_ens" + version + ".tsv"
-    #prepare new header and replace
-    f = open(tsvfile_out, 'r')
-    header = f.readline()
+    with open(tsvfile_out, 'w') as tsvout:
+        merge_shards(tsvout, gene, True)
+else:
+    # Change file header when transcript and gene annotations are written in the same file
+    # The file header needs to suit both cases, default Ensembl header does not.
+    logging.info("merging transcript and gene annotations in a final single file.\n")
+    tsvfile_out = "/biomart/" + organism + "_ens" + version + ".tsv"
+    #tsvfile_out = "./" + organism + "_ens" + version + ".tsv"
+    header = next((r.partition('\n')[0] for r in transcript if r.partition('\n')[0]), '')
     header = header.replace("Ensembl Transcript ID", "Ensembl ID")
     header = header.replace("Transcript ID", "ID")
     header = header.replace("Transcript stable ID", "ID")
@@ -235,9 +258,7 @@ if filenb == "1":
     header = header.replace("Transcript start (bp)", "Start (bp)")
     header = header.replace("Transcript End (bp)", "End (bp)")
     header = header.replace("Transcript end (bp)", "End (bp)")
-    f.close()
-    logging.info("merging transcript and gene annotations in a final single file.\n")
-    replace_header(tsvfile_out, newtsvfile_out, header)
-    #tsvout.close()
-    f.close()
-    os.remove(tsvfile_out)
+    with open(tsvfile_out, 'w') as tsvout:
+        tsvout.write(header + '\n')
+        merge_shards(tsvout, [r.partition('\n')[2] for r in transcript], False)
+        merge_shards(tsvout, gene, False)
@@ -6,18 +6,26 @@
 # Genomicpariscentre
 
 # Usage : python retrieve_files_from_ensembl.py -o organism_ensembl -e ensemblversion -f file type -t generic -v
+#         python retrieve_files_from_ensembl.py -m manifest -v
 
 # Arguments :
 # -o or --organism         = Bos_taurus, Mus_musculus, Homo_sapiens
 # -t or type               = plants, fungi, metazoa, bacteria, protists, generic
 # -e or --ensemblversion   = 83
 # -f or --files            = all, gff3, gtf, dna_fasta, cdna_fasta, ncrna_fasta (default=all)
+# -m or --manifest         = batch manifest, one "organism ensemblversion [type [files]]" per line, instead of -o -e -t -f
+# -j or --connections      = maximum number of ftp sessions used at the same time on each ftp server (default=5)
+# -w or --workers          = maximum number of transfers running at the same time (default=connections)
+# -s or --segments         = number of byte ranges retrieved at the same time for the dna fasta file (default=1)
+# -n or --nocache          = do not use the team cache of retrieved files
 # -v or --verbose
 
 # Exemple :
 # python retrieve_files_from_ensembl.py -o Bos_taurus -e 83 -f all -t generic -v
+# python retrieve_files_from_ensembl.py -m ensembl84.manifest -w 8 -v
 
 # Results :
+# Files are written to .part files first, an interrupted run is resumed where it stopped
 
 from validannot_env import gff3_path
 from validannot_env import log_path
@@ -25,178 +33,210 @@ from validannot_env import dna_fasta_path
 from validannot_env import gtf_path
 from validannot_env import cdna_fasta_path
 from validannot_env import ncrna_fasta_path
+from validannot_ftp import FtpPool
+from validannot_ftp import ensembl_host
+from validannot_ftp import ftp_releasedir
+from validannot_ftp import schedule_transfers
+from validannot_ftp import retrieve_matching
+from validannot_ftp import TransferResult
+from validannot_cache import default_cache
+from validannot_cache import md5_checksum
 import argparse
+import functools
 import logging
-from ftplib import FTP
+import posixpath
+import sys
+from ftplib import all_errors
 
 
 #############
 # Functions #
 #############
-# Ftp connexion
-def ftp_connect(url):
-    ftp = FTP(url)
-    ftp.login()
-    logging.info(ftp.getwelcome())
-    return ftp
-
-def ftp_defdir(t):
-    if t == 'generic':
-        d ='pub'
-    elif t == 'plants':
-        d ='pub/plants/'
-    elif t == 'metazoa':
-        d = 'pub/metazoa/'
-    elif t == 'fungi':
-        d = 'pub/fungi/'
-    elif t == 'protists':
-        d = 'pub/protists/'
-    elif t == 'bacteria':
-        d= 'pub/bacteria/'
-    return d
+
+# Local file path of each file type
+def output_file(f, s, v):
+    if f == 'gff3':
+        return gff3_path + s + "_ens" + str(v) + ".gff.gz"
+    elif f == 'gtf':
+        return gtf_path + s + "_ens" + str(v) + ".gtf.gz"
+    elif f == 'dna_fasta':
+        return dna_fasta_path + s + "_ens" + str(v) + ".fa.gz"
+    elif f == 'cdna_fasta':
+        return cdna_fasta_path + s + "_ens" + str(v) + "_cdna.fa.gz"
+    elif f == 'ncrna_fasta':
+        return ncrna_fasta_path + s + "_ens" + str(v) + "_ncrna.fa.gz"
 
 # Retrieve gff3 file from ftp://ftp.ensembl.org/pub/release-xx/gff3
 def retrieve_gff3(ftp ,s, v, t):
     # Paths and filename preparation
-    releasenumber = "release" + "-" + str(v)
-    gfffile_out = gff3_path + s + "_ens" + str(v) + ".gff.gz"
-    root=ftp.pwd()
-    ftpdir = ftp_defdir(t)
-    ftp.cwd(ftpdir)
-    ftp.cwd(releasenumber)
-    ftp.cwd('gff3/' + s.lower())
-    logging.info(ftp.pwd())
-    files = []
-    ftp.retrlines('NLST', files.append)
-    for f in files:
-        if f.endswith(v + ".gff3.gz"):
-            logging.info(f)
-            ftp.retrbinary('RETR ' + f, open(gfffile_out, 'wb').write)
-    ftp.cwd(root)
+    gfffile_out = output_file('gff3', s, v)
+    ftpdir = posixpath.join(ftp_releasedir(t, v), 'gff3', s.lower())
+    return retrieve_matching(ftp, ftpdir, v + ".gff3.gz", gfffile_out)
 
 
 # Retrieve gtf file from ftp://ftp.ensembl.org/pub/release-xx/gtf
 def retrieve_gtf(ftp, s, v, t):
     # Paths and filename preparation
-    releasenumber = "release" + "-" + str(v)
-    gtffile_out = gtf_path + s + "_ens" + str(v) + ".gtf.gz"
-    ftpdir = ftp_defdir(t)
-    ftp.cwd(ftpdir)
-    ftp.cwd(releasenumber)
-    ftp.cwd('gtf/' + s.lower())
-    logging.info(ftp.pwd())
-    files = []
-    ftp.retrlines('NLST', files.append)
-    for f in files:
-        if f.endswith(v + ".gtf.gz"):
-            logging.info(f)
-            ftp.retrbinary('RETR ' + f, open(gtffile_out, 'wb').write)
+    gtffile_out = output_file('gtf', s, v)
+    ftpdir = posixpath.join(ftp_releasedir(t, v), 'gtf', s.lower())
+    return retrieve_matching(ftp, ftpdir, v + ".gtf.gz", gtffile_out)
 
 
 # ftp://ftp.ensembl.org/pub/release-xx/fasta/
-def retrieve_dna_fasta(ftp, s, v, t):
+# The genome being the largest file, it can be retrieved as several byte ranges at the same time
+def retrieve_dna_fasta(ftp, s, v, t, segments=1):
     # Paths and filename preparation
-    releasenumber = "release" + "-" + str(v)
-    fastafile_out = dna_fasta_path + s + "_ens" + str(v) + ".fa.gz"
-    root = ftp.pwd()
-    ftpdir = ftp_defdir(t)
-    ftp.cwd(ftpdir)
-    ftp.cwd(releasenumber)
-    ftp.cwd('fasta/' + s.lower() + '/dna')
-    logging.info(ftp.pwd())
-    files = []
-    ftp.retrlines('NLST', files.append)
-    for f in files:
-        if f.endswith(".dna.toplevel.fa.gz"):
-            logging.info (f)
-            ftp.retrbinary('RETR ' + f, open(fastafile_out, 'wb').write)
-    ftp.cwd(root)
+    fastafile_out = output_file('dna_fasta', s, v)
+    ftpdir = posixpath.join(ftp_releasedir(t, v), 'fasta', s.lower(), 'dna')
+    return retrieve_matching(ftp, ftpdir, ".dna.toplevel.fa.gz", fastafile_out, segments)
 
 
 # ftp://ftp.ensembl.org/pub/release-xx/fasta/
 def retrieve_cdna_fasta(ftp, s, v, t):
     # Paths and filename preparation
-    releasenumber = "release" + "-" + str(v)
-    fastafile_out = cdna_fasta_path + s + "_ens" + str(v) + "_cdna.fa.gz"
-    root = ftp.pwd()
-    ftpdir = ftp_defdir(t)
-    ftp.cwd(ftpdir)
-    ftp.cwd(releasenumber)
-    ftp.cwd('fasta/' + s.lower() + '/cdna')
-    logging.info(ftp.pwd())
-    files = []
-    ftp.retrlines('NLST', files.append)
-    for f in files:
-        if f.endswith(".cdna.all.fa.gz"):
-            logging.info (f)
-            ftp.retrbinary('RETR ' + f, open(fastafile_out, 'wb').write)
-    ftp.cwd(root)
+    fastafile_out = output_file('cdna_fasta', s, v)
+    ftpdir = posixpath.join(ftp_releasedir(t, v), 'fasta', s.lower(), 'cdna')
+    return retrieve_matching(ftp, ftpdir, ".cdna.all.fa.gz", fastafile_out)
 
 
 # ftp://ftp.ensembl.org/pub/release-xx/fasta/
 def retrieve_ncrna_fasta(ftp, s, v, t):
     # Paths and filename preparation
-    releasenumber = "release" + "-" + str(v)
-    fastafile_out = ncrna_fasta_path + s + "_ens" + str(v) + "_ncrna.fa.gz"
-    root = ftp.pwd()
-    ftpdir = ftp_defdir(t)
-    ftp.cwd(ftpdir)
-    ftp.cwd(releasenumber)
-    ftp.cwd('fasta/' + s.lower() + '/ncrna')
-    logging.info(ftp.pwd())
-    files = []
-    ftp.retrlines('NLST', files.append)
-    for f in files:
-        if f.endswith(".ncrna.fa.gz"):
-            logging.info (f)
-            ftp.retrbinary('RETR ' + f, open(fastafile_out, 'wb').write)
-    ftp.cwd(root)
-
-
+    fastafile_out = output_file('ncrna_fasta', s, v)
+    ftpdir = posixpath.join(ftp_releasedir(t, v), 'fasta', s.lower(), 'ncrna')
+    return retrieve_matching(ftp, ftpdir, ".ncrna.fa.gz", fastafile_out)
+
+
+retrievers = {'dna_fasta': retrieve_dna_fasta,
+              'cdna_fasta': retrieve_cdna_fasta,
+              'ncrna_fasta': retrieve_ncrna_fasta,
+              'gff3': retrieve_gff3,
+              'gtf': retrieve_gtf}
+
+
+# Expands the files argument into a list of file types
+def file_types(files):
+    if files == 'all':
+        return ['dna_fasta', 'cdna_fasta', 'ncrna_fasta', 'gff3', 'gtf']
+    elif files in retrievers:
+        return [files]
+    else:
+        logging.info(files +" unknown. Check your parameters.")
+        return []
+
+
+# Reads a batch manifest, one organism and release per line :
+# organism ensemblversion [type [files]], type being generic and files being all by default, # starts a comment
+# Argv = the manifest path
+# Returns a list of (organism, version, type, files)
+def read_manifest(path):
+    entries = []
+    with open(path) as fin:
+        for line in fin:
+            fields = line.split('#')[0].split()
+            if not fields:
+                continue
+            if len(fields) < 2:
+                logging.info("Bad manifest line, organism and version needed: " + line.strip())
+                continue
+            fields += ['generic', 'all'][len(fields) - 2:]
+            entries.append(tuple(fields[:4]))
+    return entries
+
+
+# Retrieves one file type of an organism and release, then stores it in the team cache
+# A failed transfer is logged and reported, the other transfers go on
+# Argv = the ftp session, the file type, the organism, the version, the type of organism, the number of byte ranges and the cache
+# Returns the list of TransferResult
+def retrieve_artifact(ftp, f, s, v, t, segments, cache):
+    url = ensembl_host(t)
+    try:
+        if f == 'dna_fasta':
+            results = retrieve_dna_fasta(ftp, s, v, t, segments)
+        else:
+            results = retrievers[f](ftp, s, v, t)
+        if cache is not None:
+            for r in results:
+                checksum = r.checksum or md5_checksum(r.local)
+                cache.store((url, v, s, checksum), r.local, alias=(url, v, s, f))
+    except all_errors as e:
+        logging.info("Failed to retrieve " + f + " for " + s + " release " + str(v) + ": " + str(e))
+        results = [TransferResult(f, output_file(f, s, v), 0, 0.0, 'failed', None)]
+    return results
 
 #############
 
 # Arguments and usage
 
 parser = argparse.ArgumentParser(description='A script to retrieve gff3, gtf and fasta files from the ensembl genome database')
-parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus musculus)', required=True)
-parser.add_argument('-e', '--ensemblversion', help='Ensembl version (Ex:84)', required=True)
+parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus musculus)')
+parser.add_argument('-e', '--ensemblversion', help='Ensembl version (Ex:84)')
 parser.add_argument('-t', '--type',help='Type of organism you want (plants, fungi, metazoa, bacteria, protists, generic)',default='generic')
 parser.add_argument('-f', '--files', help='gff3, gtf, dna_fasta, cdna_fasta, ncrna_fasta or all of them', default='all')
+parser.add_argument('-m', '--manifest', help='Batch manifest, one "organism ensemblversion [type [files]]" per line, instead of -o -e -t -f')
+parser.add_argument('-j', '--connections', help='Maximum number of ftp sessions used at the same time on each ftp server (default=5)', type=int, default=5)
+parser.add_argument('-w', '--workers', help='Maximum number of transfers running at the same time (default=connections)', type=int)
+parser.add_argument('-s', '--segments', help='Number of byte ranges retrieved at the same time for the dna fasta file (default=1)', type=int, default=1)
+parser.add_argument('-n', '--nocache', help='Do not use the team cache of retrieved files', action='store_true')
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
-organism = args['organism']
-version = args['ensemblversion']
-files = args['files']
-type = args['type']
-if type == 'generic':
-    url = 'ftp.ensembl.org'
-else:
-    url = 'ftp.ensemblgenomes.org'
+if not args['manifest'] and not (args['organism'] and args['ensemblversion']):
+    parser.error('-o and -e are required without -m')
+connections = args['connections']
+workers = args['workers'] or connections
+segments = args['segments']
+nocache = args['nocache']
 if args['verbose']:
     logging.basicConfig(filename=log_path +'retrieve_ensembl.log',level=logging.INFO,format='%(asctime)s %(message)s')
 
-ftp = ftp_connect(url)
-
-if files == 'gff3':
-    retrieve_gff3(ftp, organism, version, type)
-elif files == 'gtf':
-    retrieve_gtf(ftp, organism, version, type)
-elif files == 'dna_fasta':
-    retrieve_dna_fasta(ftp, organism, version, type)
-elif files == 'cdna_fasta':
-    retrieve_cdna_fasta(ftp, organism, version, type)
-elif files == 'ncrna_fasta':
-    retrieve_ncrna_fasta(ftp, organism, version, type)
-elif files == 'all':
-    retrieve_dna_fasta(ftp, organism, version, type)
-    retrieve_cdna_fasta(ftp, organism, version, type)
-    retrieve_ncrna_fasta(ftp, organism, version, type)
-    retrieve_gff3(ftp, organism, version, type)
-    retrieve_gtf(ftp, organism, version, type)
+if args['manifest']:
+    entries = read_manifest(args['manifest'])
 else:
-    logging.info(files +" unknown. Check your parameters.")
-
-ftp.quit()
-ftp.close()
\ No newline at end of file
+    entries = [(args['organism'], args['ensemblversion'], args['type'], args['files'])]
+
+# Files already in the team cache are linked without any ftp connexion
+# The other ones are retrieved on sessions of one pool per ftp server, directory listings being read once
+cache = None if nocache else default_cache()
+pools = {}
+artifacts = []
+cached = set()
+jobs = []
+for organism, version, type, files in entries:
+    url = ensembl_host(type)
+    for f in file_types(files):
+        artifacts.append((organism, version, f))
+        if cache is not None and cache.fetch((url, version, organism, f), output_file(f, organism, version)):
+            cached.add(output_file(f, organism, version))
+            continue
+        if url not in pools:
+            pools[url] = FtpPool(url, connections)
+        jobs.append((pools[url], functools.partial(retrieve_artifact, f=f, s=organism, v=version, t=type, segments=segments, cache=cache)))
+
+results = {}
+try:
+    for rs in schedule_transfers(jobs, workers):
+        for r in rs:
+            results.setdefault(r.local, []).append(r)
+finally:
+    for pool in pools.values():
+        pool.close()
+
+# Summary of each file
+summary = []
+for organism, version, f in artifacts:
+    local = output_file(f, organism, version)
+    if local in cached:
+        rs = [TransferResult(f, local, 0, 0.0, 'cached', None)]
+    else:
+        rs = results.get(local) or [TransferResult(f, local, 0, 0.0, 'missing', None)]
+    for r in rs:
+        logging.info(r.local + " : " + r.status + ", " + str(r.nbytes) + " bytes in " + "%.1f" % r.elapsed + "s")
+        summary.append((organism, str(version), f, r.status, r.nbytes, r.elapsed))
+if args['manifest']:
+    print "%-30s %-8s %-12s %-11s %15s %10s" % ('organism', 'version', 'file', 'status', 'bytes', 'seconds')
+    for organism, version, f, status, nbytes, elapsed in summary:
+        print "%-30s %-8s %-12s %-11s %15d %10.1f" % (organism, version, f, status, nbytes, elapsed)
+    print "%-30s %-8s %-12s %-11s %15d" % ('total', '', '', '', sum(row[4] for row in summary))
+if [row for row in summary if row[3] in ('failed', 'missing')]:
+    sys.exit(1)
@@ -10,6 +10,9 @@
 
 # Arguments :
 # -o or --organism         = Capra_hircus
+# -n or --nocache          = do not use the team cache of retrieved files
+# -j or --connections      = maximum number of ftp sessions used at the same time for the chromosome files (default=4)
+# -b or --bgzf             = write the merged genome as a single bgzf file
 # -v or --verbose
 
 # Exemple :
@@ -19,13 +22,24 @@
 from validannot_env import gff3_path
 from validannot_env import dna_fasta_path
 from validannot_env import log_path
+from validannot_cache import default_cache
+from validannot_cache import md5_checksum
+from validannot_ftp import FtpPool
+from validannot_ftp import LocalManifest
+from validannot_ftp import run_transfers
+from validannot_ftp import retrieve_file
+from validannot_ftp import list_remote_files
+from validannot_ftp import remote_checksums
+from validannot_io import append_file
+from validannot_io import chromosome_key
+from validannot_io import BgzfWriter
+from validannot_io import GzipDecoder
 import argparse
+import functools
 import os
 import datetime
 import os.path
-import hashlib
 import gzip
-import urllib2
 import logging
 import glob
 from ftplib import FTP
@@ -35,89 +49,43 @@ from ftplib import FTP
 # Functions #
 #############
 
-# Retrieves server date link to file name in a ftp connexion
-# Argv = the ftp connexion
-# Returns a dictionary containing filename:date
-def get_ftp_file_datetime(ftp):
-    data = []
-    filetodate = {}
-    corresponding_month = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06', 'Jul': '07',
-                           'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
-    # Get files and file parameters
-    ftp.dir(data.append)
-    for line in data:
-        print line
-        col = line.split()
-        # Format date
-        if ":" in col[7]:
-            now = datetime.datetime.now()
-            year = str(now.year)
-        else:
-            year = col[7]
-        month =  corresponding_month[col[5]]
-        if len(col[6]) == 1:
-            day = "0"+col[6]
-        else:
-            day = col[6]
-        datestr = year + month + day
-        # Link file name and its date
-        filetodate.update({col[8]: datestr})
-    return filetodate
+ncbi = 'ftp.ncbi.nih.gov'
 
-# Retrieves server file sizes in a ftp connexion
+# Lists the files of a ftp connexion directory in a single pass, with the md5 keys of the server checksum file
 # Argv = the ftp connexion
-# Returns a dictionary containing filename:size
-def get_ftp_file_size(ftp):
-    data = []
-    filetosize = {}
-    # Get files and file parameters
-    ftp.dir(data.append)
-    for line in data:
-        col = line.split()
-        # Format date
-        size = col[4]
-        # Link file name and its date
-        filetosize.update({col[8]: size})
-    return filetosize
-
-# Computes the md5 key for a remote file without copying it locally
-# Would not work for big files
-# Argv = remote file path
-# Returns the md5sum key
-def remote_md5Checksum(remotefile):
-    remote = urllib2.urlopen(remotefile)
-    m = hashlib.md5()
-    while True:
-        data = remote.read(8192)
-        if not data:
-            break
-        m.update(data)
-    return m.hexdigest()
-
-# Computes the md5 key for a local file
-# Would not work for big files
-# Argv = file path
-# Returns the md5sum key
-def md5Checksum(filePath):
-    with open(filePath, 'rb') as fh:
-        m = hashlib.md5()
-        while True:
-            data = fh.read(8192)
-            if not data:
-                break
-            m.update(data)
-        return m.hexdigest()
+# Returns a dictionary containing filename:RemoteFile and a dictionary containing filename:md5
+def get_ftp_files(ftp):
+    files = list_remote_files(ftp)
+    return files, remote_checksums(ftp, files)
+
+# Server date of a file used in the local file names, today if the server does not give it
+# Argv = the RemoteFile
+# Returns the date as YYYYMMDD
+def get_ftp_file_date(remote):
+    if remote.mtime:
+        return remote.mtime[:8]
+    return datetime.date.today().strftime('%Y%m%d')
+
+# Retrieves a file from a ftp connexion or links it from the team cache if it is already there, then records it in the local manifest
+# Argv = the ftp connexion, the remote file name, the local file path, the RemoteFile, the server md5 (None if unknown), the organism name, the cache (None for no cache) and the local manifest
+def retrieve_or_link(ftp, f, file_out, remote, md5, s, cache, manifest):
+    date = get_ftp_file_date(remote)
+    alias = ('ncbi', date, s, f)
+    if cache is None or not cache.fetch(alias, file_out, md5):
+        retrieve_file(ftp, f, file_out)
+        if cache is not None:
+            cache.store(('ncbi', date, s, md5 or md5_checksum(file_out)), file_out, alias)
+    manifest.record(file_out, remote, md5)
 
 
 # Retrieves gff3 *top_level.gff3.gz file from a ftp connexion on the ncbi genome site
 # Reformats the name following the server date of the file
-# Checks if already exists locally with its date and its size
+# Checks if already exists locally with the local manifest (server size, date and md5)
 # Does not retrieve it if it's the same
-# Argv = the root path where to save the files and the organism name following the ncbi convention ex: Mus_musculus
+# Argv = the root path where to save the files, the organism name following the ncbi convention ex: Mus_musculus and the cache (None for no cache)
 # Gets the distant file and returns the reformated gff3 file path and name
 # ftp://ftp.ncbi.nih.gov/genomes/xxx_xxx/GFF/
-def retrieve_gff3(p, s):
-    ncbi = 'ftp.ncbi.nih.gov'
+def retrieve_gff3(p, s, cache=None):
     # Paths and filename preparation
     ftp = FTP(ncbi)
     ftp.login()
@@ -125,73 +93,79 @@ def retrieve_gff3(p, s):
     ftp.cwd('genomes')
     ftp.cwd(s)
     ftp.cwd('GFF')
-    filetodate = get_ftp_file_datetime(ftp)
-    filetosize = get_ftp_file_size(ftp)
-    for f in ftp.nlst("."):
+    files, checksums = get_ftp_files(ftp)
+    manifest = LocalManifest(p)
+    for f in sorted(files):
         if f.startswith("ref") and f.endswith("top_level.gff3.gz"):
-            gfffile_out = p + filetodate[f] + "_" + s + "_ncbi.gff.gz"
+            gfffile_out = p + get_ftp_file_date(files[f]) + "_" + s + "_ncbi.gff.gz"
             # Looks for local gff3.gz file
-            if os.path.exists(gfffile_out): # Finds a local file
-                oldfile_size=str(os.path.getsize(gfffile_out))
-                newfile_size = filetosize[f]
-                if newfile_size != oldfile_size:
-                    logging.info("retrieve gff3 file: " + f)
-                    logging.info("write to file: " + gfffile_out)
-                    outf = open(gfffile_out, 'wb')
-                    ftp.retrbinary('RETR ' + f, outf.write)
-                    outf.close()
-                else: # Server and local files are the same
-                    logging.info(gfffile_out+" already exist and is the same as server file\nThere is no need to get it again")
-            else: # No local file
+            if manifest.unchanged(gfffile_out, files[f], checksums.get(f)): # Server and local files are the same
+                logging.info(gfffile_out+" already exist and is the same as server file\nThere is no need to get it again")
+            else:
                 logging.info("retrieve gff3 file: " + f)
                 logging.info("write to file: " + gfffile_out)
-                outf = open(gfffile_out, 'wb')
-                ftp.retrbinary('RETR ' + f, outf.write)
-                outf.close()
-    return gfffile_out
+                retrieve_or_link(ftp, f, gfffile_out, files[f], checksums.get(f), s, cache, manifest)
     ftp.quit()
+    return gfffile_out
+
+# Maps the chromosome fasta file names of a directory to their chromosome, for the wanted chromosomes only
+# Argv = the file names and the chromosome list
+# Returns a dictionary containing filename:chromosome
+def map_chromosome_files(files, chromo):
+    wanted = set(chromo)
+    filetochromo = {}
+    for f in files:
+        if 'ref' in f and f.endswith(".fa.gz") and "chr" in f:
+            c = f[:-6].rsplit("chr", 1)[1]
+            if c in wanted:
+                filetochromo[f] = c
+    return filetochromo
+
+# Retrieves a chromosome fasta file on a session of the ftp pool
+# Argv = the ftp session, the remote directory, the remote file name, the local file path, the RemoteFile, the server md5, the organism name, the cache and the local manifest
+def retrieve_chromosome(ftp, ftpdir, f, fastafile_out, remote, md5, s, cache, manifest):
+    ftp.cwd(ftpdir)
+    logging.info("retrieve fasta file lines: " + f)
+    retrieve_or_link(ftp, f, fastafile_out, remote, md5, s, cache, manifest)
 
 # Retrieves chromosome fasta files from a ftp connexion on the ncbi genome site following a chromosome list
 # Reformats the name following the server date of the files
-# Checks if already exists locally with its date and its size
+# Checks if already exists locally with the local manifest (server size, date and md5)
 # Does not retrieve it if it's the same
-# Gets the distant file
-# Argv = the root path where to save the files, the organism name following the ncbi convention ex: Mus_musculus and the chromosome list
+# Gets the distant files at the same time on a pool of ftp sessions
+# Argv = the root path where to save the files, the organism name following the ncbi convention ex: Mus_musculus, the chromosome list, the cache (None for no cache) and the number of ftp sessions
 # Returns a prefix following this pattern = ncbiftpfiledate_latinspecies_name__ncbi
 # ftp://ftp.ncbi.nih.gov/genomes/xxx_xxx/Assembled_chromosomes/seq/
-def retrieve_fasta(p, s, chromo):
+def retrieve_fasta(p, s, chromo, cache=None, connections=4):
     # Paths and filename preparation
-    ftp = FTP('ftp.ncbi.nih.gov')
+    ftp = FTP(ncbi)
     ftp.login()
     ftp.getwelcome()
     ftp.cwd('genomes')
     ftp.cwd(s)
     ftp.cwd('Assembled_chromosomes/seq')
-    filetodate = get_ftp_file_datetime(ftp)
-    filetosize = get_ftp_file_size(ftp)
-    prefix = ""
-    for f in ftp.nlst("."):
-        for c in chromo:
-            if 'ref' in f and f.endswith("chr" + c + ".fa.gz"):
-                newfile_size = filetosize[f]
-                fastafile_out = p + filetodate[f] + "_" + s + "_ncbi_" + f
-                prefix = p + filetodate[f] + "_" + s + "_ncbi_"
-                if os.path.exists(fastafile_out):
-                    oldfile_size = str(os.path.getsize(fastafile_out))
-                    if newfile_size != oldfile_size:
-                        logging.info("retrieve fasta file lines: " + f)
-                        ouf = open(fastafile_out, 'w')
-                        ftp.retrbinary('RETR ' + f, ouf.write)
-                        ouf.close()
-                    else: # Server and local files are the same
-                        logging.info(fastafile_out + " already exist locally and is the same as the server file: there is no need to get it again")
-                else: # No local file
-                    logging.info("retrieve fasta file lines: " + f)
-                    ouf = open(fastafile_out, 'w')
-                    ftp.retrbinary('RETR ' + f, ouf.write)
-                    ouf.close()
-
+    ftpdir = ftp.pwd()
+    files, checksums = get_ftp_files(ftp)
+    filetochromo = map_chromosome_files(files, chromo)
     ftp.quit()
+    manifest = LocalManifest(p)
+    prefix = ""
+    tasks = []
+    for f in sorted(filetochromo):
+        date = get_ftp_file_date(files[f])
+        fastafile_out = p + date + "_" + s + "_ncbi_" + f
+        prefix = p + date + "_" + s + "_ncbi_"
+        if manifest.unchanged(fastafile_out, files[f], checksums.get(f)):
+            # Server and local files are the same
+            logging.info(fastafile_out + " already exist locally and is the same as the server file: there is no need to get it again")
+        else:
+            tasks.append(functools.partial(retrieve_chromosome, ftpdir=ftpdir, f=f, fastafile_out=fastafile_out, remote=files[f],
+                                           md5=checksums.get(f), s=s, cache=cache, manifest=manifest))
+    pool = FtpPool(ncbi, connections)
+    try:
+        run_transfers(pool, tasks)
+    finally:
+        pool.close()
     return prefix
 
 # Analyses a gff3.gz file to build a defined chromosome list found in the gff3
@@ -222,16 +196,28 @@ def get_reference_and_chromosome_from_ncbigff(p,s):
 
 
 # Gets the fa.gz files defined by a specific pattern from a directory and concatenate them into a single fa.gz file
-# Argv = pattern to find the fa.gz files, the pattern is the concatenation between the path and the prefix of the file names
+# Chromosomes are written in natural order (1, 2, ..., 10, X, Y, MT) with constant memory
+# gzip members are copied as they are by the kernel when possible, or decompressed and written as a single bgzf file
+# Argv = pattern to find the fa.gz files, the pattern is the concatenation between the path and the prefix of the file names, and bgzf output (True or False)
 # Returns the output file name
-def concatenate_fasta(pattern):
-    filenames = glob.glob(pattern+"*.fa.gz")
+def concatenate_fasta(pattern, bgzf=False):
     outfileName = pattern+"genome.fa.gz"
-    with open(outfileName, 'w') as outfile:
-        for fname in filenames:
-            with open(fname) as infile:
-                outfile.write(infile.read())
-    outfile.close()
+    filenames = [f for f in glob.glob(pattern+"*.fa.gz") if f != outfileName]
+    filenames.sort(key=lambda f: chromosome_key(f[len(pattern):-6].rsplit("chr", 1)[-1]))
+    if bgzf:
+        with BgzfWriter(outfileName) as outfile:
+            for fname in filenames:
+                logging.info("add " + fname)
+                decoder = GzipDecoder()
+                with open(fname, 'rb') as infile:
+                    for block in iter(lambda: infile.read(1 << 20), ''):
+                        outfile.write(decoder.decompress(block))
+                outfile.write(decoder.flush())
+    else:
+        with open(outfileName, 'wb') as outfile:
+            for fname in filenames:
+                logging.info("add " + fname)
+                append_file(outfile, fname)
     return outfileName
 
 
@@ -241,16 +227,20 @@ def concatenate_fasta(pattern):
 
 parser = argparse.ArgumentParser(description='A script to retrieve and format gff3 and fasta files from the ncbi genome database')
 parser.add_argument('-o', '--organism', help='NCBI organism name (Ex: Mus_musculus)', required=True)
+parser.add_argument('-n', '--nocache', help='Do not use the team cache of retrieved files', action='store_true')
+parser.add_argument('-b', '--bgzf', help='Write the merged genome as a single bgzf file (indexable by samtools faidx)', action='store_true')
+parser.add_argument('-j', '--connections', help='Maximum number of ftp sessions used at the same time for the chromosome files (default=4)', type=int, default=4)
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
 organism = args['organism']
+cache = None if args['nocache'] else default_cache()
 if args['verbose']:
     logging.basicConfig(filename=log_path +'retrieve_ncbi.log',level=logging.INFO,format='%(asctime)s %(message)s')
 
 # Retrieves gff3 file
 logging.info ("Get " + organism + " gff3 file from the NCBI")
-gfffile_in = retrieve_gff3(gff3_path, organism)
+gfffile_in = retrieve_gff3(gff3_path, organism, cache)
 # Gets chromosome numbers from the gff3 file
 logging.info ("Get chromosome fasta file needed by gff3 file "+gfffile_in)
 ref_chr = get_reference_and_chromosome_from_ncbigff(gfffile_in,organism)
@@ -258,7 +248,7 @@ ref_chr = get_reference_and_chromosome_from_ncbigff(gfffile_in,organism)
 
 # Gets the fasta files following the chromosome list
 logging.info ("Get chromosome fasta files")
-prefix = retrieve_fasta(dna_fasta_path, organism, ref_chr)
+prefix = retrieve_fasta(dna_fasta_path, organism, ref_chr, cache, args['connections'])
 logging.info ("Merge all the chromosome fasta files into one")
-genomeFile = concatenate_fasta(prefix)
+genomeFile = concatenate_fasta(prefix, args['bgzf'])
 logging.info (genomeFile+" created")
\ No newline at end of file
@@ -12,6 +12,7 @@
 # Arguments :
 # -o or --organism    	 Ensembl organism name Ex: Mus_musculus
 # -e or --ensemblversion Ensembl version Ex: 84
+# -z or --bgzf           Write a bgzf compressed fasta file (.gz), the compression level can follow (1 to 9, default=6)
 # -v or --verbose
 
 # Exemple :
@@ -20,54 +21,33 @@
 from validannot_env import gff3_path
 from validannot_env import log_path
 from validannot_env import dna_fasta_path
+from validannot_fasta import chrom_sizes_path
+from validannot_fasta import fasta_name
+from validannot_fasta import filter_fasta
+from validannot_gff import gff_chromosomes
+from validannot_io import find_input
+from validannot_io import open_input
+from validannot_io import open_output
 import argparse
-import subprocess
-import fileinput
 import os
 import sys
 import logging
-from Bio import SeqIO
 
 
 #############
 # Functions #
 #############
 
-# Checks if the path and file exist
-# Argv = path and file
-# Returns a var that can be a boolean or an integer
-# If true, path and gz file exist, if false, path and gunzipped file exist, if 2, path or file do not exist
-def make_sure_file_exists(p,f):
-        if os.path.exists(p):
-            if os.path.isfile(p+"/"+f[:-3]):
-                logging.info("Found gunzipped file: "+ f[:-3] + "\n No need to gunzip...")
-                gz = False
-            elif os.path.isfile(p+"/"+f):
-                logging.info("Found gzipped file: "+ f +"...")
-                gz = True
-            else:
-                gz=2
-        else:
-            gz=2
-        return gz
-
-
-# Gets the chromosomes names in the gff3 file to format the fasta file
-# Argv = the gff file
-# Returns a chromosome list
-def get_chromosome_from_ensemblgff(gff_in):
-    wanted = []
-    for line in fileinput.input(gff_in):
-            if line.startswith('#'):
-                continue
-            gff_fields = line.strip().split('\t')
-            if gff_fields[2] == 'chromosome' and not '_' in gff_fields[0]:
-                wanted.append(gff_fields[0])
-    logging.info("chromosome list for "+gff_in+" : "+','.join(wanted))
-    fileinput.close()
-    return wanted
-
-
+# Keeps the sequences of the chromosome list, their headers are not changed
+# Argv = the header line (without > and line end)
+# Returns the header, None if the sequence is not kept
+def select_chromosome(header):
+    name = fasta_name(header)
+    if name in wanted:
+        logging.info(name)
+        wanted.remove(name)
+        return header
+    return None
 
 
 #############
@@ -76,66 +56,41 @@ def get_chromosome_from_ensemblgff(gff_in):
 parser = argparse.ArgumentParser(description='A script to build a fasta file containing only the chromosomes described in a gff3 file.')
 parser.add_argument('-o', '--organism', help='Ensembl organism name (Ex: Mus_musculus)', required=True)
 parser.add_argument('-e', '--ensemblversion', help='Ensembl version Ex: 84', required=True)
+parser.add_argument('-z', '--bgzf', help='Write the output as a bgzf file (.gz), with an optional compression level from 1 fastest to 9 smallest (default=6)', type=int, nargs='?', const=6)
 parser.add_argument('-v', '--verbose', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
 
 organism = args['organism']
 version = args['ensemblversion']
+level = args['bgzf']
 if args['verbose']:
     logging.basicConfig(filename=log_path+'select_ensembl_fasta_from_gffid.log',level=logging.INFO,format='%(asctime)s %(message)s')
 
-gff_in = "only_chr_" + organism + "_ens" + version + "_sgdb.gff.gz"
-# Check if gff coming in exists
-isgz_gff = make_sure_file_exists(gff3_path,gff_in)
-# gunzip or not gff
-if type(isgz_gff) is int:
-    logging.info(os.strerror(isgz_gff))
+# Check if gff and fasta coming in exist, gzipped files are read as they are
+gff_in = find_input(gff3_path, "only_chr_" + organism + "_ens" + version + "_sgdb.gff.gz")
+if gff_in is None:
     sys.exit(1)
-else:
-    if not isgz_gff:
-        gff_in = gff_in[:-3]
-    else:
-        inF = gff3_path + gff_in
-        proc = subprocess.Popen(["gunzip", gff3_path + gff_in], stderr=subprocess.PIPE)
-        for line in proc.stderr:
-            logging.info(line)
-        gfffile_in = gff_in[:-3]
-
-
-fasta_in = organism + "_ens" + version + ".fa.gz"
-# Check if fasta coming in exists
-isgz_fasta = make_sure_file_exists(dna_fasta_path,fasta_in)
-# gunzip or not fasta
-if type(isgz_fasta) is int:
-    logging.info(os.strerror(isgz_fasta))
+
+fasta_in = find_input(dna_fasta_path, organism + "_ens" + version + ".fa.gz")
+if fasta_in is None:
     sys.exit(1)
-else:
-    if not isgz_fasta:
-        fasta_in = fasta_in[:-3]
-    else:
-        inF = dna_fasta_path + fasta_in
-        proc = subprocess.Popen(["gunzip", dna_fasta_path + fasta_in], stderr=subprocess.PIPE)
-        for line in proc.stderr:
-            logging.info(line)
-        fasta_in = fasta_in[:-3]
 
 
 # Create chromosome list from gff file
-wanted = get_chromosome_from_ensemblgff(gff3_path+gff_in)
+wanted = gff_chromosomes(gff_in)
 
 logging.info("Writing new fasta file....")
 # Open fasta coming in
-fin = open(dna_fasta_path+fasta_in, "rU")
+fin = open_input(fasta_in)
 # Create output fasta file and handle it
-fasta_out = dna_fasta_path + "only_chr_" + fasta_in
-fout = open(fasta_out, "w")
-
-for record in SeqIO.parse(fin, "fasta") :
-    if record.id in wanted:
-        logging.info(record.id)
-        SeqIO.write(record, fout, "fasta")
-        wanted.remove(record.id)
+fasta_out = dna_fasta_path + "only_chr_" + organism + "_ens" + version + ".fa"
+if level is not None:
+    fasta_out += ".gz"
+fout = open_output(fasta_out, level)
+
+# Sequence lines are copied as they are, the .fai index and chrom.sizes files are written in the same pass
+filter_fasta(fin, fout, select_chromosome, fasta_out + ".fai", chrom_sizes_path(fasta_out))
 if wanted:
     logging.info("Missing chromosomes in new fasta file: "+','.join(wanted))
 else:
@@ -143,4 +98,7 @@ else:
 
 fin.close()
 fout.close()
+if level is not None:
+    # samtools faidx reads a bgzf fasta file with its .fai and .gzi indexes
+    fout.write_gzi(fasta_out + ".gzi")
 logging.info("New fasta file "+fasta_out+" written.")
\ No newline at end of file
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+# validannot_biomart.py
+# Shared BioMart tools : queries split by chromosome (shards), run at the same time on a bounded number of connections
+# Each shard is retried with a growing delay when BioMart fails or returns a truncated answer
+# Redirections, attribute lists and query answers are kept in the team cache (validannot_cache.py) and can be replayed without network
+# Needs to be included in query_ensembl_bioservices.py
+
+from validannot_cache import alias_key
+import hashlib
+import heapq
+import logging
+import random
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+#############
+# Functions #
+#############
+
+# Xml query of BioMart, as bioservices writes it
+query_template = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE Query>
+<Query  virtualSchemaName = "default" formatter = "TSV" header = "0" uniqueRows = "0" count = "" datasetConfigVersion = "0.6" >
+<Dataset name = "%s" interface = "default" >
+%s</Dataset>
+</Query>
+"""
+
+
+# Gets an answer of BioMart from the cache, or else computes it and keeps it in the cache
+# Argv = the cache (None for no cache), the alias of the answer (source, release, kind, name), the function computing the answer,
+# the replay mode (no computing, a missing answer is an error) and the function checking that an answer can be cached
+# Returns the answer
+def cached(cache, alias, compute, replay=False, valid=None):
+    if cache is not None:
+        data = cache.fetch_data(alias)
+        if data is not None:
+            return data
+    if replay:
+        raise IOError("Not in the cache, no connexion in replay mode : " + alias_key(alias))
+    data = compute()
+    if cache is not None and (valid is None or valid(data)):
+        cache.store_data(tuple(alias[:3]) + (hashlib.sha1(data).hexdigest(),), data, alias)
+    return data
+
+
+# BioMart session of a release answering from the cache
+# Queries are written as xml without connexion, the attribute lists and the query answers are cached, queries being keyed by the sha1 of their xml
+# The bioservices session is opened at the first answer missing from the cache, never in replay mode
+class CachedBioMart(object):
+
+    # Argv = a function opening a bioservices BioMart session, the Ensembl release, the cache (None for no cache) and the replay mode
+    def __init__(self, connect, release, cache=None, replay=False):
+        self.connect = connect
+        self.release = release
+        self.cache = cache
+        self.replay = replay
+        self.session = None
+        self.attribute_lists = {}
+        self.new_query()
+
+    def biomart(self):
+        if self.session is None:
+            self.session = self.connect()
+        return self.session
+
+    def new_query(self):
+        self.dataset = None
+        self.attribute_names = []
+
+    def add_dataset_to_xml(self, dataset):
+        self.dataset = dataset
+
+    def add_attribute_to_xml(self, name):
+        self.attribute_names.append(name)
+
+    def get_xml(self):
+        return query_template % (self.dataset, ''.join('<Attribute name = "' + a + '" />\n' for a in self.attribute_names))
+
+    # Returns the list of the attribute names of a dataset
+    def attributes(self, dataset):
+        if dataset not in self.attribute_lists:
+            names = cached(self.cache, ('biomart', self.release, 'attributes', dataset),
+                           lambda: '\n'.join(sorted(self.biomart().attributes(dataset))), self.replay)
+            self.attribute_lists[dataset] = names.split('\n')
+        return self.attribute_lists[dataset]
+
+    # Returns the answer of an xml query, only complete answers being cached
+    def query(self, xmlq):
+        def answer():
+            result = self.biomart().query(xmlq)
+            return result.encode('utf-8') if isinstance(result, unicode) else result
+        return cached(self.cache, ('biomart', self.release, 'query', hashlib.sha1(xmlq).hexdigest()), answer, self.replay, complete_answer)
+
+
+# Sets an attribute of the Query element of a BioMart xml query (header, uniqueRows, completionStamp...)
+def set_query_option(xmlq, name, value):
+    option = re.compile(r'\b' + name + r'\s*=\s*"[^"]*"')
+    if option.search(xmlq):
+        return option.sub(name + ' = "' + value + '"', xmlq, 1)
+    return re.sub(r'<Query\b', '<Query ' + name + ' = "' + value + '"', xmlq, 1)
+
+
+# Adds a chromosome filter to a BioMart xml query
+# Argv = the xml query and the list of chromosomes
+def chromosome_filter(xmlq, chromosomes):
+    return re.sub(r'(<Dataset\b[^>]*>)', r'\1\n<Filter name = "chromosome_name" value = "' + ','.join(chromosomes) + '"/>', xmlq, 1)
+
+
+# Checks the answer of a BioMart query sent with completionStamp = "1"
+# BioMart answers errors as text, and a query cut by a timeout has no completion stamp
+# Returns the answer without its completion stamp, raises IOError if the query failed
+def checked_result(result):
+    if not isinstance(result, basestring):
+        raise IOError("BioMart query failed (status " + str(result) + ")")
+    if result.startswith('Query ERROR'):
+        raise IOError(result.strip())
+    if not result.rstrip('\n').endswith('[success]'):
+        raise IOError("BioMart answer truncated (" + str(len(result)) + " bytes)")
+    result = result.rstrip('\n')[:-len('[success]')]
+    return result
+
+
+# True if an answer is complete, only complete answers being cached
+def complete_answer(result):
+    try:
+        checked_result(result)
+    except IOError:
+        return False
+    return True
+
+
+# Runs a BioMart query, again after a growing random delay when it fails
+# An answer from the cache is never retried, in replay mode a query missing from the cache fails at once
+# Argv = the BioMart session, the xml query, the number of retries and the first delay in seconds
+# Returns the answer of the query, without completion stamp
+def query_with_retries(s, xmlq, retries=3, delay=5):
+    xmlq = set_query_option(xmlq, 'completionStamp', '1')
+    attempt = 0
+    while True:
+        try:
+            return checked_result(s.query(xmlq))
+        except Exception as e:
+            if attempt >= retries or getattr(s, 'replay', False):
+                raise
+            wait = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+            logging.info("BioMart query failed (" + str(e)[:200] + "), new try in " + "%.0f" % wait + "s\n")
+            time.sleep(wait)
+            attempt += 1
+
+
+# Counts the genes of each chromosome of a dataset, a small query whose answer is a chromosome name by gene
+# Argv = the BioMart session, the dataset, the number of retries and the first delay in seconds
+# Returns a dictionary chromosome:number of genes
+def chromosome_counts(s, dataset, retries=3, delay=5):
+    s.new_query()
+    s.add_dataset_to_xml(dataset)
+    s.add_attribute_to_xml("chromosome_name")
+    xmlq = set_query_option(set_query_option(s.get_xml(), 'header', '0'), 'uniqueRows', '0')
+    counts = {}
+    for line in query_with_retries(s, xmlq, retries, delay).splitlines():
+        if line:
+            counts[line] = counts.get(line, 0) + 1
+    return counts
+
+
+# Groups the chromosomes in shards of about the same number of genes : each chromosome, largest first, goes to the smallest shard
+# Scaffolds and patches of a few genes are queried together, large chromosomes are queried alone
+# Argv = the dictionary chromosome:number of genes and the number of shards
+# Returns the list of shards, each shard being a list of chromosomes
+def chromosome_shards(counts, n):
+    shards = [(0, i, []) for i in range(max(1, min(n, len(counts))))]
+    for chromosome in sorted(counts, key=lambda c: (-counts[c], c)):
+        size, i, chromosomes = heapq.heappop(shards)
+        chromosomes.append(chromosome)
+        heapq.heappush(shards, (size + counts[chromosome], i, chromosomes))
+    return [chromosomes for size, i, chromosomes in sorted(shards, key=lambda shard: shard[1]) if chromosomes]
+
+
+# Runs BioMart queries split by chromosome, the shards of all the queries being run at the same time
+# Each worker thread has its own BioMart session (CachedBioMart)
+# Argv = a function opening a BioMart session, the list of xml queries, the list of shards (lists of chromosomes),
+# the number of connections used at the same time, the number of retries and the first delay in seconds
+# Returns, for each query, the list of the answers of its shards in the shard order
+def sharded_queries(connect, xmlqs, shards, connections=4, retries=3, delay=5):
+    sessions = threading.local()
+
+    def run(job):
+        xmlq, chromosomes = job
+        if not hasattr(sessions, 's'):
+            sessions.s = connect()
+        start = time.time()
+        result = query_with_retries(sessions.s, chromosome_filter(xmlq, chromosomes), retries, delay)
+        logging.info("BioMart shard " + ','.join(chromosomes)[:50] + " : " + str(len(result)) + " bytes in " + "%.1f" % (time.time() - start) + "s\n")
+        return result
+
+    jobs = [(xmlq, chromosomes) for xmlq in xmlqs for chromosomes in shards]
+    threads = ThreadPool(max(1, min(connections, len(jobs))))
+    try:
+        results = threads.map(run, jobs, 1)
+    finally:
+        threads.close()
+        threads.join()
+    return [results[i * len(shards):(i + 1) * len(shards)] for i in range(len(xmlqs))]
+
+
+# Writes the answers of the shards of a query in a single file
+# Argv = the open output file, the answers of the shards and whether they begin with a header line
+# The header line of the first shard is written once, the header lines of the other shards are skipped
+def merge_shards(out, results, header):
+    written = False
+    for result in results:
+        if header:
+            first, sep, result = result.partition('\n')
+            if not written and first:
+                out.write(first + '\n')
+                written = True
+        if result:
+            out.write(result if result.endswith('\n') else result + '\n')
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+# validannot_cache.py
+# Local cache of the release files retrieved from Ensembl and NCBI, shared by all the users of the validannot scripts
+# Files are stored once, addressed by source, release, species and remote checksum
+# A file already in the cache is hard linked (or copied) to its destination without any network access
+# Answers of web services (BioMart redirections, attribute lists and queries) are kept the same way, as small entries
+# Old and least recently used files are evicted following a maximum age and a maximum size
+
+# Usage : python validannot_cache.py -s -e
+
+# Arguments :
+# -s or --stats    = print hit and miss counts, number of files and size of the cache
+# -e or --evict    = evict files following the validannot_env cache policy
+
+# Exemple :
+# python validannot_cache.py -s
+
+from validannot_env import cache_path
+from validannot_env import cache_max_size
+from validannot_env import cache_max_age
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+#############
+# Functions #
+#############
+
+class ArtifactCache(object):
+
+    # Argv = cache directory, maximum size in bytes and maximum age in days since last use (None for no limit)
+    def __init__(self, root, max_size=None, max_age=None):
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        self.objects = os.path.join(root, 'objects')
+        self.index_file = os.path.join(root, 'index.json')
+        if not os.path.isdir(self.objects):
+            try:
+                os.makedirs(self.objects)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    # Locks the cache index for all the users and processes
+    # Yields the index, written back when the block ends
+    @contextmanager
+    def index(self):
+        with open(os.path.join(self.root, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.index_file):
+                    with open(self.index_file) as fin:
+                        index = json.load(fin)
+                else:
+                    index = {'objects': {}, 'aliases': {}, 'hits': 0, 'misses': 0}
+                yield index
+                tmp = self.index_file + '.' + str(os.getpid())
+                with open(tmp, 'w') as out:
+                    json.dump(index, out, indent=1, sort_keys=True)
+                os.rename(tmp, self.index_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def object_path(self, name):
+        return os.path.join(self.objects, name[:2], name)
+
+    # Copies a file already in the cache to a destination, counts a hit or a miss
+    # When the remote checksum is known, the file is looked for by its key (source, release, species, checksum) :
+    # a file replaced on the server under the same name is not taken for the cached one
+    # The alias is used only when there is no checksum
+    # Argv = alias (source, release, species, artifact name), destination path and remote checksum (None if unknown)
+    # Returns True if the file was in the cache
+    def fetch(self, alias, dest, checksum=None):
+        with self.index() as index:
+            if checksum is not None:
+                name = hashlib.sha1(alias_key(tuple(alias[:3]) + (checksum,))).hexdigest()
+            else:
+                name = index['aliases'].get(alias_key(alias))
+            if name is None or name not in index['objects'] or not os.path.exists(self.object_path(name)):
+                index['misses'] += 1
+                return False
+            link_or_copy(self.object_path(name), dest)
+            index['objects'][name]['used'] = time.time()
+            index['hits'] += 1
+        logging.info("cache hit for " + alias_key(alias) + " : " + dest)
+        return True
+
+    # Adds a file to the cache, then evicts old files
+    # The file is copied : the cache owns its copy, made read only, the stored file keeps its own inode and mode
+    # Argv = key (source, release, species, checksum), file path and alias (source, release, species, artifact name)
+    def store(self, key, path, alias=None):
+        name = hashlib.sha1(alias_key(key)).hexdigest()
+        target = self.object_path(name)
+        tmp = None
+        if not os.path.exists(target):
+            if not os.path.isdir(os.path.dirname(target)):
+                try:
+                    os.makedirs(os.path.dirname(target))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            # Copied out of the index lock, a large file does not block the other users
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target))
+            os.close(fd)
+            shutil.copyfile(path, tmp)
+            # Read only, a file opened for writing through a hard link given by fetch would change the cache
+            os.chmod(tmp, 0444)
+        with self.index() as index:
+            if tmp is not None:
+                if os.path.exists(target):
+                    os.remove(tmp)
+                else:
+                    os.rename(tmp, target)
+            now = time.time()
+            index['objects'][name] = {'key': list(key), 'size': os.path.getsize(target), 'added': now, 'used': now}
+            if alias is not None:
+                index['aliases'][alias_key(alias)] = name
+            self.evict_index(index)
+        logging.info("cached " + path + " as " + alias_key(key))
+
+    # Reads a small entry (text, answer of a web service) from the cache, counts a hit or a miss
+    # Argv = alias (source, release, kind, name)
+    # Returns the content of the entry, None if it is not in the cache
+    def fetch_data(self, alias):
+        with self.index() as index:
+            name = index['aliases'].get(alias_key(alias))
+            if name is None or name not in index['objects'] or not os.path.exists(self.object_path(name)):
+                index['misses'] += 1
+                return None
+            with open(self.object_path(name), 'rb') as fin:
+                data = fin.read()
+            index['objects'][name]['used'] = time.time()
+            index['hits'] += 1
+        logging.info("cache hit for " + alias_key(alias))
+        return data
+
+    # Adds a small entry to the cache, as store does for a file
+    # Argv = key (source, release, kind, checksum), content and alias (source, release, kind, name)
+    def store_data(self, key, data, alias=None):
+        fd, tmp = tempfile.mkstemp(dir=self.root)
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        try:
+            self.store(key, tmp, alias)
+        finally:
+            os.remove(tmp)
+
+    def evict(self):
+        with self.index() as index:
+            self.evict_index(index)
+
+    # Removes the files not used for max_age days, then the least recently used files above max_size
+    def evict_index(self, index):
+        objects = index['objects']
+        evicted = []
+        if self.max_age is not None:
+            limit = time.time() - self.max_age * 86400
+            evicted.extend(n for n, o in objects.items() if o['used'] < limit)
+        if self.max_size is not None:
+            kept = sorted((o['used'], n) for n, o in objects.items() if n not in evicted)
+            size = sum(objects[n]['size'] for u, n in kept)
+            for u, n in kept:
+                if size <= self.max_size:
+                    break
+                evicted.append(n)
+                size -= objects[n]['size']
+        for n in evicted:
+            logging.info("evicted from cache : " + alias_key(objects[n]['key']))
+            del objects[n]
+            try:
+                os.remove(self.object_path(n))
+            except OSError:
+                pass
+        if evicted:
+            index['aliases'] = dict((a, n) for a, n in index['aliases'].items() if n in objects)
+
+    # Returns hits, misses, number of files and total size of the cache
+    def stats(self):
+        with self.index() as index:
+            return {'hits': index['hits'], 'misses': index['misses'],
+                    'files': len(index['objects']),
+                    'size': sum(o['size'] for o in index['objects'].values())}
+
+
+def alias_key(fields):
+    return "\t".join(str(f) for f in fields)
+
+
+# Hard links a file, copies it if the link is not possible (other file system, no hard link support)
+def link_or_copy(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+# Computes the md5 key of a local file, used as checksum when the server does not give one
+def md5_checksum(path):
+    m = hashlib.md5()
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(1 << 20)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+# Opens the team cache following the validannot_env policy
+def default_cache():
+    return ArtifactCache(cache_path, cache_max_size, cache_max_age)
+
+
+#############
+
+# Arguments and usage
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A script to show and clean the validannot cache of retrieved files')
+    parser.add_argument('-s', '--stats', help='Print hit and miss counts, number of files and size of the cache', action='store_true')
+    parser.add_argument('-e', '--evict', help='Evict files following the cache policy', action='store_true')
+    args = vars(parser.parse_args())
+
+    cache = default_cache()
+    if args['evict']:
+        cache.evict()
+    if args['stats']:
+        stats = cache.stats()
+        requests = stats['hits'] + stats['misses']
+        print "hits   : " + str(stats['hits'])
+        print "misses : " + str(stats['misses'])
+        if requests:
+            print "hit ratio : " + "%.1f" % (100.0 * stats['hits'] / requests) + "%"
+        print "files  : " + str(stats['files'])
+        print "size   : " + str(stats['size']) + " bytes"
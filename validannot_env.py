@@ -13,5 +13,11 @@ log_path = "$HOME/shares-net/sequencages/ressources/validation_genomeannot/log/"
 biomart_path = "$HOME/shares-net/sequencages/ressources/validation_genomeannot/biomart/"
 validation_path = "$HOME/shares-net/sequencages/ressources/validation_genomeannot/validation/"
 
+# Cache of the retrieved release files, shared by all the users
+# Files not used for cache_max_age days are evicted, then the least recently used ones above cache_max_size bytes
+cache_path = "$HOME/shares-net/sequencages/ressources/validation_genomeannot/cache/"
+cache_max_size = 500 * 1024 ** 3
+cache_max_age = 365
+
 
 
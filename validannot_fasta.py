@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# validannot_fasta.py
+# Shared fasta tools for the validannot scripts
+# Sequences are read and written as raw blocks of lines, never as whole sequences : memory does not depend on the chromosome sizes
+
+from validannot_io import BgzfReader
+from validannot_io import is_gzip
+import collections
+import logging
+import mmap
+import os
+import re
+
+
+#############
+# Functions #
+#############
+
+# Gets the name of a sequence from its header line (without > and line end), the first word as Biopython does
+def fasta_name(header):
+    words = header.split(None, 1)
+    return words[0] if words else ''
+
+
+# Reads a fasta file as header lines and blocks of sequence lines
+# A block holds whole lines of a single sequence, at most about the size read at once
+# A line longer than the size read at once (unwrapped sequence) is kept as a list of pieces, joined once its end is read
+# Argv = an open fasta file (open_input) and the size read at once
+# Yields (header, None) for a header line (without > and line end) and (None, block) for sequence lines
+def fasta_blocks(fin, size=1 << 20):
+    pieces = []
+    for data in iter(lambda: fin.read(size), ''):
+        pieces.append(data)
+        if '\n' not in data:
+            continue
+        data = ''.join(pieces)
+        pos = 0
+        while pos < len(data):
+            if data[pos] == '>':
+                eol = data.find('\n', pos)
+                if eol < 0:
+                    break
+                yield data[pos + 1:eol], None
+                pos = eol + 1
+            else:
+                # The sequence lines go on until the next header, or until the last whole line read
+                h = data.find('\n>', pos)
+                if h < 0:
+                    last = data.rfind('\n', pos) + 1
+                    if last > pos:
+                        yield None, data[pos:last]
+                        pos = last
+                    break
+                yield None, data[pos:h + 1]
+                pos = h + 1
+        pieces = [data[pos:]]
+    rest = ''.join(pieces)
+    if rest.startswith('>'):
+        yield rest[1:].rstrip('\n'), None
+    elif rest:
+        yield None, rest + '\n'
+
+
+# Number of bases of a block of sequence lines, line ends (\n or \r\n) not counted
+def block_length(block):
+    return len(block) - block.count('\n') - block.count('\r')
+
+
+# Reads the headers and the sequence lengths of a fasta file, without building any sequence
+# The file can be copied as it is to an output file in the same pass
+# Argv = the open fasta file (open_input) and the output file (None for no copy)
+# Yields (header, length) for each sequence (header without > and line end), once its lines are read
+def scan_fasta(fin, fout=None):
+    header = None
+    length = 0
+    for h, block in fasta_blocks(fin):
+        if h is not None:
+            if header is not None:
+                yield header, length
+            header = h
+            length = 0
+            if fout is not None:
+                fout.write('>' + h + '\n')
+        else:
+            if fout is not None:
+                fout.write(block)
+            length += block_length(block)
+    if header is not None:
+        yield header, length
+
+
+# Checks that the lines of a block are linebases long, but the last one which can be shorter
+# Argv = the block, the number of bases per line and the number of bytes per line (bases and line end, \n or \r\n)
+# Returns 0 if all the lines are linebases long, 1 if the last one is shorter, -1 otherwise
+def block_lines(block, linebases, linewidth):
+    if linebases == 0:
+        return -1
+    full = len(block) // linewidth * linewidth
+    if block.count('\n', 0, full) != full // linewidth or block[linewidth - 1:full:linewidth].count('\n') != full // linewidth:
+        return -1
+    if full == len(block):
+        return 0
+    if block.find('\n', full) == len(block) - 1 and linewidth - linebases < len(block) - full < linewidth:
+        return 1
+    return -1
+
+
+# Path of the chrom.sizes file of a fasta file : Xxxx.fa(.gz) gives Xxxx.chrom.sizes
+def chrom_sizes_path(path):
+    if path.endswith('.gz'):
+        path = path[:-3]
+    for ext in ('.fa', '.fasta', '.fna'):
+        if path.endswith(ext):
+            return path[:-len(ext)] + '.chrom.sizes'
+    return path + '.chrom.sizes'
+
+
+# Filters the sequences of a fasta file in a single pass with constant memory
+# The sequence lines of the kept sequences are copied as they are, their headers can be rewritten
+# The .fai index (samtools faidx) and the chrom.sizes file of the new fasta file are written at the same time
+# Argv = the open fasta file (open_input), the output file (open_output),
+# a function getting a header (without > and line end) and returning the new header, None if the sequence is not kept,
+# the .fai and chrom.sizes paths (None to not write them)
+# Returns the list of (name, length) of the kept sequences
+def filter_fasta(fin, fout, select, fai=None, sizes=None):
+    # name, length, offset of the first base, bases per line, bytes per line, and the state of the lines (0 regular, 1 short line read, -1 irregular)
+    entries = []
+    entry = None
+    offset = 0
+    for header, block in fasta_blocks(fin):
+        if header is not None:
+            new = select(header)
+            entry = None
+            if new is not None:
+                line = '>' + new + '\n'
+                fout.write(line)
+                offset += len(line)
+                entry = [fasta_name(new), 0, offset, 0, 0, 0]
+                entries.append(entry)
+        elif entry is not None:
+            fout.write(block)
+            offset += len(block)
+            entry[1] += block_length(block)
+            if entry[4] == 0:
+                entry[4] = block.find('\n') + 1
+                entry[3] = entry[4] - 2 if block[entry[4] - 2:entry[4]] == '\r\n' else entry[4] - 1
+            if entry[5] == 0:
+                entry[5] = block_lines(block, entry[3], entry[4])
+            else:
+                # A short line is the last line of a sequence
+                entry[5] = -1
+    if fai is not None:
+        irregular = [e[0] for e in entries if e[5] < 0]
+        if irregular:
+            logging.info("Lines of different lengths in " + ','.join(irregular) + ", no index written : " + fai)
+        else:
+            with open(fai, 'w') as out:
+                for e in entries:
+                    out.write("%s\t%d\t%d\t%d\t%d\n" % tuple(e[:5]))
+            logging.info("Index written : " + fai)
+    if sizes is not None:
+        with open(sizes, 'w') as out:
+            for e in entries:
+                out.write("%s\t%d\n" % (e[0], e[1]))
+        logging.info("Chromosome sizes written : " + sizes)
+    return [(e[0], e[1]) for e in entries]
+
+
+# Writes the .fai index of a plain fasta file (samtools faidx), reading it by blocks
+# Argv = the fasta file
+# Returns the .fai path
+def index_fasta(path):
+    if is_gzip(path):
+        raise ValueError(path + " is compressed, its .fai index is written with it (-z)")
+    with open(path, 'rb') as fin:
+        with open(os.devnull, 'w') as null:
+            filter_fasta(fin, null, lambda header: header, path + '.fai')
+    if not os.path.isfile(path + '.fai'):
+        raise ValueError(path + " can not be indexed, its lines are of different lengths")
+    return path + '.fai'
+
+
+# Parses a region : chr, chr:start or chr:start-end, 1-based positions, end included as in samtools faidx
+# Returns (name, start, end), start and end None when they are not given
+def parse_region(region):
+    m = re.match(r'^(.+?)(?::(\d+)(?:-(\d+))?)?$', region.strip())
+    if m is None:
+        raise ValueError("Bad region : " + region)
+    name, start, end = m.groups()
+    return name, int(start) if start else None, int(end) if end else None
+
+
+# Random access to the sequences of a fasta file with its .fai index (samtools faidx)
+# A plain file is memory mapped, a bgzf file is read by blocks with its .gzi index
+# A region is read from its first to its last base only, whatever the size of the chromosome
+class FastaIndex(object):
+
+    # Argv = fasta file path, plain or bgzf, the .fai index is written for a plain file without index
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isfile(path + '.fai'):
+            index_fasta(path)
+        # name : (length, offset, bases per line, bytes per line)
+        self.entries = collections.OrderedDict()
+        with open(path + '.fai') as fai:
+            for line in fai:
+                fields = line.rstrip('\n').split('\t')
+                self.entries[fields[0]] = tuple(int(f) for f in fields[1:5])
+        self.bgzf = None
+        if is_gzip(path):
+            self.bgzf = BgzfReader(path)
+        else:
+            self.fin = open(path, 'rb')
+            self.map = mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Returns the bytes of the file from start to end
+    def read(self, start, end):
+        if self.bgzf is not None:
+            return self.bgzf.read(start, end)
+        return self.map[start:end]
+
+    # Checks a region against the sequence length
+    # Argv = sequence name, 1-based start and end (None for the beginning and the end of the sequence)
+    # Returns (name, start, end) as 0-based offsets, end excluded, in the sequence
+    def locate(self, name, start=None, end=None):
+        if name not in self.entries:
+            raise ValueError("No sequence " + name + " in " + self.path)
+        length = self.entries[name][0]
+        start = 0 if start is None else max(start - 1, 0)
+        end = length if end is None else min(end, length)
+        return name, start, max(start, end)
+
+    # Byte offset of a base of a sequence in the file
+    def offset(self, name, pos):
+        length, offset, linebases, linewidth = self.entries[name]
+        return offset + pos // linebases * linewidth + pos % linebases
+
+    # Gets the bases of a region
+    # Argv = sequence name, 1-based start and end (None for the beginning and the end of the sequence)
+    # Returns the bases, without line ends
+    def fetch(self, name, start=None, end=None):
+        name, start, end = self.locate(name, start, end)
+        if start == end:
+            return ''
+        return self.read(self.offset(name, start), self.offset(name, end - 1) + 1).translate(None, '\r\n')
+
+    # Gets the bases of several regions, read in the file order
+    # Argv = a list of (name, start, end) as for fetch
+    # Returns the list of the bases, in the order of the regions
+    def fetch_regions(self, regions):
+        located = [self.locate(*r) for r in regions]
+        order = sorted(range(len(located)), key=lambda i: (self.entries[located[i][0]][1], located[i][1]))
+        bases = [None] * len(located)
+        for i in order:
+            bases[i] = self.fetch(located[i][0], located[i][1] + 1, located[i][2])
+        return bases
+
+    def close(self):
+        if self.bgzf is not None:
+            self.bgzf.close()
+        else:
+            self.map.close()
+            self.fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,578 @@
+#!/usr/bin/python
+
+# validannot_ftp.py
+# Shared ftp tools : a bounded pool of ftp sessions and a concurrent transfer engine
+# Needs to be included in the validannot retrieve scripts
+
+import datetime
+import fcntl
+import functools
+import json
+import logging
+import os
+import posixpath
+import shutil
+import threading
+import time
+import Queue
+from validannot_io import GzipDecoder
+from validannot_io import split_lines
+from collections import namedtuple
+from contextlib import contextmanager
+from ftplib import FTP, all_errors, error_perm
+from multiprocessing.pool import ThreadPool
+
+
+# Remote file from a directory listing, mtime being 'YYYYMMDDHHMMSS' (UTC) or None if the server does not give it
+RemoteFile = namedtuple('RemoteFile', ['name', 'size', 'mtime'])
+
+# Outcome of one transfer, status is 'downloaded', 'resumed' or 'cached'
+# checksum is the server checksum of the file when the server gives one, None otherwise
+TransferResult = namedtuple('TransferResult', ['remote', 'local', 'nbytes', 'elapsed', 'status', 'checksum'])
+
+
+#############
+# Functions #
+#############
+
+# Ftp connexion
+# Argv = host name and port
+# Returns a logged in ftp session
+def ftp_connect(url, port=21):
+    ftp = FTP()
+    ftp.connect(url, port)
+    ftp.login()
+    logging.info(ftp.getwelcome())
+    return ftp
+
+
+# Ensembl ftp server of a type of organism
+def ensembl_host(t):
+    if t == 'generic':
+        return 'ftp.ensembl.org'
+    else:
+        return 'ftp.ensemblgenomes.org'
+
+def ftp_defdir(t):
+    if t == 'generic':
+        d ='pub'
+    elif t == 'plants':
+        d ='pub/plants/'
+    elif t == 'metazoa':
+        d = 'pub/metazoa/'
+    elif t == 'fungi':
+        d = 'pub/fungi/'
+    elif t == 'protists':
+        d = 'pub/protists/'
+    elif t == 'bacteria':
+        d= 'pub/bacteria/'
+    return d
+
+# Absolute release directory, sessions coming from the pool may be anywhere on the server
+def ftp_releasedir(t, v):
+    return posixpath.join('/', ftp_defdir(t), "release" + "-" + str(v))
+
+
+# Bounded pool of ftp sessions opened on a single host
+# Sessions are opened on demand, never more than size at the same time, and reused once released
+class FtpPool(object):
+
+    def __init__(self, host, size=5, port=21):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    # Gets an idle session or opens a new one, waits if size sessions are already in use
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    ftp = self._idle.get_nowait()
+                except Queue.Empty:
+                    return ftp_connect(self.host, self.port)
+                # Idle sessions can be dropped by the server
+                try:
+                    ftp.voidcmd('NOOP')
+                    return ftp
+                except all_errors:
+                    close_quietly(ftp)
+        except:
+            self._slots.release()
+            raise
+
+    # Gives a session back to the pool, back to the root directory
+    # A broken session is closed instead
+    def release(self, ftp, broken=False):
+        try:
+            if broken:
+                close_quietly(ftp)
+            else:
+                try:
+                    ftp.cwd('/')
+                    self._idle.put(ftp)
+                except all_errors:
+                    close_quietly(ftp)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def session(self):
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except:
+            self.release(ftp, broken=True)
+            raise
+        self.release(ftp)
+
+    def close(self):
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except all_errors:
+                pass
+            close_quietly(ftp)
+
+
+def close_quietly(ftp):
+    try:
+        ftp.close()
+    except all_errors:
+        pass
+
+
+# Runs transfer tasks at the same time on the sessions of a pool
+# Argv = the pool and a list of tasks, each task being a callable taking an ftp session
+# Returns the list of the task results in the task order
+def run_transfers(pool, tasks):
+    return schedule_transfers([(pool, task) for task in tasks], pool.size)
+
+
+# Runs transfer tasks on a bounded number of workers, each task on a session of its own pool (one pool per host)
+# Argv = a list of (pool, task), each task being a callable taking an ftp session, and the number of workers
+# Returns the list of the task results in the task order
+def schedule_transfers(jobs, workers):
+    def run(job):
+        pool, task = job
+        with pool.session() as ftp:
+            return task(ftp)
+    if len(jobs) <= 1 or workers <= 1:
+        return [run(job) for job in jobs]
+    threads = ThreadPool(min(workers, len(jobs)))
+    try:
+        return threads.map(run, jobs, 1)
+    finally:
+        threads.close()
+        threads.join()
+
+
+# Directory listings already read, by host and directory
+listings = {}
+listings_lock = threading.Lock()
+
+# Lists the file names of a remote directory once per host and per run, the session ends in this directory
+# Argv = the ftp session and the absolute remote directory
+# Returns the file names
+def list_directory(ftp, ftpdir):
+    ftp.cwd(ftpdir)
+    key = (ftp.host, ftpdir)
+    with listings_lock:
+        if key in listings:
+            return listings[key]
+    files = []
+    ftp.retrlines('NLST', files.append)
+    with listings_lock:
+        listings[key] = files
+    return files
+
+
+# Gets the size of a remote file in the current directory of the ftp session
+# Returns the size or None if the server does not give it
+def remote_size(ftp, remote):
+    try:
+        ftp.voidcmd('TYPE I')
+        return ftp.size(remote)
+    except all_errors:
+        return None
+
+
+# Downloads a remote file in the current directory of the ftp session
+# The file is written to local.part and renamed once complete, an existing local.part is resumed with REST
+# Argv = the ftp session, the remote file name and the local file path
+# Returns a TransferResult
+def retrieve_file(ftp, remote, local):
+    part = local + '.part'
+    expected = remote_size(ftp, remote)
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        if expected is None or offset > expected:
+            offset = 0
+    # The part file exists even for an empty remote file, which gives an empty local file
+    open(part, 'ab').close()
+    start = time.time()
+    if expected is not None and offset == expected:
+        nbytes = 0
+    else:
+        try:
+            nbytes = retrieve_range(ftp, remote, part, offset)
+        except error_perm:
+            if not offset:
+                raise
+            # REST refused, restart from zero
+            offset = 0
+            nbytes = retrieve_range(ftp, remote, part, 0)
+    elapsed = time.time() - start
+    check_size(part, expected)
+    os.rename(part, local)
+    logging.info("retrieved " + remote + " (" + str(nbytes) + " bytes in " + "%.1f" % elapsed + "s)")
+    status = 'resumed' if offset else 'downloaded'
+    return TransferResult(posixpath.join(ftp.pwd(), remote), local, nbytes, elapsed, status, None)
+
+
+# Downloads a remote file from a byte offset and appends it to a local file
+# Stops after length bytes if a length is given
+# Argv = the ftp session, the remote file name, the local file path, the offset and the length
+# Returns the number of bytes written
+def retrieve_range(ftp, remote, local, offset, length=None):
+    written = 0
+    ftp.voidcmd('TYPE I')
+    conn = ftp.transfercmd('RETR ' + remote, rest=offset or None)
+    try:
+        with open(local, 'ab' if offset else 'wb') as out:
+            while length is None or written < length:
+                size = 65536 if length is None else min(65536, length - written)
+                block = conn.recv(size)
+                if not block:
+                    break
+                out.write(block)
+                written += len(block)
+    finally:
+        conn.close()
+    # The server ends the transfer (226) or notices the closed connection (426) when stopped early
+    try:
+        ftp.voidresp()
+    except all_errors:
+        if length is None:
+            raise
+    return written
+
+
+# Checks that a local file has the expected size
+# Raises an IOError if not, nothing is checked if the expected size is None
+def check_size(path, expected):
+    if expected is not None and os.path.getsize(path) != expected:
+        raise IOError(path + " has " + str(os.path.getsize(path)) + " bytes, " + str(expected) + " expected")
+
+
+# Downloads a remote file in the current directory of the ftp session as several byte ranges at the same time
+# The first range uses the ftp session, the other ones use their own sessions
+# Each range is written to local.part.N, resumed if it exists, then the ranges are joined and checked against the remote size
+# Argv = the ftp session, the remote file name, the local file path and the number of ranges
+# Returns a TransferResult
+def retrieve_segmented(ftp, remote, local, segments):
+    expected = remote_size(ftp, remote)
+    if expected is None or segments <= 1 or expected < segments:
+        return retrieve_file(ftp, remote, local)
+    ftpdir = ftp.pwd()
+    step = expected // segments
+    ranges = [(i * step, expected - i * step if i == segments - 1 else step) for i in range(segments)]
+    parts = [local + '.part.' + str(i) for i in range(segments)]
+
+    def fetch(session, i):
+        start, length = ranges[i]
+        done = os.path.getsize(parts[i]) if os.path.exists(parts[i]) else 0
+        if done > length:
+            done = 0
+        if done == length:
+            return 0
+        if session is not ftp:
+            session.cwd(ftpdir)
+        return retrieve_range(session, remote, parts[i], start + done, length - done)
+
+    start = time.time()
+    pool = FtpPool(ftp.host, segments - 1, port=ftp.port)
+    tasks = [functools.partial(fetch, i=i) for i in range(1, segments)]
+    workers = ThreadPool(1)
+    try:
+        others = workers.apply_async(run_transfers, (pool, tasks))
+        nbytes = fetch(ftp, 0) + sum(others.get())
+    finally:
+        workers.close()
+        workers.join()
+        pool.close()
+    for i in range(segments):
+        check_size(parts[i], ranges[i][1])
+    # Joins the ranges on the first one
+    with open(parts[0], 'ab') as out:
+        for p in parts[1:]:
+            with open(p, 'rb') as fin:
+                shutil.copyfileobj(fin, out, 1 << 20)
+    check_size(parts[0], expected)
+    os.rename(parts[0], local)
+    for p in parts[1:]:
+        os.remove(p)
+    elapsed = time.time() - start
+    logging.info("retrieved " + remote + " in " + str(segments) + " ranges (" + str(nbytes) + " bytes in " + "%.1f" % elapsed + "s)")
+    return TransferResult(posixpath.join(ftpdir, remote), local, nbytes, elapsed, 'downloaded', None)
+
+
+# Downloads the files of a remote directory whose name ends with a suffix
+# Large files can be downloaded as several byte ranges at the same time
+# Argv = the ftp session, the absolute remote directory, the file suffix, the local file path and the number of ranges
+# Returns the list of TransferResult
+def retrieve_matching(ftp, ftpdir, suffix, file_out, segments=1):
+    results = []
+    files = list_directory(ftp, ftpdir)
+    logging.info(ftp.pwd())
+    checksums = remote_checksums(ftp, files)
+    for f in files:
+        if f.endswith(suffix):
+            logging.info(f)
+            if segments > 1:
+                r = retrieve_segmented(ftp, f, file_out, segments)
+            else:
+                r = retrieve_file(ftp, f, file_out)
+            results.append(r._replace(checksum=checksums.get(f)))
+    return results
+
+
+# Reads the checksum file of the current directory of the ftp session
+# Ensembl gives a CHECKSUMS file (sum output), NCBI a md5checksums.txt file (md5sum output)
+# Argv = the ftp session and the file names of the directory
+# Returns a dictionary containing filename:checksum, empty if there is no checksum file
+def remote_checksums(ftp, files):
+    checksums = {}
+    lines = []
+    if 'CHECKSUMS' in files:
+        ftp.retrlines('RETR CHECKSUMS', lines.append)
+        for line in lines:
+            col = line.split()
+            if len(col) == 3:
+                checksums[col[2]] = col[0] + "-" + col[1]
+    elif 'md5checksums.txt' in files:
+        ftp.retrlines('RETR md5checksums.txt', lines.append)
+        for line in lines:
+            col = line.split()
+            if len(col) == 2:
+                checksums[posixpath.basename(col[1])] = col[0]
+    return checksums
+
+
+# Streams the lines of a remote gzipped file while it is downloaded, nothing is written to disk
+# The download and the decompression run in a thread, the lines can be processed during the transfer
+# A transfer ended before the remote size raises IOError after the last lines
+# When the lines are not read to the end (error, generator closed), the transfer is aborted and the thread joined :
+# the ftp session can be used or quit at once
+# Argv = the ftp session, the remote file name in the current directory
+# Yields the decompressed lines
+def stream_gzip_lines(ftp, remote):
+    blocks = Queue.Queue(64)
+    stopped = threading.Event()
+    expected = remote_size(ftp, remote)
+
+    # Returns False if the lines are no longer read
+    def put(item):
+        while not stopped.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def download():
+        decoder = GzipDecoder()
+        received = 0
+        try:
+            ftp.voidcmd('TYPE I')
+            conn = ftp.transfercmd('RETR ' + remote)
+            try:
+                while True:
+                    block = conn.recv(1 << 16)
+                    if not block:
+                        break
+                    received += len(block)
+                    if not put(decoder.decompress(block)):
+                        break
+            finally:
+                conn.close()
+            if stopped.is_set():
+                # The data connection is closed : the server drops the transfer (426), the session stays usable
+                try:
+                    ftp.voidresp()
+                except all_errors:
+                    pass
+                return
+            ftp.voidresp()
+            if expected is not None and received != expected:
+                raise IOError(remote + " : " + str(received) + " bytes received, " + str(expected) + " expected")
+            put(decoder.flush())
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def received():
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    thread = threading.Thread(target=download)
+    thread.daemon = True
+    thread.start()
+    try:
+        for line in split_lines(received()):
+            yield line
+    finally:
+        stopped.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        thread.join()
+
+
+# Lists the optional commands of the server (FEAT)
+# Returns the set of command names, empty if the server does not answer FEAT
+def server_features(ftp):
+    try:
+        resp = ftp.sendcmd('FEAT')
+    except all_errors:
+        return set()
+    return set(line.split()[0].upper() for line in resp.splitlines()[1:-1] if line.strip())
+
+
+# Lists the files of the current directory of the ftp session with their size and modification time, in a single pass
+# Uses MLSD when the server offers it (MLST feature), else NLST with SIZE and MDTM, else the LIST output
+# Argv = the ftp session
+# Returns a dictionary containing filename:RemoteFile
+def list_remote_files(ftp):
+    features = server_features(ftp)
+    files = {}
+    if 'MLST' in features:
+        lines = []
+        ftp.retrlines('MLSD', lines.append)
+        for line in lines:
+            facts, _, name = line.partition(' ')
+            facts = dict(f.split('=', 1) for f in facts.lower().split(';') if '=' in f)
+            if facts.get('type') == 'file':
+                size = int(facts['size']) if 'size' in facts else None
+                mtime = facts['modify'][:14] if 'modify' in facts else None
+                files[name] = RemoteFile(name, size, mtime)
+    elif 'SIZE' in features or 'MDTM' in features:
+        ftp.voidcmd('TYPE I')
+        for name in ftp.nlst():
+            size = None
+            mtime = None
+            try:
+                if 'SIZE' in features:
+                    size = ftp.size(name)
+                if 'MDTM' in features:
+                    mtime = ftp.sendcmd('MDTM ' + name).split()[1][:14]
+            except all_errors:
+                # A directory
+                continue
+            files[name] = RemoteFile(name, size, mtime)
+    else:
+        lines = []
+        ftp.dir(lines.append)
+        for line in lines:
+            r = parse_list_line(line)
+            if r is not None:
+                files[r.name] = r
+    return files
+
+
+# Parses a line of a unix like LIST output
+# The time of day is lost and the year is the current one for recent files
+# Returns a RemoteFile or None for directories
+def parse_list_line(line):
+    corresponding_month = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06', 'Jul': '07',
+                           'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+    col = line.split(None, 8)
+    if len(col) < 9 or col[0].startswith('d'):
+        return None
+    # Format date
+    if ":" in col[7]:
+        year = str(datetime.datetime.now().year)
+    else:
+        year = col[7]
+    month = corresponding_month[col[5]]
+    day = col[6].zfill(2)
+    return RemoteFile(col[8], int(col[4]), year + month + day + "000000")
+
+
+# Persistent manifest of the files retrieved in a local directory
+# For each local file : the server size, modification time and md5 when the file was retrieved, and the local size and modification time
+# A file is known unchanged when the server gives the same values and the local file was not modified, without reading it
+class LocalManifest(object):
+
+    def __init__(self, directory, name='.validannot_manifest.json'):
+        self.path = os.path.join(directory, name)
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as fin:
+                return json.load(fin)
+        return {}
+
+    # Locks the manifest for all the threads and processes retrieving in the same directory
+    # Yields the entries read again from the file, written back when the block ends
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    entries = self.load()
+                    yield entries
+                    tmp = self.path + '.' + str(os.getpid())
+                    with open(tmp, 'w') as out:
+                        json.dump(entries, out, indent=1, sort_keys=True)
+                    os.rename(tmp, self.path)
+                    self.entries = entries
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Argv = the local file path, the RemoteFile and the server md5 (None if unknown)
+    # Returns True if the local file is the same as the server file
+    def unchanged(self, local, remote, md5=None):
+        if not os.path.exists(local):
+            return False
+        st = os.stat(local)
+        with self.lock:
+            e = self.entries.get(os.path.basename(local))
+        if e is None:
+            # Retrieved before the manifest existed, only the size can be compared
+            return remote.size is not None and st.st_size == remote.size
+        if e['local_size'] != st.st_size or e['local_mtime'] != int(st.st_mtime):
+            return False
+        if remote.size is not None and e['size'] != remote.size:
+            return False
+        if remote.mtime is not None and e['mtime'] != remote.mtime:
+            return False
+        if md5 is not None and e['md5'] is not None and e['md5'] != md5:
+            return False
+        return True
+
+    # Records a local file just retrieved, the manifest is written at once
+    # The entries written meanwhile by another process are kept
+    def record(self, local, remote, md5=None):
+        st = os.stat(local)
+        with self.locked() as entries:
+            entries[os.path.basename(local)] = {'size': remote.size, 'mtime': remote.mtime, 'md5': md5,
+                                                'local_size': st.st_size, 'local_mtime': int(st.st_mtime)}
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+
+# validannot_ftpserver.py
+# Local ftp stand-in serving a directory tree, to test and benchmark the retrieve scripts offline
+# Only the read only commands used by ftplib are implemented, with an optional bandwidth limit per data connection
+
+# Usage : python validannot_ftpserver.py -r root_directory -p port -b bytes_per_second
+
+# Arguments :
+# -r or --root        = directory served as the ftp root
+# -p or --port        = listening port (default=2121)
+# -b or --bandwidth   = bandwidth limit per data connection in bytes per second (default=0, no limit)
+
+# Exemple :
+# python validannot_ftpserver.py -r /tmp/ensembl_mirror -p 2121 -b 2000000
+
+import argparse
+import os
+import posixpath
+import socket
+import SocketServer
+import threading
+import time
+
+
+#############
+# Functions #
+#############
+
+class FtpStandinHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.cwd = '/'
+        self.rest = 0
+        self.passive = None
+        self.reply('220 ValidAnnot ftp stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            cmd, _, arg = line.strip().partition(' ')
+            method = getattr(self, 'ftp_' + cmd.upper(), None)
+            if method is None:
+                self.reply('502 Command not implemented')
+            elif method(arg) is False:
+                break
+        self.close_passive()
+
+    def reply(self, text):
+        self.wfile.write(text + '\r\n')
+        self.wfile.flush()
+
+    # Maps a client path on the served directory, without going above it
+    def local_path(self, arg):
+        path = posixpath.normpath(posixpath.join(self.cwd, arg or '.'))
+        return path, os.path.join(self.server.root, path.lstrip('/'))
+
+    def close_passive(self):
+        if self.passive is not None:
+            self.passive.close()
+            self.passive = None
+
+    def data_connection(self):
+        if self.passive is None:
+            self.reply('425 Use PASV first')
+            return None
+        conn, _ = self.passive.accept()
+        self.close_passive()
+        return conn
+
+    def ftp_USER(self, arg):
+        self.reply('331 Anonymous login ok')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Logged in')
+
+    def ftp_SYST(self, arg):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 Type set to ' + arg)
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 NOOP ok')
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "' + self.cwd + '" is the current directory')
+
+    def ftp_CWD(self, arg):
+        path, local = self.local_path(arg)
+        if os.path.isdir(local):
+            self.cwd = path
+            self.reply('250 Directory changed to ' + path)
+        else:
+            self.reply('550 No such directory')
+
+    def ftp_CDUP(self, arg):
+        self.ftp_CWD('..')
+
+    def ftp_PASV(self, arg):
+        self.close_passive()
+        self.passive = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.passive.bind((self.server.server_address[0], 0))
+        self.passive.listen(1)
+        host, port = self.passive.getsockname()
+        self.reply('227 Entering Passive Mode (' + host.replace('.', ',') + ',' + str(port >> 8) + ',' + str(port & 255) + ')')
+
+    def ftp_NLST(self, arg):
+        path, local = self.local_path(arg)
+        if not os.path.isdir(local):
+            self.reply('550 No such directory')
+            return
+        self.send_lines(sorted(os.listdir(local)))
+
+    def ftp_LIST(self, arg):
+        path, local = self.local_path(arg)
+        if not os.path.isdir(local):
+            self.reply('550 No such directory')
+            return
+        lines = []
+        for name in sorted(os.listdir(local)):
+            st = os.stat(os.path.join(local, name))
+            mode = 'drwxr-xr-x' if os.path.isdir(os.path.join(local, name)) else '-rw-r--r--'
+            date = time.strftime('%b %d %Y', time.gmtime(st.st_mtime))
+            lines.append(' '.join([mode, '1', 'ftp', 'ftp', str(st.st_size), date, name]))
+        self.send_lines(lines)
+
+    def send_lines(self, lines):
+        self.reply('150 Here comes the listing')
+        conn = self.data_connection()
+        if conn is None:
+            return
+        conn.sendall(''.join(l + '\r\n' for l in lines))
+        conn.close()
+        self.reply('226 Transfer complete')
+
+    def ftp_RETR(self, arg):
+        path, local = self.local_path(arg)
+        rest, self.rest = self.rest, 0
+        if not os.path.isfile(local):
+            self.reply('550 No such file')
+            self.close_passive()
+            return
+        self.reply('150 Opening BINARY mode data connection for ' + path)
+        conn = self.data_connection()
+        if conn is None:
+            return
+        bandwidth = self.server.bandwidth
+        start = time.time()
+        sent = 0
+        try:
+            with open(local, 'rb') as fin:
+                fin.seek(rest)
+                while True:
+                    block = fin.read(65536)
+                    if not block:
+                        break
+                    conn.sendall(block)
+                    sent += len(block)
+                    if bandwidth:
+                        delay = sent / float(bandwidth) - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+        except socket.error:
+            conn.close()
+            self.reply('426 Connection closed; transfer aborted')
+            return
+        conn.close()
+        self.reply('226 Transfer complete')
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply('350 Restarting at ' + arg)
+
+    def ftp_SIZE(self, arg):
+        path, local = self.local_path(arg)
+        if os.path.isfile(local):
+            self.reply('213 ' + str(os.path.getsize(local)))
+        else:
+            self.reply('550 No such file')
+
+    def ftp_MDTM(self, arg):
+        path, local = self.local_path(arg)
+        if os.path.isfile(local):
+            self.reply('213 ' + time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(local))))
+        else:
+            self.reply('550 No such file')
+
+    def ftp_FEAT(self, arg):
+        self.wfile.write('211-Features:\r\n MDTM\r\n MLST type*;size*;modify*;\r\n REST STREAM\r\n SIZE\r\n')
+        self.reply('211 End')
+
+    def ftp_MLSD(self, arg):
+        path, local = self.local_path(arg)
+        if not os.path.isdir(local):
+            self.reply('550 No such directory')
+            return
+        lines = []
+        for name in sorted(os.listdir(local)):
+            st = os.stat(os.path.join(local, name))
+            kind = 'dir' if os.path.isdir(os.path.join(local, name)) else 'file'
+            modify = time.strftime('%Y%m%d%H%M%S', time.gmtime(st.st_mtime))
+            lines.append('type=' + kind + ';size=' + str(st.st_size) + ';modify=' + modify + '; ' + name)
+        self.send_lines(lines)
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Goodbye')
+        return False
+
+
+class FtpStandinServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, bandwidth=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), FtpStandinHandler)
+        self.root = os.path.abspath(root)
+        self.bandwidth = bandwidth
+
+
+# Starts a stand-in server in a background thread
+# Argv = served directory, listening port (0 for any free port) and bandwidth limit per data connection
+# Returns the server, its port being server.server_address[1]
+def start_standin_server(root, port=0, bandwidth=0):
+    server = FtpStandinServer(root, port=port, bandwidth=bandwidth)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+#############
+
+# Arguments and usage
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='A local ftp stand-in server to test the retrieve scripts offline')
+    parser.add_argument('-r', '--root', help='Directory served as the ftp root', required=True)
+    parser.add_argument('-p', '--port', help='Listening port (default=2121)', type=int, default=2121)
+    parser.add_argument('-b', '--bandwidth', help='Bandwidth limit per data connection in bytes per second (default=0, no limit)', type=int, default=0)
+    args = vars(parser.parse_args())
+
+    server = FtpStandinServer(args['root'], port=args['port'], bandwidth=args['bandwidth'])
+    server.serve_forever()
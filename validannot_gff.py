@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+# validannot_gff.py
+# Shared gff3 tools for the validannot scripts
+# Compact gff3 records, the attribute column being parsed only when an attribute is asked for (format_ncbi_fasta_from_gffid.py, validannot_stats.py)
+# Raw Ensembl gff3 files are rewritten following declarative rules, compiled once into a single pass rewriter
+
+from validannot_io import is_gzip
+from validannot_io import line_ranges
+from validannot_io import open_input
+from validannot_io import read_range
+import fnmatch
+import json
+import logging
+import os
+import re
+
+
+#############
+# Functions #
+#############
+
+# A feature of a gff3 file
+# seqid, source and type are interned (one string for all the features of a chromosome or of a type), start and end are integers
+# The attribute column is kept as it is until an attribute is asked for
+class GffRecord(object):
+
+    __slots__ = ('seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'column9', 'parsed')
+
+    # Argv = the 9 gff fields
+    def __init__(self, gff_fields):
+        self.seqid = intern(gff_fields[0])
+        self.source = intern(gff_fields[1])
+        self.type = intern(gff_fields[2])
+        self.start = int(gff_fields[3])
+        self.end = int(gff_fields[4])
+        self.score = gff_fields[5]
+        self.strand = gff_fields[6]
+        self.phase = gff_fields[7]
+        self.column9 = gff_fields[8] if len(gff_fields) > 8 else ''
+        self.parsed = None
+
+    # Returns the value of an attribute, default if the feature does not have it
+    def attribute(self, key, default=None):
+        if self.parsed is None:
+            self.parsed = parse_attributes(self.column9)
+        return self.parsed.get(key, default)
+
+    # Returns the 9 gff fields
+    def fields(self):
+        return [self.seqid, self.source, self.type, str(self.start), str(self.end), self.score, self.strand, self.phase, self.column9]
+
+
+# Parses a gff3 attribute column, values are kept as they are (url escaped)
+# Returns a dictionary containing key:value
+def parse_attributes(column9):
+    attributes = {}
+    for a in column9.split(';'):
+        key, sep, value = a.partition('=')
+        if sep:
+            attributes[key] = value
+    return attributes
+
+
+# Reads the features of gff3 lines, comment and header lines are skipped
+# Features of other types are skipped before any record is built
+# Argv = the lines (an open file) and the wanted types (None for all)
+# Yields a GffRecord for each feature
+def read_gff(lines, types=None):
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        gff_fields = line.strip().split('\t', 8)
+        if len(gff_fields) < 8 or (types is not None and gff_fields[2] not in types):
+            continue
+        yield GffRecord(gff_fields)
+
+
+# Gets the seqid of a gff3 line without splitting the other fields
+def gff_seqid(line):
+    return line[:line.find('\t')]
+
+
+# Sidecar index of a gff3 file, written next to it as file.index.json
+# It is valid as long as the size and the modification time of the file do not change
+# It holds :
+#   chromosomes : the seqids of the chromosome features, without _ (Ensembl regular chromosomes)
+#   types : the number of features of each type
+#   seqids : the byte ranges [start, end] of the lines of each seqid, plain files only (None for gzipped files)
+def gff_index_path(path):
+    return path + '.index.json'
+
+
+# Reads the sidecar index of a gff3 file
+# Returns the index, None if there is no index or if the file changed since
+def read_gff_index(path):
+    try:
+        with open(gff_index_path(path)) as fin:
+            index = json.load(fin)
+    except (IOError, ValueError):
+        return None
+    st = os.stat(path)
+    if index.get('size') != st.st_size or index.get('mtime') != st.st_mtime:
+        return None
+    return index
+
+
+# Indexes the lines of a gff3 file
+# Comment lines (### between the genes of Ensembl files) stay in the byte range of the feature before them
+# Argv = the lines, the offset of the first line (None if the byte offsets are unknown)
+# Returns an index without size and mtime, with the byte range of the comment lines before the first feature (lead)
+# and the seqid whose range ends at the end of the lines (last), used to merge consecutive parts
+def index_gff_lines(lines, offset=None):
+    index = {'chromosomes': [], 'types': {}, 'seqids': {} if offset is not None else None, 'lead': [offset, offset], 'last': None}
+    types = index['types']
+    seqids = index['seqids']
+    ranges = None
+    for line in lines:
+        start = offset
+        if offset is not None:
+            offset += len(line)
+        if line.startswith('#'):
+            if ranges is None:
+                index['lead'][1] = offset
+            elif ranges[-1][1] == start:
+                ranges[-1][1] = offset
+            continue
+        gff_fields = line.split('\t', 3)
+        if len(gff_fields) < 4:
+            continue
+        seqid = gff_fields[0]
+        types[gff_fields[2]] = types.get(gff_fields[2], 0) + 1
+        if gff_fields[2] == 'chromosome' and not '_' in seqid:
+            index['chromosomes'].append(seqid)
+        if seqids is not None:
+            ranges = seqids.setdefault(seqid, [])
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = offset
+            else:
+                ranges.append([start, offset])
+            index['last'] = seqid
+    if ranges is None or ranges[-1][1] != offset:
+        index['last'] = None
+    return index
+
+
+# Indexes a byte range of a plain gff3 file, run by the worker processes
+def index_gff_range(path, start, end):
+    return index_gff_lines(read_range(path, start, end), start)
+
+
+# Merges the indexes of consecutive parts of a gff3 file
+# Returns the same index as the whole file indexed at once
+def merge_gff_indexes(parts):
+    index = {'chromosomes': [], 'types': {}, 'seqids': {}, 'lead': None, 'last': None}
+    for part in parts:
+        if index['lead'] is None:
+            index['lead'] = part['lead']
+        elif index['last'] is not None and index['seqids'][index['last']][-1][1] == part['lead'][0]:
+            # Comment lines at the beginning of the part follow the last feature of the previous part
+            index['seqids'][index['last']][-1][1] = part['lead'][1]
+        index['chromosomes'].extend(part['chromosomes'])
+        for t, n in part['types'].items():
+            index['types'][t] = index['types'].get(t, 0) + n
+        for seqid, ranges in part['seqids'].items():
+            merged = index['seqids'].setdefault(seqid, [])
+            for r in ranges:
+                if merged and merged[-1][1] == r[0]:
+                    merged[-1][1] = r[1]
+                else:
+                    merged.append(r)
+        if part['last'] is not None:
+            index['last'] = part['last']
+        elif part['seqids'] or index['last'] is None or index['seqids'][index['last']][-1][1] != part['lead'][1]:
+            index['last'] = None
+    return index
+
+
+# Builds the sidecar index of a gff3 file and writes it next to the file when possible
+# A plain file can be indexed by parts on a pool of processes
+# Argv = the gff3 file, a multiprocessing pool (None to index in this process) and the number of parts
+# Returns the index
+def build_gff_index(path, pool=None, processes=1):
+    st = os.stat(path)
+    if is_gzip(path):
+        with open_input(path) as fin:
+            index = index_gff_lines(fin)
+    elif pool is not None:
+        parts = [pool.apply_async(index_gff_range, (path, start, end)) for start, end in line_ranges(path, processes)]
+        index = merge_gff_indexes(part.get() for part in parts)
+    else:
+        with open(path, 'rb') as fin:
+            index = index_gff_lines(fin, 0)
+    del index['lead']
+    del index['last']
+    index['size'] = st.st_size
+    index['mtime'] = st.st_mtime
+    tmp = gff_index_path(path) + '.' + str(os.getpid())
+    try:
+        with open(tmp, 'w') as out:
+            json.dump(index, out)
+        os.rename(tmp, gff_index_path(path))
+        logging.info("index written : " + gff_index_path(path))
+    except (IOError, OSError) as e:
+        # Read only directory, the index is used for this run only
+        logging.info("index not written for " + path + " : " + str(e))
+    return index
+
+
+# Reads the sidecar index of a gff3 file, builds it if it is missing or out of date
+def gff_index(path, pool=None, processes=1):
+    index = read_gff_index(path)
+    if index is None:
+        index = build_gff_index(path, pool, processes)
+    return index
+
+
+# Gets the chromosomes names in the gff3 file from its sidecar index
+# Argv = the gff file, plain or gzipped
+# Returns a chromosome list
+def gff_chromosomes(path):
+    wanted = [c.encode('utf-8') for c in gff_index(path)['chromosomes']]
+    logging.info("chromosome list for " + path + " : " + ','.join(wanted))
+    return wanted
+
+
+# Reads the lines of one seqid of a plain gff3 file, jumping to them with the sidecar index
+# Argv = the gff file and the seqid
+# Yields the lines
+def read_gff_seqid(path, seqid):
+    seqids = gff_index(path)['seqids']
+    if seqids is None:
+        raise ValueError(path + " is gzipped, its lines can not be reached by offset")
+    for start, end in seqids.get(seqid, []):
+        for line in read_range(path, start, end):
+            yield line
+
+
+# Attribute prefix rules of the raw Ensembl gff3 files : (prefix, new prefix)
+# The type part of the Ensembl ids is removed (ID=gene:ENSG... becomes ID=ENSG...)
+ensembl_attribute_rules = [('ID=chromosome:', 'ID='),
+                           ('ID=gene:', 'ID='),
+                           ('ID=transcript:', 'ID='),
+                           ('ID=CDS:', 'ID='),
+                           ('Parent=gene:', 'Parent='),
+                           ('Parent=transcript:', 'Parent=')]
+
+# Feature type rules of the raw Ensembl gff3 files : (type pattern, attribute prefix the feature must have, new type)
+# Genes described with another type (ncRNA_gene, pseudogene...) become genes
+ensembl_type_rules = [('*_gene', 'ID=gene:', 'gene'),
+                      ('RNA', 'ID=gene:', 'gene')]
+
+
+class GffRewriter(object):
+
+    # Compiles the rules
+    # All the attribute prefixes are matched by a single regular expression, at the beginning of the column or after a ;
+    # Argv = attribute prefix rules and feature type rules
+    def __init__(self, attribute_rules, type_rules):
+        self.prefixes = dict(attribute_rules)
+        alternatives = '|'.join(re.escape(p) for p in sorted(self.prefixes, key=len, reverse=True))
+        self.attribute_re = re.compile('(?<![^;])(?:' + alternatives + ')')
+        self.type_rules = [(re.compile(fnmatch.translate(pattern)).match, condition, new) for pattern, condition, new in type_rules]
+        # Type rules matching each type seen, (attribute prefix, new type)
+        self.types = {}
+
+    # Rewrites the type and the attributes of a feature
+    # Argv = the 9 gff fields, changed in place
+    # Returns the fields
+    def rewrite(self, gff_fields):
+        rules = self.types.get(gff_fields[2])
+        if rules is None:
+            rules = self.types[gff_fields[2]] = [(condition, new) for match, condition, new in self.type_rules if match(gff_fields[2])]
+        for condition, new in rules:
+            if gff_fields[8].startswith(condition) or ';' + condition in gff_fields[8]:
+                gff_fields[2] = new
+                break
+        gff_fields[8] = self.attribute_re.sub(self.replace, gff_fields[8])
+        return gff_fields
+
+    def replace(self, match):
+        return self.prefixes[match.group()]
+
+
+# Rewriter of the raw Ensembl gff3 files
+ensembl_rewriter = GffRewriter(ensembl_attribute_rules, ensembl_type_rules)
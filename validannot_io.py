@@ -0,0 +1,512 @@
+#!/usr/bin/python
+
+# validannot_io.py
+# Shared input and output tools for the validannot scripts
+
+import bisect
+import collections
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+import Queue
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+#############
+# Functions #
+#############
+
+# Incremental gzip decompression, following the members of multi-member files (bgzf files are multi-member)
+class GzipDecoder(object):
+
+    def __init__(self):
+        self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.empty = True
+
+    # Returns the decompressed data available after a block of compressed data
+    def decompress(self, block):
+        self.empty = self.empty and not block
+        out = [self.d.decompress(block)]
+        while self.d.unused_data:
+            rest = self.d.unused_data
+            self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self.d.decompress(rest))
+        return ''.join(out)
+
+    # Returns the last decompressed data, raises IOError if the last member is not complete (truncated file)
+    def flush(self):
+        if self.empty:
+            return ''
+        # A complete member leaves the data following its end unused, an incomplete one goes on decompressing it
+        end = self.d.copy()
+        try:
+            end.decompress('\0')
+        except zlib.error:
+            raise IOError("truncated gzip data")
+        if not end.unused_data:
+            raise IOError("truncated gzip data")
+        return self.d.flush()
+
+
+# Splits a stream of data blocks into lines, line ends are kept as in a file iteration
+# Argv = an iterable of data blocks
+# Yields the lines
+def split_lines(blocks):
+    tail = ''
+    for block in blocks:
+        if not block:
+            continue
+        lines = (tail + block).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+
+# Finds an input file of the validannot directories, gunzipped or gzipped
+# Argv = path and gz file name
+# Returns the path of the gunzipped file if it exists, else of the gz file, None if none of them exists
+def find_input(p, f):
+    if os.path.isfile(os.path.join(p, f[:-3])):
+        logging.info("Found gunzipped file: " + f[:-3])
+        return os.path.join(p, f[:-3])
+    elif os.path.isfile(os.path.join(p, f)):
+        logging.info("Found gzipped file: " + f)
+        return os.path.join(p, f)
+    logging.info("No such file: " + os.path.join(p, f))
+    return None
+
+
+# Opens an input file, plain, gzip or bgzf, without writing anything to disk
+# gzip and bgzf files are recognized by their first bytes, whatever their name
+# Argv = file path and a hashlib object updated with the bytes of the file as they are read (None for no checksum)
+# Returns a file like object (iteration, readline, read, close)
+def open_input(path, checksum=None):
+    if is_gzip(path):
+        return DecompressedInput(path, checksum=checksum)
+    if checksum is not None:
+        return ChecksumInput(path, checksum)
+    return open(path, 'rU')
+
+
+# Reader of a plain file computing the checksum of its bytes while they are read : the file is read once for both
+class ChecksumInput(object):
+
+    # Argv = file path and hashlib object
+    def __init__(self, path, checksum):
+        self.name = path
+        self.fin = open(path, 'rb')
+        self.checksum = checksum
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        self.checksum.update(data)
+        return data
+
+    def readline(self):
+        line = self.fin.readline()
+        self.checksum.update(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Returns True if a file is gzip or bgzf compressed, following its first bytes
+def is_gzip(path):
+    with open(path, 'rb') as fin:
+        return fin.read(2) == '\x1f\x8b'
+
+
+# Splits a plain file into byte ranges starting and ending at line boundaries, to be read by several processes
+# Argv = file path and number of ranges
+# Returns a list of (start, end) offsets, fewer than asked for small files
+def line_ranges(path, n):
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as fin:
+        for i in range(1, n):
+            pos = size * i // n
+            if pos <= bounds[-1]:
+                continue
+            # The range ends at the end of the line containing pos
+            fin.seek(pos - 1)
+            fin.readline()
+            if fin.tell() >= size:
+                break
+            if fin.tell() > bounds[-1]:
+                bounds.append(fin.tell())
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+# Reads the lines of a byte range of a plain file
+# Argv = file path, start and end offsets from line_ranges
+# Yields the lines
+def read_range(path, start, end):
+    with open(path, 'rb') as fin:
+        fin.seek(start)
+        pos = start
+        for line in fin:
+            yield line
+            pos += len(line)
+            if pos >= end:
+                break
+
+
+# Reader of a gzip or bgzf file, decompressed in a thread while the lines are read
+# zlib releases the GIL, decompression and parsing run at the same time
+class DecompressedInput(object):
+
+    # Argv = file path, size of the compressed blocks read at once and a hashlib object updated with the compressed bytes (None for no checksum)
+    def __init__(self, path, block_size=1 << 20, checksum=None):
+        self.name = path
+        self.checksum = checksum
+        self.blocks = Queue.Queue(16)
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.decompress, args=(path, block_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress(self, path, block_size):
+        decoder = GzipDecoder()
+        try:
+            with open(path, 'rb') as fin:
+                for block in iter(lambda: fin.read(block_size), ''):
+                    if self.stopped:
+                        return
+                    if self.checksum is not None:
+                        self.checksum.update(block)
+                    self.blocks.put(decoder.decompress(block))
+            self.blocks.put(decoder.flush())
+            self.blocks.put(None)
+        except Exception as e:
+            self.blocks.put(e)
+
+    # Adds the next decompressed block to the buffer
+    # Returns False at the end of the file
+    def fill(self):
+        while not self.done:
+            block = self.blocks.get()
+            if block is None:
+                self.done = True
+            elif isinstance(block, Exception):
+                self.done = True
+                raise block
+            elif block:
+                self.buffer = self.buffer[self.pos:] + block
+                self.pos = 0
+                return True
+        return False
+
+    def readline(self):
+        start = self.pos
+        while True:
+            end = self.buffer.find('\n', start)
+            if end >= 0:
+                line = self.buffer[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+            start = len(self.buffer) - self.pos
+            if not self.fill():
+                line = self.buffer[self.pos:]
+                self.pos = len(self.buffer)
+                return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            if not self.fill():
+                break
+        if size < 0:
+            size = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    # Stops the decompression if the file is not read to the end
+    def close(self):
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.buffer = ''
+        self.pos = 0
+        self.done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Sort key ordering chromosome names naturally : 1, 2, ..., 10, X, Y, MT, then unplaced sequences
+# Names are compared on their numeric parts as numbers (2A before 10, chr2 before chr10)
+def chromosome_key(name):
+    n = name
+    if n.lower().startswith('chr'):
+        n = n[3:]
+    if n.upper() in ('X', 'Y', 'Z', 'W'):
+        rank = 1
+    elif n.upper() in ('MT', 'M', 'MITO'):
+        rank = 3
+    elif n.lower().startswith('un'):
+        rank = 4
+    elif n[:1].isdigit():
+        rank = 0
+    else:
+        rank = 2
+    return (rank, [int(p) if p.isdigit() else p for p in re.split(r'(\d+)', n)])
+
+
+# Kernel side copies available for this python and os, from the fastest to the most common
+# copy_file_range lets the file system copy without reading (server side copy on NFS 4.2), sendfile avoids user space buffers
+# They come from the os module (python 3) or from the C library (python 2, Linux)
+# Returns a list of functions copy(in_fd, out_fd, in_offset, count) returning the number of bytes copied
+def kernel_copies():
+    copies = []
+    if hasattr(os, 'copy_file_range'):
+        copies.append(lambda fin, fout, offset, count: os.copy_file_range(fin, fout, count, offset))
+    if hasattr(os, 'sendfile'):
+        copies.append(lambda fin, fout, offset, count: os.sendfile(fout, fin, offset, count))
+    if copies:
+        return copies
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        return copies
+
+    def checked(n):
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+
+    if hasattr(libc, 'copy_file_range'):
+        copy_file_range = libc.copy_file_range
+        copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        copy_file_range.restype = ctypes.c_ssize_t
+        copies.append(lambda fin, fout, offset, count: checked(copy_file_range(fin, ctypes.byref(ctypes.c_int64(offset)), fout, None, count, 0)))
+    if hasattr(libc, 'sendfile64'):
+        sendfile = libc.sendfile64
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+        copies.append(lambda fin, fout, offset, count: checked(sendfile(fout, fin, ctypes.byref(ctypes.c_int64(offset)), count)))
+    return copies
+
+
+# Appends a file at the end of an open output file with constant memory
+# The copy is done by the kernel when possible, by 1 MB blocks otherwise
+# Argv = the output file object and the input file path
+# Returns the number of bytes copied
+def append_file(out, path):
+    out.flush()
+    with open(path, 'rb') as fin:
+        size = os.fstat(fin.fileno()).st_size
+        done = 0
+        for copy in kernel_copies():
+            try:
+                while done < size:
+                    n = copy(fin.fileno(), out.fileno(), done, min(size - done, 1 << 30))
+                    if n == 0:
+                        break
+                    done += n
+            except OSError:
+                # Not supported for these files (other file systems, old kernel), try the next way
+                continue
+            if done == size:
+                return size
+        fin.seek(done)
+        shutil.copyfileobj(fin, out, 1 << 20)
+        return size
+
+
+# BGZF (blocked gzip) writer, the format of bgzip, samtools and tabix
+# Data is cut in blocks of 65280 bytes, each one written as a gzip member with its compressed size in the header
+# The file is readable by any gzip reader and can be indexed by block (samtools faidx, tabix)
+# Blocks are compressed on a pool of threads (zlib releases the GIL) and written in order
+class BgzfWriter(object):
+
+    block_size = 65280
+    # Empty block ending every bgzf file
+    eof = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    # Argv = output file path, compression level (1 fastest to 9 smallest) and number of compression threads (default=number of cpus)
+    def __init__(self, path, level=6, threads=None):
+        self.out = open(path, 'wb')
+        self.level = level
+        self.buffer = []
+        self.buffered = 0
+        self.threads = threads or cpu_count()
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+        # Blocks being compressed, in file order
+        self.pending = collections.deque()
+        # Compressed and uncompressed offsets of the blocks written, for the .gzi index
+        self.blocks = []
+        self.offsets = (0, 0)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = ''.join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for i in range(0, end, self.block_size):
+                self.compress(data[i:i + self.block_size])
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    # Compresses a block, written once the previous blocks are written
+    # At most two blocks per thread are held in memory
+    def compress(self, data):
+        if self.pool is None:
+            self.write_block(bgzf_block(data, self.level), len(data))
+            return
+        self.pending.append((self.pool.apply_async(bgzf_block, (data, self.level)), len(data)))
+        while len(self.pending) > 2 * self.threads:
+            block, size = self.pending.popleft()
+            self.write_block(block.get(), size)
+
+    def write_block(self, block, size):
+        self.blocks.append(self.offsets)
+        self.out.write(block)
+        self.offsets = (self.offsets[0] + len(block), self.offsets[1] + size)
+
+    def close(self):
+        if self.buffered:
+            self.compress(''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        while self.pending:
+            block, size = self.pending.popleft()
+            self.write_block(block.get(), size)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.out.write(self.eof)
+        self.out.close()
+
+    # Writes the .gzi index of the file (bgzip -i), used with the .fai index to read a region of a bgzf fasta file
+    # The offsets of every block but the first one, compressed and uncompressed
+    def write_gzi(self, path):
+        with open(path, 'wb') as out:
+            out.write(struct.pack('<Q', len(self.blocks[1:])))
+            for offsets in self.blocks[1:]:
+                out.write(struct.pack('<QQ', *offsets))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Random access reader of a bgzf file, by uncompressed offsets
+# The block offsets come from the .gzi index (bgzip -i, BgzfWriter.write_gzi), or from the block headers when there is no index
+# The last block read is kept, reads at increasing offsets decompress each block once
+class BgzfReader(object):
+
+    # Argv = bgzf file path
+    def __init__(self, path):
+        self.fin = open(path, 'rb')
+        if os.path.isfile(path + '.gzi'):
+            with open(path + '.gzi', 'rb') as gzi:
+                n = struct.unpack('<Q', gzi.read(8))[0]
+                offsets = [(0, 0)] + [struct.unpack('<QQ', gzi.read(16)) for i in range(n)]
+        else:
+            offsets = self.scan()
+        self.compressed = [c for c, u in offsets]
+        self.uncompressed = [u for c, u in offsets]
+        self.block = (-1, '')
+
+    # Reads the block headers
+    # Returns the compressed and uncompressed offsets of the blocks
+    def scan(self):
+        offsets = []
+        c = u = 0
+        while True:
+            self.fin.seek(c)
+            header = self.fin.read(18)
+            if len(header) < 18:
+                return offsets
+            if header[:4] != '\x1f\x8b\x08\x04' or header[12:14] != 'BC':
+                raise ValueError(self.fin.name + " is not a bgzf file")
+            size = struct.unpack('<H', header[16:18])[0] + 1
+            self.fin.seek(c + size - 4)
+            offsets.append((c, u))
+            c += size
+            u += struct.unpack('<I', self.fin.read(4))[0]
+
+    # Returns the uncompressed data of the block i
+    def read_block(self, i):
+        if self.block[0] != i:
+            self.fin.seek(self.compressed[i])
+            header = self.fin.read(18)
+            data = header + self.fin.read(struct.unpack('<H', header[16:18])[0] + 1 - 18)
+            self.block = (i, zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data))
+        return self.block[1]
+
+    # Returns the uncompressed data from start to end
+    def read(self, start, end):
+        data = []
+        i = bisect.bisect_right(self.uncompressed, start) - 1
+        pos = start
+        while pos < end and i < len(self.compressed):
+            block = self.read_block(i)
+            data.append(block[pos - self.uncompressed[i]:end - self.uncompressed[i]])
+            i += 1
+            if i < len(self.uncompressed):
+                pos = self.uncompressed[i]
+        return ''.join(data)
+
+    def close(self):
+        self.fin.close()
+
+
+# Opens an output file, plain or bgzf compressed
+# Argv = file path, compression level (None for a plain file) and number of compression threads
+# Returns a file like object (write, close)
+def open_output(path, level=None, threads=None):
+    if level is None:
+        return open(path, 'w')
+    return BgzfWriter(path, level, threads)
+
+
+# Compresses up to 65536 bytes into a bgzf block
+def bgzf_block(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+# validannot_stats.py
+# Bounded memory length statistics of gff3 features, whatever the size of the file
+# Mean and variance are updated online (Welford), quantiles come from a relative error sketch (DDSketch)
+# Stats of parts of a file are merged into the stats of the whole file
+
+from validannot_gff import parse_attributes
+from validannot_gff import read_gff
+from validannot_io import is_gzip
+from validannot_io import line_ranges
+from validannot_io import open_input
+from validannot_io import read_range
+import math
+import os
+from multiprocessing import Pool
+
+
+#############
+# Functions #
+#############
+
+# Quantile sketch of non negative values with a relative error bound (DDSketch, Masson et al. 2019)
+# Values are counted in buckets growing geometrically : a quantile is returned within accuracy x its true value
+# The number of buckets depends on the range of the values (about 750 from 1 to 10 Mb at 1%), not on their number
+class QuantileSketch(object):
+
+    # Argv = relative accuracy of the quantiles (0.01 = 1%)
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = int(math.ceil(math.log(value) / self.log_gamma))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    # Adds the values of a sketch of the same accuracy
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Sketches of different accuracies can not be merged")
+        for key, n in other.buckets.iteritems():
+            self.buckets[key] = self.buckets.get(key, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+
+    # Returns the value of rank q x (count - 1) within the accuracy, None if the sketch is empty
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        n = self.zeros
+        if rank < n:
+            return 0.0
+        for key in sorted(self.buckets):
+            n += self.buckets[key]
+            if n > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+# Length statistics of features : count, total, online mean and variance, exact min and max with their IDs, quantile sketch
+class LengthStats(object):
+
+    # Argv = relative accuracy of the quantiles
+    def __init__(self, accuracy=0.01):
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = self.min_id = None
+        self.max = self.max_id = None
+        self.sketch = QuantileSketch(accuracy)
+
+    def add(self, id_feature, length):
+        self.count += 1
+        self.total += length
+        delta = length - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (length - self.mean)
+        if self.min is None or length < self.min:
+            self.min, self.min_id = length, id_feature
+        if self.max is None or length > self.max:
+            self.max, self.max_id = length, id_feature
+        self.sketch.add(length)
+
+    # Adds the stats of another part (Chan et al. pairwise update of the mean and variance)
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min, self.min_id = other.min, other.min_id
+        if self.max is None or other.max > self.max:
+            self.max, self.max_id = other.max, other.max_id
+        self.sketch.merge(other.sketch)
+
+    # Sample standard deviation, as pandas computes it
+    def std(self):
+        if self.count < 2:
+            return float('nan')
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+
+# Length stats of the features of gff3 lines, for all the features and by type and seqid
+# Features without ID are not counted, consecutive features of the same ID (CDS of a protein) are counted once, the last one
+# Argv = the lines, the wanted types (None for all) and the accuracy of the quantiles
+# Returns the stats of all the features, a dictionary type:stats and a dictionary seqid:stats
+def gff_length_stats(lines, types, accuracy):
+    stats = LengthStats(accuracy)
+    by_type = {}
+    by_seqid = {}
+    pending = None
+    for record in read_gff(lines, types):
+        id_feature = record.attribute('ID')
+        if id_feature is None:
+            continue
+        if pending is not None and pending[0] != id_feature:
+            add_feature(stats, by_type, by_seqid, pending, accuracy)
+        pending = (id_feature, record)
+    if pending is not None:
+        add_feature(stats, by_type, by_seqid, pending, accuracy)
+    return stats, by_type, by_seqid
+
+
+def add_feature(stats, by_type, by_seqid, pending, accuracy):
+    id_feature, record = pending
+    length = record.end - record.start
+    stats.add("ID=" + id_feature, length)
+    for groups, key in ((by_type, record.type), (by_seqid, record.seqid)):
+        if key not in groups:
+            groups[key] = LengthStats(accuracy)
+        groups[key].add("ID=" + id_feature, length)
+
+
+# Gets the ID of the feature of a gff3 line, without building a record
+# Argv = the line and the wanted types (None for all)
+# Returns the ID, None for a comment line, a feature of another type or a feature without ID
+def gff_line_id(line, types):
+    if line.startswith('#'):
+        return None
+    gff_fields = line.strip().split('\t', 8)
+    if len(gff_fields) < 9 or (types is not None and gff_fields[2] not in types):
+        return None
+    return parse_attributes(gff_fields[8]).get('ID')
+
+
+# Moves the inner bounds of byte ranges of a plain gff3 file to the beginning of a new ID run
+# A bound is set at the first feature whose ID differs from the ID of the feature before it, both after the former bound :
+# a run of features of the same ID (CDS of a protein) is read by a single process and counted once, as in a single read
+# Argv = the gff file, its byte ranges (line_ranges) and the wanted types (None for all)
+# Returns the list of (start, end) offsets, fewer than given when a run goes on until the end of the file
+def id_run_ranges(path, ranges, types):
+    bounds = [0]
+    with open(path, 'rb') as fin:
+        for start, end in ranges[1:]:
+            pos = max(start, bounds[-1])
+            fin.seek(pos)
+            previous = None
+            bound = None
+            for line in iter(fin.readline, ''):
+                id_feature = gff_line_id(line, types)
+                if id_feature is not None:
+                    if previous is not None and id_feature != previous:
+                        bound = pos
+                        break
+                    previous = id_feature
+                pos += len(line)
+            if bound is None:
+                break
+            bounds.append(bound)
+    bounds.append(os.path.getsize(path))
+    return zip(bounds[:-1], bounds[1:])
+
+
+# Length stats of a byte range of a plain gff3 file, run by the worker processes
+def gff_range_length_stats(path, start, end, types, accuracy):
+    return gff_length_stats(read_range(path, start, end), types, accuracy)
+
+
+# Merges the length stats of consecutive parts of a file
+def merge_length_stats(parts, accuracy):
+    stats = LengthStats(accuracy)
+    by_type = {}
+    by_seqid = {}
+    for part_stats, part_by_type, part_by_seqid in parts:
+        stats.merge(part_stats)
+        for groups, part_groups in ((by_type, part_by_type), (by_seqid, part_by_seqid)):
+            for key, s in part_groups.items():
+                if key not in groups:
+                    groups[key] = LengthStats(accuracy)
+                groups[key].merge(s)
+    return stats, by_type, by_seqid
+
+
+# Length stats of the features of a gff3 file, read once with constant memory
+# A plain file can be read by parts on a pool of processes, the stats of the parts being merged
+# The parts begin with a new ID run (id_run_ranges) : the stats do not depend on the number of processes
+# Argv = the gff file, the wanted types (None for all), the accuracy of the quantiles and the number of processes
+# Returns the stats of all the features, a dictionary type:stats and a dictionary seqid:stats
+def read_gff_length_stats(path, types=None, accuracy=0.01, processes=1):
+    if processes > 1 and not is_gzip(path):
+        pool = Pool(processes)
+        try:
+            parts = [pool.apply_async(gff_range_length_stats, (path, start, end, types, accuracy))
+                     for start, end in id_run_ranges(path, line_ranges(path, processes), types)]
+            return merge_length_stats((part.get() for part in parts), accuracy)
+        finally:
+            pool.close()
+            pool.join()
+    with open_input(path) as fin:
+        return gff_length_stats(fin, types, accuracy)
@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+# validannot_table.py
+# Columnar tables of gff3 features for the analyses (pandas)
+# The gff3 file is read by chunks by the pandas C parser, the ID attributes are extracted by a vectorized regular expression
+# The features of all the types are kept in a columnar snapshot next to the gff3 file (file.table.npz), read instead of the text by the next analyses
+# The size, modification time and md5 of the gff3 file the snapshot was made from are kept beside it (file.table.json)
+
+from validannot_cache import md5_checksum
+from validannot_io import open_input
+import csv
+import hashlib
+import json
+import logging
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+
+#############
+# Functions #
+#############
+
+gff_columns = ['seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attributes']
+table_columns = ['Ensembl ID', 'seqid', 'type', 'start', 'end']
+
+
+# Parses the features of a gff3 file having an ID, in the file order
+# Comment and header lines are skipped
+# Argv = the gff file (plain or gzipped), the wanted types (None for all), the number of lines read at once
+# and a hashlib object updated with the bytes of the file while it is read (None for no checksum)
+# Returns a data.frame : Ensembl ID (ID=xxx), seqid and type (categories), start and end (int64)
+def parse_gff_table(path, types=None, chunksize=1 << 18, checksum=None):
+    chunks = []
+    with open_input(path, checksum) as fin:
+        reader = pd.read_csv(fin, sep='\t', header=None, names=gff_columns, usecols=['seqid', 'type', 'start', 'end', 'attributes'],
+                             dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False, chunksize=chunksize)
+        for chunk in reader:
+            # Comment and header lines have a single column, the next ones are missing (NaN)
+            if types is not None:
+                chunk = chunk[chunk['type'].isin(types)]
+            else:
+                chunk = chunk[chunk['end'].notnull() & ~chunk['seqid'].str.startswith('#')]
+            ids = chunk['attributes'].str.extract(r'(?:^|;)ID=([^;]*)', expand=False)
+            chunk = chunk[ids.notnull()]
+            chunks.append(pd.DataFrame({'Ensembl ID': 'ID=' + ids[ids.notnull()],
+                                        'seqid': chunk['seqid'],
+                                        'type': chunk['type'],
+                                        'start': pd.to_numeric(chunk['start']).astype(np.int64),
+                                        'end': pd.to_numeric(chunk['end']).astype(np.int64)},
+                                       columns=table_columns))
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        df = pd.DataFrame({'Ensembl ID': [], 'seqid': [], 'type': [], 'start': np.array([], np.int64), 'end': np.array([], np.int64)},
+                          columns=table_columns)
+    df['seqid'] = df['seqid'].astype('category')
+    df['type'] = df['type'].astype('category')
+    return df
+
+
+# Keeps one row per ID (the last feature of an ID, as a dictionary would keep it) and adds the Length column (end - start)
+def unique_features(df):
+    df = df.drop_duplicates('Ensembl ID', keep='last').reset_index(drop=True)
+    if 'start' in df and 'end' in df:
+        df['Length'] = df['end'] - df['start']
+    return df
+
+
+# Reads the features of a gff3 file as a table, one row per ID
+# Features without ID are not counted
+# Argv = the gff file (plain or gzipped), the wanted types (None for all) and the number of lines read at once
+# Returns a data.frame : Ensembl ID, seqid and type (categories), start, end and Length (int64)
+def read_gff_table(path, types=None, chunksize=1 << 18):
+    return unique_features(parse_gff_table(path, types, chunksize))
+
+
+# Columnar snapshot of a gff3 file, written next to it as file.table.npz
+# It is valid while the size of the file and its modification time (or else its md5) do not change
+def gff_table_cache_path(path):
+    return path + '.table.npz'
+
+
+# Size, modification time and md5 of the gff3 file of a snapshot, written next to it as file.table.json
+def gff_table_stat_path(path):
+    return path + '.table.json'
+
+
+# Writes the size, modification time and md5 of the gff3 file of a snapshot
+# Returns False if the file can not be written (read only directory)
+def write_gff_table_stat(path, st, md5):
+    stat = gff_table_stat_path(path)
+    tmp = stat + '.' + str(os.getpid())
+    try:
+        with open(tmp, 'w') as out:
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5}, out)
+        os.rename(tmp, stat)
+    except (IOError, OSError) as e:
+        logging.info("Snapshot stats not written for " + path + " : " + str(e))
+        return False
+    return True
+
+
+# Writes the columnar snapshot of a gff3 file : strings as fixed width arrays, categories as codes and names
+# Argv = the gff file, the table of all its features (parse_gff_table), its os.stat and its md5 computed while it was parsed
+def write_gff_table_cache(path, df, st, md5):
+    cache = gff_table_cache_path(path)
+    tmp = cache + '.' + str(os.getpid())
+    try:
+        with open(tmp, 'wb') as out:
+            np.savez(out,
+                     ids=np.array(df['Ensembl ID'].values, dtype=str),
+                     seqid_codes=df['seqid'].cat.codes.values, seqid_names=np.array(df['seqid'].cat.categories, dtype=str),
+                     type_codes=df['type'].cat.codes.values, type_names=np.array(df['type'].cat.categories, dtype=str),
+                     start=df['start'].values, end=df['end'].values)
+        os.rename(tmp, cache)
+        if write_gff_table_stat(path, st, md5):
+            logging.info("Columnar snapshot written : " + cache)
+    except (IOError, OSError) as e:
+        # Read only directory, the table is used for this run only
+        logging.info("Columnar snapshot not written for " + path + " : " + str(e))
+
+
+# Opens the columnar snapshot of a gff3 file, arrays being read from the npz file only when they are used
+# A file touched but not changed (same md5) keeps its snapshot, its new modification time is written : its md5 is computed once
+# Returns the NpzFile, None if there is no snapshot or if the file changed since
+def read_gff_table_cache(path):
+    try:
+        with open(gff_table_stat_path(path)) as fin:
+            stat = json.load(fin)
+        size, mtime, md5 = stat['size'], stat['mtime'], stat['md5']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+    st = os.stat(path)
+    if size != st.st_size:
+        return None
+    if mtime != st.st_mtime:
+        if md5 != md5_checksum(path):
+            return None
+        logging.info(path + " touched but not changed, snapshot kept")
+        write_gff_table_stat(path, st, md5)
+    try:
+        return np.load(gff_table_cache_path(path))
+    except (IOError, ValueError, zipfile.BadZipfile):
+        return None
+
+
+# Reads the features of a gff3 file as a table, one row per ID, from its columnar snapshot
+# The snapshot holds all the types, it is written by the first analysis of the file
+# Only the columns asked for are read from the snapshot
+# Argv = the gff file, the wanted types (None for all) and the wanted columns (among Ensembl ID, seqid, type, start, end)
+# Returns the same data.frame as read_gff_table, with the wanted columns (and Length with start and end)
+def load_gff_table(path, types=None, columns=table_columns):
+    # The IDs are always read, a row by ID being kept
+    columns = [c for c in table_columns if c == 'Ensembl ID' or c in columns]
+    data = read_gff_table_cache(path)
+    if data is None:
+        st = os.stat(path)
+        md5 = hashlib.md5()
+        df = parse_gff_table(path, checksum=md5)
+        write_gff_table_cache(path, df, st, md5.hexdigest())
+        if types is not None:
+            df = df[df['type'].isin(types)]
+        return unique_features(df[columns])
+    logging.info("Reading columnar snapshot of " + path)
+    type_names = data['type_names']
+    type_codes = data['type_codes']
+    if types is not None:
+        rows = np.array([t in types for t in type_names], dtype=bool)[type_codes]
+    else:
+        rows = slice(None)
+    df = pd.DataFrame(index=np.arange(len(type_codes))[rows])
+    df['Ensembl ID'] = data['ids'][rows].astype(object)
+    if 'seqid' in columns:
+        df['seqid'] = pd.Categorical.from_codes(data['seqid_codes'][rows], data['seqid_names'].astype(object))
+    if 'type' in columns:
+        df['type'] = pd.Categorical.from_codes(type_codes[rows], type_names.astype(object))
+    for c in ('start', 'end'):
+        if c in columns:
+            df[c] = data[c][rows]
+    data.close()
+    return unique_features(df[columns])